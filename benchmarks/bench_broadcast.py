@@ -0,0 +1,123 @@
+"""Benchmark of the node output broadcast to websockets.
+
+Compares writing node output with `write_message` for each websocket with
+writing a frame encoded once for all websockets (`BroadcastMessage`), at
+several numbers of viewers. Viewers run in their own process, only the CPU
+time of the server process is measured. Reports the CPU time per MB
+delivered to the viewers.
+
+Usage: PYTHONPATH=. python benchmarks/bench_broadcast.py [--size MB]
+"""
+
+import argparse
+import multiprocessing
+import time
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+from tornado.httpserver import HTTPServer
+from tornado.web import Application
+from tornado.websocket import WebSocketHandler, websocket_connect
+
+from iotlabwebsocket.broadcast import BroadcastMessage
+
+VIEWERS = (1, 2, 10, 100)
+CHUNK_SIZE = 1024  # bytes per node read
+WINDOW = 16  # chunks written before waiting for the viewers
+
+
+class ViewerHandler(WebSocketHandler):
+    # pylint:disable=abstract-method
+    def initialize(self, viewers):
+        self.viewers = viewers
+
+    def open(self):
+        self.viewers.append(self)
+
+
+def viewers_process(port, count, size):
+    """Open `count` websockets and read `size` bytes on each of them."""
+
+    @gen.coroutine
+    def read(connection):
+        received = 0
+        while received < size:
+            message = yield connection.read_message()
+            if message is None:
+                return
+            received += len(message)
+
+    @gen.coroutine
+    def run():
+        url = "ws://localhost:{}/".format(port)
+        connections = yield [websocket_connect(url) for _ in range(count)]
+        yield [read(connection) for connection in connections]
+
+    IOLoop.current().run_sync(run)
+
+
+@gen.coroutine
+def run(port, viewers, count, size, broadcast):
+    """Stream `size` bytes to `count` viewers, return the CPU time."""
+    # Viewers need their own event loop, not a copy of the running one
+    process = multiprocessing.get_context("spawn").Process(
+        target=viewers_process, args=(port, count, size), daemon=True
+    )
+    process.start()
+    while len(viewers) < count:
+        yield gen.sleep(0.01)
+    chunk = "x" * (CHUNK_SIZE - 1) + "\n"
+    start = time.process_time()
+    writes = []
+    for index in range(size // CHUNK_SIZE):
+        if broadcast:
+            message = BroadcastMessage(chunk, False)
+            writes = [message.write_to(viewer) for viewer in viewers]
+        else:
+            writes = [viewer.write_message(chunk) for viewer in viewers]
+        if index % WINDOW == 0:
+            yield writes
+    yield writes
+    elapsed = time.process_time() - start
+    while process.is_alive():
+        yield gen.sleep(0.01)
+    for viewer in viewers:
+        viewer.close()
+    viewers.clear()
+    return elapsed
+
+
+@gen.coroutine
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=2, help="MB per viewer")
+    args = parser.parse_args()
+    size = args.size * 1024 * 1024
+
+    viewers = []
+    sock, port = bind_unused_port()
+    server = HTTPServer(Application([(r"/", ViewerHandler, dict(viewers=viewers))]))
+    server.add_sockets([sock])
+
+    print(
+        "{:<8} {:>14} {:>16} {:>8}".format(
+            "viewers", "write ms/MB", "broadcast ms/MB", "gain"
+        )
+    )
+    for count in VIEWERS:
+        delivered = size * count / 1024 / 1024
+        results = []
+        for broadcast in (False, True):
+            elapsed = yield run(port, viewers, count, size, broadcast)
+            results.append(elapsed * 1000 / delivered)
+        print(
+            "{:<8} {:>14.2f} {:>16.2f} {:>7.1f}x".format(
+                count, results[0], results[1], results[0] / results[1]
+            )
+        )
+    server.stop()
+
+
+if __name__ == "__main__":
+    IOLoop.current().run_sync(main, timeout=600)
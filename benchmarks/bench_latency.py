@@ -0,0 +1,117 @@
+"""Benchmark of the cost of the node output latency sampling.
+
+Fans node output out to websockets, through their frame coalescers, with
+latency sampling disabled and at several sampling rates. Websockets are
+stubs whose writes complete immediately. Reports the CPU time per node read
+and the overhead compared to no sampling, as measured and as estimated from
+the cost of sampling every read.
+
+Usage: PYTHONPATH=. python benchmarks/bench_latency.py [--reads N]
+"""
+
+import argparse
+import time
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from iotlabwebsocket.api import ApiClient
+from iotlabwebsocket.clients.tcp_client import TCPClient
+from iotlabwebsocket.coalescer import FrameCoalescer
+from iotlabwebsocket.web_application import WebApplication
+
+SAMPLE_RATES = (0, 0.001, 0.01, 0.1, 1)
+WEBSOCKETS = 2
+CHUNK = b"x" * 127 + b"\n"
+
+
+class ConnectionStub:
+    """Websocket connection that is never closing."""
+
+    @staticmethod
+    def is_closing():
+        return False
+
+
+class WebsocketStub:
+    """Raw websocket whose writes complete immediately."""
+
+    text = False
+    lines = False
+    endpoint = "raw"
+    user = "user"
+
+    def __init__(self, node):
+        self.node = node
+        self.ws_connection = ConnectionStub()
+        self.output = FrameCoalescer(self)
+
+    def write_message(self, message, binary=False):
+        future = Future()
+        future.set_result(None)
+        return future
+
+    def send_node_output(self, message):
+        self.output.write(message)
+
+
+@gen.coroutine
+def run(rate, reads):
+    """Return the CPU time per read of the fan-out at a sampling rate."""
+    application = WebApplication(
+        ApiClient("http"), scrollback_size=0, latency_sample_rate=rate
+    )
+    tcp_client = TCPClient(
+        sample_interval=application._latency_sample_interval()
+    )
+    session = application.sessions.open("m3-1", tcp_client)
+    for _ in range(WEBSOCKETS):
+        application.sessions.attach(session, WebsocketStub("m3-1"))
+    start = time.process_time()
+    for index in range(reads):
+        if tcp_client.sample_interval:
+            tcp_client._sample_read()
+        application.handle_tcp_data("m3-1", CHUNK)
+        if index % 64 == 0:
+            # Let the writes complete
+            yield gen.moment
+    yield gen.moment
+    return (time.process_time() - start) / reads
+
+
+@gen.coroutine
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--reads", type=int, default=100000, help="node reads")
+    parser.add_argument("--rounds", type=int, default=7, help="runs per rate")
+    args = parser.parse_args()
+
+    # Rates are run in turn, the best run of each rate is kept
+    results = dict.fromkeys(SAMPLE_RATES, float("inf"))
+    for _ in range(args.rounds):
+        for rate in SAMPLE_RATES:
+            elapsed = yield run(rate, args.reads)
+            results[rate] = min(results[rate], elapsed)
+
+    baseline = results[0]
+    # Overhead is derived from the cost of sampling every read, less noisy
+    sample_cost = results[1] - baseline
+    print(
+        "{:<12} {:>10} {:>17} {:>19}".format(
+            "sample rate", "us/read", "measured overhead", "estimated overhead"
+        )
+    )
+    for rate in SAMPLE_RATES:
+        print(
+            "{:<12} {:>10.2f} {:>16.2f}% {:>18.2f}%".format(
+                rate,
+                results[rate] * 1e6,
+                (results[rate] / baseline - 1) * 100,
+                rate * sample_cost / baseline * 100,
+            )
+        )
+
+
+if __name__ == "__main__":
+    IOLoop.current().run_sync(main, timeout=600)
@@ -0,0 +1,146 @@
+"""Benchmark of the messages handled per second per core.
+
+Runs the web application with a websocket and a node connected to it, both
+in their own process so only the CPU time of the application is measured.
+In the `input` direction, the websocket sends messages forwarded to the
+node; in the `output` direction, the node sends lines forwarded to a
+`lines` websocket, one message per line. Reports the messages handled per
+CPU second of the application.
+
+Usage: PYTHONPATH=. python benchmarks/bench_messages.py [--messages N]
+       [--rounds N] [--uvloop]
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import time
+
+from tornado import gen
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.tcpserver import TCPServer
+from tornado.testing import bind_unused_port
+from tornado.websocket import websocket_connect
+
+from iotlabwebsocket.api import ApiClient
+from iotlabwebsocket.clients.tcp_client import NODE_TCP_PORT
+from iotlabwebsocket.web_application import WebApplication
+
+TOKEN = "token"
+MESSAGE_SIZE = 32  # bytes
+LINE = b"x" * 63 + b"\n"
+WINDOW = 64  # messages sent before waiting for the connection
+
+
+class NodeServer(TCPServer):
+    """Node that reads `size` bytes or writes `lines` lines."""
+
+    def __init__(self, size=0, lines=0):
+        super().__init__()
+        self.size = size
+        self.lines = lines
+        self.connected = asyncio.Event()
+        self.done = asyncio.Event()
+
+    async def handle_stream(self, stream, address):
+        self.connected.set()
+        if self.lines:
+            for index in range(0, self.lines, WINDOW):
+                await stream.write(LINE * min(WINDOW, self.lines - index))
+            await self.done.wait()
+        else:
+            received = 0
+            while received < self.size:
+                data = await stream.read_bytes(65536, partial=True)
+                received += len(data)
+            self.done.set()
+        stream.close()
+
+
+def peer_process(port, direction, messages):
+    """Connect a node and a websocket to the application and exchange data."""
+
+    async def run():
+        if direction == "input":
+            node = NodeServer(size=messages * MESSAGE_SIZE)
+            path = "serial/raw"
+        else:
+            node = NodeServer(lines=messages)
+            path = "serial/lines"
+        node.listen(NODE_TCP_PORT, "localhost")
+        url = "ws://localhost:{}/ws/local/123/localhost/{}".format(port, path)
+        connection = await websocket_connect(
+            url, subprotocols=["user", "token", TOKEN]
+        )
+        await node.connected.wait()
+        if direction == "input":
+            # Let the application see the node connection as ready
+            await gen.sleep(0.2)
+            message = b"x" * MESSAGE_SIZE
+            for index in range(messages):
+                future = connection.write_message(message, binary=True)
+                if index % WINDOW == 0:
+                    await future
+        else:
+            received = 0
+            while received < messages:
+                message = await connection.read_message()
+                if message is None:
+                    break
+                received += 1
+            node.done.set()
+        await node.done.wait()
+        connection.close()
+        node.stop()
+
+    IOLoop.current().run_sync(run)
+
+
+async def run(app, port, direction, messages):
+    """Exchange `messages` messages, return the CPU time of the application."""
+    process = multiprocessing.get_context("spawn").Process(
+        target=peer_process, args=(port, direction, messages), daemon=True
+    )
+    start = time.process_time()
+    process.start()
+    while process.is_alive():
+        await gen.sleep(0.01)
+    elapsed = time.process_time() - start
+    while app.sessions.get("localhost") is not None:
+        await gen.sleep(0.01)
+    return elapsed
+
+
+async def main(args):
+    sock, port = bind_unused_port()
+    api = ApiClient("http", "localhost", port)
+    app = WebApplication(api, use_local_api=True, token=TOKEN, node_rate=0)
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+
+    print("event loop: {}".format(type(asyncio.get_running_loop()).__module__))
+    print("{:<10} {:>16}".format("direction", "messages/s/core"))
+    for direction in ("input", "output"):
+        # Best of several rounds, the machine is shared
+        elapsed = min(
+            [
+                await run(app, port, direction, args.messages)
+                for _ in range(args.rounds)
+            ]
+        )
+        print("{:<10} {:>16.0f}".format(direction, args.messages / elapsed))
+    server.stop()
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    PARSER.add_argument("--messages", type=int, default=100000)
+    PARSER.add_argument("--rounds", type=int, default=3)
+    PARSER.add_argument("--uvloop", action="store_true", help="Run on uvloop")
+    ARGS = PARSER.parse_args()
+    if ARGS.uvloop:
+        import uvloop  # pylint:disable=import-error
+
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    IOLoop.current().run_sync(lambda: main(ARGS), timeout=600)
@@ -0,0 +1,90 @@
+"""Benchmark of the node TCP read path.
+
+Compares the copying read path (`read_bytes`) with the zero-copy one
+(`read_into` with reused buffers) on a node stub, running in its own process,
+streaming data as fast as possible. Reports the throughput and the peak
+memory traced during a second, slower, run.
+
+Usage: PYTHONPATH=. python benchmarks/bench_read_path.py [--size MB]
+"""
+
+import argparse
+import multiprocessing
+import socket
+import time
+import tracemalloc
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from iotlabwebsocket.clients.tcp_client import TCPClient, NODE_TCP_PORT
+
+WRITE_SIZE = 256  # bytes per node write, like a chatty serial output
+
+
+def node_stub(size, ready):
+    """Stream `size` bytes to each client, then close the connection."""
+    server = socket.create_server(("localhost", NODE_TCP_PORT))
+    ready.set()
+    line = b"x" * (WRITE_SIZE - 1) + b"\n"
+    while True:
+        conn, _ = server.accept()
+        with conn:
+            for _ in range(size // WRITE_SIZE):
+                conn.sendall(line)
+
+
+@gen.coroutine
+def run(zero_copy):
+    """Stream the node output through a TCPClient, return bytes and time."""
+    done = Future()
+    received = [0]
+
+    def on_data(_, data):
+        received[0] += len(data)
+
+    def on_close(_, reason=""):
+        if not done.done():
+            done.set_result(None)
+
+    # Stub closes once all is sent, the client must not reconnect
+    client = TCPClient(rate=0, zero_copy=zero_copy, reconnect_window=0)
+    start = time.perf_counter()
+    yield client.start("localhost", on_data, on_close)
+    yield done
+    return received[0], time.perf_counter() - start
+
+
+@gen.coroutine
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=64, help="MB per run")
+    args = parser.parse_args()
+
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(
+        target=node_stub, args=(args.size * 1024 * 1024, ready), daemon=True
+    )
+    server.start()
+    ready.wait()
+    print("{:<10} {:>8} {:>10} {:>12}".format("mode", "MB", "MB/s", "peak KiB"))
+    for zero_copy in (False, True):
+        received, elapsed = yield run(zero_copy)
+        tracemalloc.start()
+        yield run(zero_copy)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(
+            "{:<10} {:>8.1f} {:>10.1f} {:>12.1f}".format(
+                "zero-copy" if zero_copy else "copy",
+                received / 1024 / 1024,
+                received / 1024 / 1024 / elapsed,
+                peak / 1024,
+            )
+        )
+    server.terminate()
+
+
+if __name__ == "__main__":
+    IOLoop.current().run_sync(main)
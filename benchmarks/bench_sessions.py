@@ -0,0 +1,136 @@
+"""Benchmark of the memory used by the node sessions.
+
+Compares the per-connection state kept in several dicts indexed by node
+(tcp clients, websockets lists, decoders, scrollbacks, user counters), as
+the application used to do, with the `SessionRegistry` of `__slots__`
+sessions, at 10k and 50k sessions with one websocket each. Reports the
+memory per connection while all sessions are connected, and what is left
+once they are all disconnected. Only the bookkeeping is measured: tcp
+clients and websockets are the same small objects in both layouts.
+
+Usage: PYTHONPATH=. python benchmarks/bench_sessions.py
+"""
+
+import argparse
+import gc
+import time
+import tracemalloc
+from collections import defaultdict
+
+from iotlabwebsocket.sessions import SessionRegistry
+
+SESSIONS = (10000, 50000)
+USERS = 100
+
+
+class Stub:
+    """Stands for a tcp client or a websocket."""
+
+    __slots__ = ("node", "user", "site")
+
+    def __init__(self, node, user):
+        self.node = node
+        self.user = user
+        self.site = "local"
+
+
+def stubs(count):
+    """Return the tcp clients and the websockets of count nodes."""
+    nodes = ["node-{}".format(index) for index in range(count)]
+    return [
+        (Stub(node, None), Stub(node, "user-{}".format(index % USERS)))
+        for index, node in enumerate(nodes)
+    ]
+
+
+class DictsLayout:
+    """Store connections like the application did before the registry."""
+
+    def __init__(self):
+        self.tcp_clients = {}
+        self.websockets = defaultdict(list)
+        self.user_connections = defaultdict(int)
+        self.decoders = {}
+        self.scrollbacks = {}
+
+    def connect(self, tcp_client, websocket):
+        node = websocket.node
+        # Limits were checked like in the registry
+        if len(self.websockets[node]) == 10:
+            return
+        if self.user_connections[websocket.user] == 10000:
+            return
+        self.user_connections[websocket.user] += 1
+        self.tcp_clients[node] = tcp_client
+        self.websockets[node].append(websocket)
+        self.decoders[node] = None
+        self.scrollbacks[node] = None
+
+    def disconnect(self, websocket):
+        node = websocket.node
+        self.websockets[node].remove(websocket)
+        if self.user_connections[websocket.user] > 0:
+            self.user_connections[websocket.user] -= 1
+        if not self.websockets[node]:
+            self.decoders.pop(node, None)
+            self.tcp_clients.pop(node, None)
+            self.scrollbacks.pop(node, None)
+
+
+class RegistryLayout:
+    """Store connections in a session registry."""
+
+    def __init__(self):
+        self.registry = SessionRegistry()
+
+    def connect(self, tcp_client, websocket):
+        self.registry.reserve(websocket, 10, 10000)
+        session = self.registry.open(websocket.node, tcp_client)
+        self.registry.attach(session, websocket)
+
+    def disconnect(self, websocket):
+        session = self.registry.detach(websocket)
+        if not session.websockets:
+            self.registry.close(session.node)
+
+
+def measure(layout_class, count):
+    """Return the bytes per connected session, left after disconnection,
+    and the time to connect and disconnect."""
+    connections = stubs(count)
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    layout = layout_class()
+    for tcp_client, websocket in connections:
+        layout.connect(tcp_client, websocket)
+    connected, _ = tracemalloc.get_traced_memory()
+    for _, websocket in connections:
+        layout.disconnect(websocket)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    left, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return connected / count, left / count, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.parse_args()
+    print(
+        "{:<10} {:<10} {:>16} {:>12} {:>10}".format(
+            "sessions", "layout", "connected B/conn", "left B/conn", "time ms"
+        )
+    )
+    for count in SESSIONS:
+        for name, layout_class in (("dicts", DictsLayout), ("registry", RegistryLayout)):
+            connected, left, elapsed = measure(layout_class, count)
+            print(
+                "{:<10} {:<10} {:>16.0f} {:>12.0f} {:>10.1f}".format(
+                    count, name, connected, left, elapsed * 1000
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@
 set -e
 
 : ${PORT:=8080}
+: ${WORKERS:=1}
 : ${API_PROTOCOL:=http}
 : ${API_HOST:=localhost}
 : ${API_PORT:=80}
@@ -11,7 +12,10 @@ set -e
 export API_USER=${API_USER}
 export API_PASSWORD=${API_PASSWORD}
 
-python3 /usr/local/bin/iotlab-websocket-service --port ${PORT} \
+# The service stays the main process of the container: SIGTERM drains the
+# websockets and SIGHUP reloads the workers without stopping the container
+exec python3 /usr/local/bin/iotlab-websocket-service --port ${PORT} \
+    --workers ${WORKERS} \
     --api-protocol ${API_PROTOCOL} \
     --api-host ${API_HOST} \
     --api-port ${API_PORT} \
@@ -2,6 +2,8 @@
 
 import json
 import os
+import time
+from collections import OrderedDict
 
 import tornado
 from tornado import gen
@@ -9,9 +11,64 @@ from tornado import gen
 from . import DEFAULT_API_HOST, DEFAULT_API_PORT
 from .logger import LOGGER
 
+API_CACHE_SIZE = 1024  # experiments
+API_CACHE_TTL = 30  # seconds
+API_TIMEOUT = 10  # seconds
+
+
+class ApiCache:
+    """Class that keeps the recent API responses of the experiments.
+
+    Responses are kept for `ttl` seconds at most, the least recently used
+    experiments are forgotten above `max_size` experiments. A `ttl` of 0
+    disables the cache.
+    """
+
+    def __init__(self, max_size=API_CACHE_SIZE, ttl=API_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, exp_id, resource):
+        """Return the response of the resource of an experiment, or None."""
+        entry = self.entries.get(exp_id)
+        if entry is not None and resource in entry:
+            value, expires = entry[resource]
+            if time.monotonic() < expires:
+                self.entries.move_to_end(exp_id)
+                self.hits += 1
+                return value
+            del entry[resource]
+        self.misses += 1
+        return None
+
+    def put(self, exp_id, resource, value):
+        """Keep the response of the resource of an experiment."""
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        entry = self.entries.setdefault(exp_id, {})
+        entry[resource] = (value, time.monotonic() + self.ttl)
+        self.entries.move_to_end(exp_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, exp_id):
+        """Forget the responses of an experiment."""
+        self.entries.pop(exp_id, None)
+
 
 class ApiClient:
-    """Class that store information about the REST API."""
+    """Class that store information about the REST API.
+
+    When `metrics` is set, the latency of the asynchronous requests is
+    observed in its `api_latency` histogram, and the lookups in the cache of
+    the responses in its `api_cache` counter.
+
+    Concurrent asynchronous fetches of the same resource of an experiment
+    share one request, which fails for all of them after `timeout` seconds.
+    """
 
     def __init__(
         self,
@@ -21,6 +78,9 @@ class ApiClient:
         username="",
         password="",
         proxy=None,
+        cache_size=API_CACHE_SIZE,
+        cache_ttl=API_CACHE_TTL,
+        timeout=API_TIMEOUT,
     ):
         # pylint:disable=too-many-arguments
         self.protocol = protocol
@@ -30,6 +90,11 @@ class ApiClient:
         self.password = password
         # Use provided proxy or try to get from environment
         self.proxy = proxy or os.environ.get('http_proxy') or os.environ.get('HTTP_PROXY')
+        self.metrics = None
+        self.cache = ApiCache(cache_size, cache_ttl)
+        self.timeout = timeout
+        # Requests in progress by experiment and resource
+        self.pending = {}
 
     def __eq__(self, other):
         return (
@@ -39,6 +104,9 @@ class ApiClient:
             and self.username == other.username
             and self.password == other.password
             and self.proxy == other.proxy
+            and self.cache.max_size == other.cache.max_size
+            and self.cache.ttl == other.cache.ttl
+            and self.timeout == other.timeout
         )
 
     @property
@@ -79,8 +147,7 @@ class ApiClient:
         client = tornado.httpclient.HTTPClient()
         return client.fetch(request).buffer.read()
 
-    @gen.coroutine
-    def _fetch_async(self, request):
+    async def _fetch_async(self, request):
         request.headers["Content-Type"] = "application/json"
         # Configure global AsyncHTTPClient with proxy if available
         if self.proxy:
@@ -103,12 +170,22 @@ class ApiClient:
             request.proxy_port = proxy_port
                 
         client = tornado.httpclient.AsyncHTTPClient()
-        response = yield client.fetch(request)
-        raise gen.Return(response.buffer.read())
+        start = time.monotonic()
+        outcome = "error"
+        try:
+            response = await client.fetch(request)
+            outcome = "ok"
+        finally:
+            if self.metrics is not None:
+                resource = "token" if request.url.endswith("/token") else "nodes"
+                self.metrics.api_latency.labels(resource, outcome).observe(
+                    time.monotonic() - start
+                )
+        return response.buffer.read()
 
     def _request(self, exp_id, resource):
         _url = "{}/{}/{}".format(self.url, exp_id, resource)
-        kwargs = {}
+        kwargs = {"connect_timeout": self.timeout, "request_timeout": self.timeout}
         if self.username and self.password:
             kwargs.update(
                 {"auth_username": self.username, "auth_password": self.password}
@@ -124,19 +201,55 @@ class ApiClient:
         response = self._fetch_sync(self._request(exp_id, ""))
         return ApiClient._parse_nodes_response(response.decode())
 
-    @gen.coroutine
-    def fetch_nodes_async(self, exp_id):
-        """Fetch the list of nodes using an asynchronous call."""
-        response = yield self._fetch_async(self._request(exp_id, ""))
-        raise gen.Return(ApiClient._parse_nodes_response(response.decode()))
+    async def _cached(self, exp_id, resource, parse):
+        key = (exp_id, resource)
+        value = self.cache.get(exp_id, resource)
+        if value is not None:
+            result = "hit"
+        elif key in self.pending:
+            result = "shared"
+        else:
+            result = "miss"
+            self.pending[key] = gen.convert_yielded(
+                self._fetch_parsed(exp_id, resource, parse)
+            )
+        if self.metrics is not None:
+            self.metrics.api_cache.labels(resource or "nodes", result).inc()
+        if value is None:
+            value = await self.pending[key]
+        return value
+
+    async def _fetch_parsed(self, exp_id, resource, parse):
+        try:
+            response = await self._fetch_async(self._request(exp_id, resource))
+            value = parse(response.decode())
+        finally:
+            # Failed requests are not shared with the next callers
+            del self.pending[(exp_id, resource)]
+        self.cache.put(exp_id, resource, value)
+        return value
+
+    def invalidate(self, exp_id):
+        """Forget the cached responses of an experiment, e.g. on auth failure."""
+        self.cache.invalidate(exp_id)
+
+    async def fetch_nodes_async(self, exp_id):
+        """Fetch the list of nodes using an asynchronous call.
+
+        The response is cached, see `ApiCache`.
+        """
+        return await self._cached(exp_id, "", ApiClient._parse_nodes_response)
 
     def fetch_token_sync(self, exp_id):
         """Fetch the experiment token using a synchronous call."""
         response = self._fetch_sync(self._request(exp_id, "token"))
         return json.loads(response.decode())["token"]
 
-    @gen.coroutine
-    def fetch_token_async(self, exp_id):
-        """Fetch the experiment token using an asynchronous call."""
-        response = yield self._fetch_async(self._request(exp_id, "token"))
-        raise gen.Return(json.loads(response.decode())["token"])
+    async def fetch_token_async(self, exp_id):
+        """Fetch the experiment token using an asynchronous call.
+
+        The response is cached, see `ApiCache`.
+        """
+        return await self._cached(
+            exp_id, "token", lambda response: json.loads(response)["token"]
+        )
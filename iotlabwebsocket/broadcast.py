@@ -0,0 +1,128 @@
+"""Websocket frames encoded once for all the websockets of a node."""
+
+import struct
+import zlib
+
+from tornado.escape import utf8
+from tornado.iostream import StreamClosedError
+from tornado.websocket import WebSocketClosedError, WebSocketProtocol13
+
+FIN = 0x80
+RSV1 = 0x40
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+COMPRESSION_LEVEL = 6
+COMPRESSION_MEM_LEVEL = 8
+COMPRESSION_MIN_SIZE = 256  # bytes
+
+
+def deflate(payload, level, mem_level, wbits):
+    """Return payload compressed without context, for permessage-deflate."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -wbits, mem_level)
+    data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    # Trailing empty block is removed, as required by RFC 7692
+    return data[:-4]
+
+
+def encode_frame(payload, opcode, flags=0):
+    """Return the unmasked, server to client, websocket frame of payload."""
+    size = len(payload)
+    if size < 126:
+        header = struct.pack("!BB", FIN | opcode | flags, size)
+    elif size <= 0xFFFF:
+        header = struct.pack("!BBH", FIN | opcode | flags, 126, size)
+    else:
+        header = struct.pack("!BBQ", FIN | opcode | flags, 127, size)
+    return header + payload
+
+
+class BroadcastMessage:
+    """Class that holds a node output message sent to several websockets.
+
+    The message is encoded to UTF-8 and framed at most once, the first time
+    it is written to a websocket, and the same frame is then written to the
+    stream of all the other websockets. For websockets compressing messages
+    without context takeover, the message is also compressed once. Messages
+    smaller than `min_compress_size` bytes are never compressed.
+    """
+
+    __slots__ = (
+        "message",
+        "binary",
+        "min_compress_size",
+        "_payload",
+        "_frame",
+        "_deflated",
+    )
+
+    def __init__(self, message, binary, min_compress_size=0):
+        self.message = message
+        self.binary = binary
+        self.min_compress_size = min_compress_size
+        self._payload = None
+        self._frame = None
+        self._deflated = {}
+
+    def __len__(self):
+        return len(self.message)
+
+    @property
+    def payload(self):
+        """Return the message as bytes."""
+        if self._payload is None:
+            self._payload = utf8(self.message)
+        return self._payload
+
+    @property
+    def opcode(self):
+        """Return the websocket opcode of the message."""
+        return OPCODE_BINARY if self.binary else OPCODE_TEXT
+
+    @property
+    def frame(self):
+        """Return the websocket frame of the message."""
+        if self._frame is None:
+            self._frame = encode_frame(self.payload, self.opcode)
+        return self._frame
+
+    def deflated_frame(self, level, mem_level, wbits):
+        """Return the compressed websocket frame of the message."""
+        key = (level, mem_level, wbits)
+        frame = self._deflated.get(key)
+        if frame is None:
+            payload = deflate(self.payload, level, mem_level, wbits)
+            frame = self._deflated[key] = encode_frame(payload, self.opcode, RSV1)
+        return frame
+
+    def write_to(self, websocket):
+        """Write the message to a websocket, return a future like write_message.
+
+        The shared frames are only used when the connection sends frames as
+        they are: masked connections and connections compressing with context
+        takeover encode their own frame.
+        """
+        protocol = websocket.ws_connection
+        if protocol is None or protocol.is_closing():
+            raise WebSocketClosedError()
+        # pylint:disable=protected-access
+        if not isinstance(protocol, WebSocketProtocol13) or protocol.mask_outgoing:
+            return websocket.write_message(self.payload, binary=self.binary)
+        compressor = protocol._compressor
+        if compressor is None or len(self.payload) < self.min_compress_size:
+            # Uncompressed messages are allowed with permessage-deflate
+            frame = self.frame
+        elif compressor._compressor is None:
+            frame = self.deflated_frame(
+                compressor._compression_level,
+                compressor._mem_level,
+                compressor._max_wbits,
+            )
+        else:
+            return websocket.write_message(self.payload, binary=self.binary)
+        try:
+            future = protocol.stream.write(frame)
+        except StreamClosedError as exc:
+            raise WebSocketClosedError() from exc
+        protocol._message_bytes_out += len(self.payload)
+        protocol._wire_bytes_out += len(frame)
+        return future
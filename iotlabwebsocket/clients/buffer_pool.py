@@ -0,0 +1,30 @@
+"""Pool of reusable read buffers for a connection."""
+
+MAX_POOLED_BUFFERS = 2
+
+
+class BufferPool:
+    """Class that keeps the most recently used read buffers of a connection.
+
+    Buffers are indexed by size, only the `max_buffers` most recently used
+    sizes are kept so a connection switching back and forth between two
+    chunk sizes doesn't reallocate its buffers.
+    """
+
+    def __init__(self, max_buffers=MAX_POOLED_BUFFERS):
+        self.max_buffers = max_buffers
+        self._buffers = {}
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def get(self, size):
+        """Return a writable memoryview of `size` bytes."""
+        buf = self._buffers.pop(size, None)
+        if buf is None:
+            buf = memoryview(bytearray(size))
+            if len(self._buffers) >= self.max_buffers:
+                # Drop the least recently used buffer
+                self._buffers.pop(next(iter(self._buffers)))
+        self._buffers[size] = buf
+        return buf
@@ -0,0 +1,133 @@
+"""Shared factory of the TCP connections to the nodes."""
+
+import time
+import socket
+
+from tornado import gen, tcpclient
+from tornado.concurrent import future_add_done_callback
+from tornado.netutil import Resolver
+
+from ..logger import LOGGER
+
+RESOLVER_TTL = 300  # seconds
+RESOLVER_NEGATIVE_TTL = 10  # seconds
+RESOLVER_MAX_ENTRIES = 10000
+
+
+class CachingResolver(Resolver):
+    """Resolver that caches the results of another resolver.
+
+    Successful resolutions are kept `ttl` seconds, failed ones `negative_ttl`
+    seconds. Concurrent resolutions of the same host share the same request.
+    """
+
+    # pylint:disable=attribute-defined-outside-init,arguments-differ
+    def initialize(
+        self,
+        resolver=None,
+        ttl=RESOLVER_TTL,
+        negative_ttl=RESOLVER_NEGATIVE_TTL,
+        max_entries=RESOLVER_MAX_ENTRIES,
+        clock=time.monotonic,
+    ):
+        """Initialize the wrapped resolver and the cache parameters."""
+        self.resolver = resolver or Resolver()
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._cache = {}
+
+    def close(self):
+        self.resolver.close()
+        self._cache.clear()
+
+    def resolve(self, host, port, family=socket.AF_UNSPEC):
+        key = (host, port, family)
+        now = self._clock()
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] > now:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        if len(self._cache) >= self.max_entries:
+            self._purge(now)
+        future = gen.convert_yielded(self.resolver.resolve(host, port, family))
+        # Pending resolution is shared until it completes
+        self._cache[key] = (float("inf"), future)
+        future_add_done_callback(future, lambda f: self._resolved(key, f))
+        return future
+
+    def _resolved(self, key, future):
+        entry = self._cache.get(key)
+        if entry is None or entry[1] is not future:
+            return
+        ttl = self.negative_ttl if future.exception() else self.ttl
+        self._cache[key] = (self._clock() + ttl, future)
+
+    def _purge(self, now):
+        expired = [key for key, (expires, _) in self._cache.items() if expires <= now]
+        for key in expired:
+            del self._cache[key]
+        if len(self._cache) >= self.max_entries:
+            # Still full, drop the oldest entries
+            for key in list(self._cache)[: len(self._cache) // 2]:
+                del self._cache[key]
+
+
+class NodeConnector:
+    """Class that opens the TCP connections to the nodes.
+
+    All connections share a caching resolver. Node addresses can also be
+    resolved in advance from the node list of an experiment, they are then
+    stored in a table indexed by site and node.
+    """
+
+    def __init__(self, resolver=None):
+        self.resolver = resolver or CachingResolver()
+        self.addresses = {}
+        self._client = tcpclient.TCPClient(resolver=self.resolver)
+
+    async def connect(self, node, port, site=None):
+        """Open a TCP connection to a node."""
+        address = self.addresses.get((site, node))
+        try:
+            stream = await self._client.connect(address or node, port)
+        except Exception:  # pylint:disable=broad-except
+            # Resolve the node name again on next connection
+            self.addresses.pop((site, node), None)
+            raise
+        return stream
+
+    async def load_nodes(self, nodes, port=0):
+        """Resolve the addresses of the nodes of an experiment.
+
+        Nodes are given by their host name: <node>.<site>[.<domain>]
+        """
+        missing = []
+        for hostname in nodes:
+            if hostname.count(".") < 1:
+                continue
+            node, site = hostname.split(".")[:2]
+            if (site, node) not in self.addresses:
+                missing.append((site, node, hostname))
+        results = await gen.multi(
+            [self._resolve(hostname, port) for _, _, hostname in missing]
+        )
+        for (site, node, _), address in zip(missing, results):
+            if address is not None:
+                self.addresses[(site, node)] = address
+        LOGGER.debug(
+            "Resolved {} node addresses out of {}".format(
+                len([address for address in results if address]), len(missing)
+            )
+        )
+
+    async def _resolve(self, hostname, port):
+        try:
+            addresses = await self.resolver.resolve(hostname, port)
+        except IOError:
+            return None
+        return addresses[0][1][0]
@@ -1,91 +1,324 @@
 """Management of the TCP connection to a node."""
 
 import time
+import random
 import socket
 
-from tornado import gen, tcpclient
+from tornado import gen
+from tornado.concurrent import Future, future_add_done_callback
+from tornado.ioloop import IOLoop
 from tornado.iostream import StreamClosedError
 
 from ..logger import LOGGER
+from .buffer_pool import BufferPool
+from .connector import NodeConnector
+from .token_bucket import TokenBucket
 
 NODE_TCP_PORT = 20000
 CHUNK_SIZE = 1024
-CHECK_BYTES_RECEIVED_PERIOD = 1  # seconds
-MAX_BYTES_RECEIVED_PER_PERIOD = 15000
+MAX_CHUNK_SIZE = 65536
+NODE_RATE = 15000  # bytes per second
+NODE_BURST = 65536  # bytes
+NODE_RECONNECT_WINDOW = 30  # seconds
+RECONNECT_MIN_DELAY = 0.5  # seconds
+RECONNECT_MAX_DELAY = 8  # seconds
+KEEPALIVE_IDLE = 10  # seconds
+KEEPALIVE_INTERVAL = 5  # seconds
+KEEPALIVE_COUNT = 3
+WRITE_HIGH_WATER = 65536  # bytes
+WRITE_LOW_WATER = 16384  # bytes
 
 
 class TCPClient:
-    """Class that manages the TCP client connection to a node."""
+    """Class that manages the TCP client connection to a node.
 
-    def __init__(self):
+    The node output is limited to `rate` bytes per second with bursts of up
+    to `burst` bytes: above that, reading from the node is paused so the
+    kernel socket buffer and TCP windowing slow it down. If `disconnect_after`
+    is set, a node throttled for more than this number of seconds in a row is
+    disconnected.
+
+    In `zero_copy` mode, the node output is read in reusable buffers and
+    `on_data` receives a memoryview that is only valid during the call.
+
+    When the connection to the node is lost, it is reopened with exponential
+    backoff for up to `reconnect_window` seconds before `on_close` is called.
+    Progress is reported with `on_status`.
+
+    Data sent to the node is queued until the node reads it. Once more than
+    `write_high_water` bytes are queued, the client is not `writable` until
+    the queue goes below `write_low_water` bytes, see `drained`.
+
+    Connections are opened with `connector`, usually shared by all clients.
+
+    When `sample_interval` is set, one read every `sample_interval` reads is
+    timestamped in `read_time`, which is None for the other reads.
+    """
+
+    def __init__(
+        self,
+        rate=NODE_RATE,
+        burst=NODE_BURST,
+        disconnect_after=None,
+        zero_copy=False,
+        reconnect_window=NODE_RECONNECT_WINDOW,
+        write_high_water=WRITE_HIGH_WATER,
+        write_low_water=WRITE_LOW_WATER,
+        connector=None,
+        sample_interval=0,
+    ):
         self.ready = False
         self.node = None
+        self.site = None
+        self.connector = connector or NodeConnector()
         self._tcp = None
+        self._stopped = False
         self.on_close = None
         self.on_data = None
+        self.on_status = None
+        self.reconnect_window = reconnect_window
+        self.disconnect_after = disconnect_after
+        self._bucket = TokenBucket(rate, burst) if rate else None
+        self._throttled_since = None
+        self.throttled_time = 0
+        self.throttles = 0
+        self.deferred_bytes = 0
+        self.zero_copy = zero_copy
+        self._buffers = BufferPool() if zero_copy else None
+        self.write_high_water = write_high_water
+        self.write_low_water = write_low_water
+        self.queued_bytes = 0
+        self._drain_waiters = []
+        self._resume = None
+        self.sample_interval = sample_interval
+        self.read_time = None
+        self._until_sample = sample_interval
+
+    @property
+    def stats(self):
+        """Return the flow control counters of the node."""
+        return {
+            "throttled_time": self.throttled_time,
+            "throttles": self.throttles,
+            "deferred_bytes": self.deferred_bytes,
+            "queued_bytes": self.queued_bytes,
+        }
+
+    @property
+    def writable(self):
+        """Return False if too many bytes are waiting to be sent to the node."""
+        return self.queued_bytes < self.write_high_water
 
     def send(self, data):
         """Send data via the TCP connection."""
         if not self.ready:
             return
-        self._tcp.write(data)
+        self.queued_bytes += len(data)
+        future_add_done_callback(
+            self._tcp.write(data), lambda future: self._on_sent(future, len(data))
+        )
+
+    def drained(self):
+        """Return a future resolved when queued bytes are below low water."""
+        future = Future()
+        if self.queued_bytes <= self.write_low_water:
+            future.set_result(None)
+        else:
+            self._drain_waiters.append(future)
+        return future
+
+    def _on_sent(self, future, size):
+        # Failed writes are handled when the connection is closed
+        future.exception()
+        self.queued_bytes -= size
+        if self.queued_bytes <= self.write_low_water:
+            waiters, self._drain_waiters = self._drain_waiters, []
+            for waiter in waiters:
+                waiter.set_result(None)
+
+    def pause(self, resume):
+        """Stop reading from the node until the `resume` future is done."""
+        self._resume = resume
 
     def stop(self):
         """Stop the TCP connection and close any opened websocket."""
+        self._stopped = True
         if self.ready:
+            self.ready = False
             self._tcp.close()
 
-    @gen.coroutine
-    def start(self, node, on_data, on_close):
-        """Start the TCP connection and wait for incoming bytes."""
+    def start(self, node, on_data, on_close, on_status=None, site=None):
+        """Start the TCP connection and wait for incoming bytes.
+
+        Return a future resolved once connected, or once the connection failed.
+        """
         self.ready = False
+        self._stopped = False
         self.node = node
+        self.site = site
         self.on_close = on_close
         self.on_data = on_data
+        self.on_status = on_status
+        return gen.convert_yielded(self._start())
+
+    async def _start(self):
+        connected = await self._connect()
+        if not connected:
+            if not self._stopped:
+                # We can't connect to the node with TCP, closing all websockets
+                self.on_close(
+                    self.node, reason="Cannot connect to node {}".format(self.node)
+                )
+            return
+        IOLoop.current().spawn_callback(self._read_stream)
+
+    async def _connect(self):
         try:
-            LOGGER.debug("Opening TCP connection to '{}:{}'".format(node, NODE_TCP_PORT))
-            self._tcp = yield tcpclient.TCPClient().connect(node, NODE_TCP_PORT)
-            LOGGER.debug("TCP connection opened on '{}:{}'".format(node, NODE_TCP_PORT))
+            LOGGER.debug(
+                "Opening TCP connection to '{}:{}'".format(self.node, NODE_TCP_PORT)
+            )
+            self._tcp = await self.connector.connect(
+                self.node, NODE_TCP_PORT, site=self.site
+            )
+            LOGGER.debug(
+                "TCP connection opened on '{}:{}'".format(self.node, NODE_TCP_PORT)
+            )
         except (StreamClosedError, socket.gaierror):
-            LOGGER.warning("Cannot open TCP connection to {}:{}".format(node, NODE_TCP_PORT))
-            # We can't connect to the node with TCP, closing all websockets
-            self.on_close(self.node, reason="Cannot connect to node {}".format(self.node))
-            return
+            LOGGER.warning(
+                "Cannot open TCP connection to {}:{}".format(self.node, NODE_TCP_PORT)
+            )
+            return False
+        if self._stopped:
+            # Stopped while connecting
+            self._tcp.close()
+            return False
+        self._set_keepalive()
         LOGGER.debug("TCP connection is ready")
         self.ready = True
-        self._read_stream()
+        if self._bucket is not None:
+            self._bucket.reset()
+        self._throttled_since = None
+        return True
+
+    def _set_keepalive(self):
+        """Detect dead nodes within a few seconds."""
+        sock = self._tcp.socket
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (
+            ("TCP_KEEPIDLE", KEEPALIVE_IDLE),
+            ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+            ("TCP_KEEPCNT", KEEPALIVE_COUNT),
+        ):
+            # Not available on all platforms
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+    def _notify(self, message):
+        if self.on_status is not None:
+            self.on_status(self.node, message)
+
+    async def _reconnect(self):
+        deadline = time.monotonic() + self.reconnect_window
+        delay = RECONNECT_MIN_DELAY
+        self._notify("Connection to node {} lost, reconnecting".format(self.node))
+        while not self._stopped:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # Jitter avoids reconnecting all nodes of a site at once
+            await gen.sleep(min(delay * random.uniform(0.5, 1), remaining))
+            if self._stopped:
+                return
+            connected = await self._connect()
+            if connected:
+                LOGGER.info("TCP connection to '{}' is restored.".format(self.node))
+                self._notify("Connection to node {} restored".format(self.node))
+                IOLoop.current().spawn_callback(self._read_stream)
+                return
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+        if not self._stopped:
+            self.on_close(self.node, "Connection to {} is closed".format(self.node))
+
+    def _throttle(self, size):
+        """Return the delay before delivering `size` bytes, None if too fast."""
+        if self._bucket is None:
+            return 0
+        delay = self._bucket.consume(size)
+        if not delay:
+            self._throttled_since = None
+            return 0
+        now = time.monotonic()
+        if self._throttled_since is None:
+            LOGGER.debug("Node {} is sending too fast, throttling".format(self.node))
+            self._throttled_since = now
+            self.throttles += 1
+        elif (
+            self.disconnect_after is not None
+            and now - self._throttled_since > self.disconnect_after
+        ):
+            self._throttled_since = None
+            return None
+        self.throttled_time += delay
+        self.deferred_bytes += size
+        return delay
+
+    def _sample_read(self):
+        """Timestamp one read every `sample_interval` reads."""
+        self._until_sample -= 1
+        if self._until_sample > 0:
+            self.read_time = None
+            return
+        self._until_sample = self.sample_interval
+        self.read_time = time.monotonic()
 
-    @gen.coroutine
-    def _read_stream(self):
+    @staticmethod
+    def _next_chunk_size(chunk_size, received):
+        """Adapt the read size to the rate of the node."""
+        if received == chunk_size:
+            return min(chunk_size * 2, MAX_CHUNK_SIZE)
+        if received < chunk_size // 4:
+            return max(chunk_size // 2, CHUNK_SIZE)
+        return chunk_size
+
+    async def _read_stream(self):
         LOGGER.debug(
             "Listening to TCP connection for node {}:{}".format(self.node, NODE_TCP_PORT)
         )
-        received_bytes = 0
-        start = time.time()
+        chunk_size = CHUNK_SIZE
         try:
             while True:
-                data = yield self._tcp.read_bytes(CHUNK_SIZE, partial=True)
-                received_bytes += len(data)
-
-                # Reset stream_byte every CHECK_BYTES_RECEIVED_PERIOD seconds
-                if time.time() - start > CHECK_BYTES_RECEIVED_PERIOD:
-                    if received_bytes > MAX_BYTES_RECEIVED_PER_PERIOD:
-                        LOGGER.warning(
-                            "Node {} is sending too fast, "
-                            "received {} bytes in "
-                            "{} seconds, closing.".format(self.node, received_bytes, CHECK_BYTES_RECEIVED_PERIOD)
-                        )
-                        # Will close all websocket connections
-                        # and as a consequence, close the TCP connection
-                        self.on_close(
-                            self.node,
-                            reason=("Node {} is sending too fast".format(self.node)),
-                        )
-                    received_bytes = 0
-                    start = time.time()
-
+                if self.zero_copy:
+                    buf = self._buffers.get(chunk_size)
+                    received = await self._tcp.read_into(buf, partial=True)
+                    data = buf[:received]
+                else:
+                    data = await self._tcp.read_bytes(chunk_size, partial=True)
+                if self.sample_interval:
+                    self._sample_read()
+                chunk_size = self._next_chunk_size(chunk_size, len(data))
+                delay = self._throttle(len(data))
+                if delay is None:
+                    LOGGER.warning(
+                        "Node {} is sending too fast for more than "
+                        "{} seconds, closing.".format(self.node, self.disconnect_after)
+                    )
+                    # Will close all websocket connections
+                    # and as a consequence, close the TCP connection
+                    self.on_close(
+                        self.node,
+                        reason=("Node {} is sending too fast".format(self.node)),
+                    )
+                elif delay:
+                    # Stop reading from the node until it is back under its rate
+                    await gen.sleep(delay)
                 self.on_data(self.node, data)
+                if self._resume is not None:
+                    resume, self._resume = self._resume, None
+                    await resume
         except StreamClosedError:
             self.ready = False
-            self.on_close(self.node, "Connection to {} is closed".format(self.node))
             LOGGER.info("TCP connection to '{}' is closed.".format(self.node))
+            if self._stopped or not self.reconnect_window:
+                self.on_close(self.node, "Connection to {} is closed".format(self.node))
+                return
+            IOLoop.current().spawn_callback(self._reconnect)
@@ -0,0 +1,33 @@
+"""Token bucket used to limit the throughput of a node."""
+
+import time
+
+
+class TokenBucket:
+    """Token bucket refilled at `rate` tokens per second, up to `burst`.
+
+    Consuming more tokens than available puts the bucket in debt: the delay
+    returned by `consume` is the time needed to pay it back at `rate`.
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self.tokens = burst
+        self._last = clock()
+
+    def reset(self):
+        """Fill the bucket to its burst size."""
+        self.tokens = self.burst
+        self._last = self._clock()
+
+    def consume(self, amount):
+        """Consume tokens and return the delay (in s) to wait before reuse."""
+        now = self._clock()
+        self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
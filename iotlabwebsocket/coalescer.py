@@ -0,0 +1,244 @@
+"""Adaptive coalescing of the messages sent to a websocket."""
+
+from collections import deque
+
+from tornado.concurrent import Future, future_add_done_callback
+from tornado.ioloop import IOLoop
+from tornado.websocket import WebSocketClosedError
+
+from .broadcast import BroadcastMessage
+from .logger import LOGGER
+
+MAX_FRAME_SIZE = 65536  # bytes
+MAX_FRAME_DELAY = 0.05  # seconds
+MAX_BUFFERED_BYTES = 4 * 1024 * 1024  # bytes
+OVERFLOW_POLICIES = ("drop", "close")
+
+
+class FrameCoalescer:
+    """Class that merges messages written to a busy websocket.
+
+    When nothing is being written to the websocket, a message is sent
+    immediately. Otherwise, it is queued and all queued messages are sent in
+    a single frame when the previous write completes, when `max_size` bytes
+    are queued or after `max_delay` seconds, whichever comes first.
+
+    Messages can be `BroadcastMessage` instances: their shared frame is sent
+    when they are not merged with other messages.
+
+    Messages queued or not yet written to the socket are limited to
+    `max_buffered` bytes (0 for no limit). Once the websocket is full, the
+    oldest queued messages are dropped, and replaced by a "N bytes dropped"
+    message, or the websocket is closed, depending on `overflow`.
+    """
+
+    # pylint:disable=too-many-instance-attributes
+    def __init__(
+        self,
+        websocket,
+        max_size=MAX_FRAME_SIZE,
+        max_delay=MAX_FRAME_DELAY,
+        max_buffered=0,
+        overflow="drop",
+    ):
+        # pylint:disable=too-many-arguments
+        self.websocket = websocket
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.max_buffered = max_buffered
+        self.overflow = overflow
+        self.frames = 0
+        self.dropped_bytes = 0
+        self.peak_buffered_bytes = 0
+        self._pending = deque()
+        self._pending_size = 0
+        self._written_size = 0
+        self._dropped = 0
+        self._writing = None
+        self._timeout = None
+        self._drain_waiters = []
+        self._written_callbacks = []
+        # Incremented on close, writes of a previous generation are ignored
+        self._generation = 0
+
+    @property
+    def busy(self):
+        """Return True if a previous frame is still being written."""
+        return self._writing is not None
+
+    @property
+    def buffered_bytes(self):
+        """Return the size of the messages queued or being written."""
+        return self._pending_size + self._written_size
+
+    @property
+    def full(self):
+        """Return True if no more messages should be sent to the websocket."""
+        return bool(self.max_buffered) and self.buffered_bytes >= self.max_buffered
+
+    @property
+    def stats(self):
+        """Return the output buffer counters of the websocket."""
+        return {
+            "buffered_bytes": self.buffered_bytes,
+            "peak_buffered_bytes": self.peak_buffered_bytes,
+            "dropped_bytes": self.dropped_bytes,
+        }
+
+    def drained(self):
+        """Return a future resolved when the websocket is no longer full."""
+        future = Future()
+        if not self.full:
+            future.set_result(None)
+        else:
+            self._drain_waiters.append(future)
+        return future
+
+    def on_written(self, callback):
+        """Call `callback` once the messages written so far are sent.
+
+        Messages are sent when they are written to the socket. Callbacks
+        are forgotten if the websocket is closed before.
+        """
+        if self._pending or self._dropped:
+            # Called with the next frame
+            self._written_callbacks.append(callback)
+        elif self._writing is not None:
+            self._call_when_written(self._writing, [callback])
+        else:
+            callback()
+
+    def _call_when_written(self, writing, callbacks):
+        generation = self._generation
+
+        def _written(_):
+            if generation != self._generation:
+                return
+            for callback in callbacks:
+                callback()
+
+        future_add_done_callback(writing, _written)
+
+    def write(self, message):
+        """Send the message now or queue it if the websocket is busy."""
+        if self.full:
+            self._overflow(message)
+            return
+        if not self.busy and not self._pending:
+            self._send(message)
+            return
+        self._queue(message)
+        self.peak_buffered_bytes = max(self.peak_buffered_bytes, self.buffered_bytes)
+        if self._pending_size >= self.max_size:
+            self.flush()
+        elif self._timeout is None:
+            self._timeout = IOLoop.current().call_later(self.max_delay, self.flush)
+
+    def _queue(self, message):
+        if isinstance(message, BroadcastMessage):
+            message = message.message
+        self._pending.append(message)
+        self._pending_size += len(message)
+
+    def _overflow(self, message):
+        if self.overflow == "close":
+            LOGGER.warning(
+                "Websocket for node '{}' is too slow, closing".format(
+                    self.websocket.node
+                )
+            )
+            buffered = self.buffered_bytes
+            self.close()
+            self.websocket.close(
+                code=1008,
+                reason="Websocket is too slow, {} bytes of output "
+                "buffered".format(buffered),
+            )
+            return
+        self._queue(message)
+        # Only queued messages can be dropped, not the ones being written
+        while self._pending and self.buffered_bytes > self.max_buffered:
+            dropped = self._pending.popleft()
+            self._pending_size -= len(dropped)
+            self._dropped += len(dropped)
+            self.dropped_bytes += len(dropped)
+        if not self.busy:
+            self.flush()
+
+    def flush(self):
+        """Send all queued messages in one frame."""
+        if self._timeout is not None:
+            IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+        if self._dropped:
+            marker = "{} bytes dropped.\n".format(self._dropped)
+            self._dropped = 0
+            if not self._send(marker, binary=False):
+                return
+        callbacks, self._written_callbacks = self._written_callbacks, []
+        if self._pending:
+            if self.websocket.text:
+                message = "".join(self._pending)
+            else:
+                message = b"".join(self._pending)
+            self._pending = deque()
+            self._pending_size = 0
+            if not self._send(message):
+                return
+        if callbacks:
+            self._call_when_written(self._writing, callbacks)
+
+    def close(self):
+        """Drop queued messages and cancel any pending flush."""
+        if self._timeout is not None:
+            IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+        self._pending = deque()
+        self._pending_size = 0
+        self._written_size = 0
+        self._writing = None
+        self._written_callbacks = []
+        self._generation += 1
+        self._wake_drain_waiters()
+
+    def _send(self, message, binary=None):
+        if binary is None:
+            binary = not self.websocket.text
+        try:
+            if isinstance(message, BroadcastMessage):
+                writing = message.write_to(self.websocket)
+            else:
+                writing = self.websocket.write_message(message, binary=binary)
+        except WebSocketClosedError:
+            self.close()
+            return False
+        size = len(message)
+        generation = self._generation
+        self.frames += 1
+        self._written_size += size
+        self.peak_buffered_bytes = max(self.peak_buffered_bytes, self.buffered_bytes)
+        self._writing = writing
+        future_add_done_callback(
+            writing, lambda writing: self._on_written(writing, size, generation)
+        )
+        return True
+
+    def _on_written(self, writing, size, generation):
+        if not writing.cancelled():
+            # Errors are handled when the websocket is closed
+            writing.exception()
+        if generation != self._generation:
+            return
+        self._written_size -= size
+        # Writes complete in order, only the last one matters
+        if writing is self._writing:
+            self._writing = None
+            if self._pending or self._dropped:
+                self.flush()
+        if not self.full:
+            self._wake_drain_waiters()
+
+    def _wake_drain_waiters(self):
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for waiter in waiters:
+            waiter.set_result(None)
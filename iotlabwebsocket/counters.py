@@ -0,0 +1,99 @@
+"""Connection counters of the users."""
+
+import hashlib
+import multiprocessing
+from collections import defaultdict
+
+COUNTER_SLOTS = 65536
+
+
+class UserCounters:
+    """Class that counts the websockets of each user in this process."""
+
+    def __init__(self):
+        self._counts = defaultdict(int)
+
+    def __getitem__(self, user):
+        return self._counts.get(user, 0)
+
+    def acquire(self, user, limit):
+        """Count a new websocket for user, return False above limit."""
+        if self._counts[user] >= limit:
+            return False
+        self._counts[user] += 1
+        return True
+
+    def release(self, user):
+        """Forget a websocket of user."""
+        count = self._counts.get(user, 0) - 1
+        if count > 0:
+            self._counts[user] = count
+        else:
+            self._counts.pop(user, None)
+
+
+class SharedUserCounters:
+    """Class that counts the websockets of each user across processes.
+
+    Counters are stored in an open addressing table, indexed by a hash of
+    the user name, in shared memory. It must be created before the worker
+    processes are forked. Slots are never emptied, the slot of a user
+    without websocket can be reused by another user.
+    """
+
+    def __init__(self, slots=COUNTER_SLOTS):
+        self.slots = slots
+        self._keys = multiprocessing.RawArray("Q", slots)
+        self._counts = multiprocessing.RawArray("l", slots)
+        self._lock = multiprocessing.Lock()
+
+    @staticmethod
+    def _key(user):
+        digest = hashlib.blake2b(user.encode("utf-8"), digest_size=8).digest()
+        # 0 marks empty slots
+        return int.from_bytes(digest, "little") or 1
+
+    def _find(self, key, insert=False):
+        """Return the slot of key, or a free one if insert, None otherwise."""
+        free = None
+        index = key % self.slots
+        for _ in range(self.slots):
+            slot_key = self._keys[index]
+            if slot_key == key:
+                return index
+            if slot_key == 0:
+                if not insert:
+                    return None
+                return index if free is None else free
+            if free is None and self._counts[index] == 0:
+                free = index
+            index = (index + 1) % self.slots
+        return free if insert else None
+
+    def __getitem__(self, user):
+        with self._lock:
+            index = self._find(self._key(user))
+            return 0 if index is None else self._counts[index]
+
+    def acquire(self, user, limit):
+        """Count a new websocket for user, return False above limit."""
+        key = self._key(user)
+        with self._lock:
+            index = self._find(key, insert=True)
+            if index is None:
+                # Table is full of connected users, don't limit
+                return True
+            if self._keys[index] != key:
+                self._keys[index] = key
+                self._counts[index] = 0
+            if self._counts[index] >= limit:
+                return False
+            self._counts[index] += 1
+            return True
+
+    def release(self, user):
+        """Forget a websocket of user."""
+        with self._lock:
+            index = self._find(self._key(user))
+            if index is not None and self._counts[index] > 0:
+                self._counts[index] -= 1
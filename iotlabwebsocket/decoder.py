@@ -0,0 +1,39 @@
+"""Incremental decoding of the output of a node."""
+
+import codecs
+
+MAX_LINE_LENGTH = 4096  # characters
+
+
+class NodeDecoder:
+    """Class that decodes the UTF-8 output of a node, chunk after chunk.
+
+    A multi-byte character split between two chunks is decoded with the
+    second chunk. Complete lines can also be extracted from the decoded text,
+    the partial line kept between chunks is limited to `max_line_length`
+    characters.
+    """
+
+    def __init__(self, max_line_length=MAX_LINE_LENGTH):
+        self.max_line_length = max_line_length
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._partial = ""
+
+    def decode(self, data):
+        """Return the text decoded from data, None if data is not UTF-8."""
+        try:
+            return self._decoder.decode(data)
+        except UnicodeDecodeError:
+            self._decoder.reset()
+            return None
+
+    def lines(self, text):
+        """Return the lines completed by text, without line terminators."""
+        lines = (self._partial + text).split("\n")
+        self._partial = lines.pop()
+        lines = [line[:-1] if line.endswith("\r") else line for line in lines]
+        while len(self._partial) > self.max_line_length:
+            # Too long lines are split
+            lines.append(self._partial[: self.max_line_length])
+            self._partial = self._partial[self.max_line_length :]
+        return lines
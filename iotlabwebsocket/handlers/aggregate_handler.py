@@ -0,0 +1,120 @@
+"""iotlabwebserial experiment-wide aggregated output handler."""
+
+import time
+
+from ..broadcast import BroadcastMessage
+from ..logger import LOGGER
+from .mux_handler import MuxHandler
+from .websocket_handler import node_output
+
+
+def _tagged(node, line):
+    return "{:.6f};{};{}\n".format(time.time(), node, line)
+
+
+class AggregateChannel:
+    """Class that merges the output lines of a node in an aggregated websocket.
+
+    Lines are tagged with their receive time and the node name, like the
+    testbed serial aggregator does: `<timestamp>;<node>;<line>`. Channels
+    share the frame coalescer of their websocket, so the lines of all the
+    nodes are batched in the same frames.
+    """
+
+    multiplexed = True
+    read_only = True
+    text = True
+    lines = True
+    endpoint = "aggregate"
+
+    def __init__(self, handler, node):
+        self.handler = handler
+        self.node = node
+        self.site = handler.site
+        self.experiment_id = handler.experiment_id
+        self.user = handler.user
+        self.closed = False
+        self.output = handler.output
+
+    def send_node_output(self, message):
+        """Send a line of node output, merged with the lines of all nodes."""
+        if isinstance(message, BroadcastMessage):
+            message = message.message
+        self.output.write(_tagged(self.node, message))
+
+    def write_message(self, message, binary=False):
+        """Send a status message of the node, tagged like its output."""
+        # pylint:disable=unused-argument
+        self.output.write(_tagged(self.node, message.rstrip("\n")))
+
+    def close(self, code=None, reason=None):
+        """Stop merging the output of the node and tell the client why."""
+        # pylint:disable=unused-argument
+        if self.closed:
+            return
+        self.closed = True
+        self.handler.channels.pop(self.node, None)
+        if reason:
+            self.output.write(_tagged(self.node, reason))
+        self.handler.application.handle_websocket_close(self)
+
+
+class AggregateHandler(MuxHandler):
+    # pylint:disable=abstract-method,arguments-differ
+    # pylint:disable=attribute-defined-outside-init
+    """Class that streams the output lines of all the nodes of an experiment.
+
+    Nodes are the nodes of the experiment on the site, their output is split
+    in lines and tagged by `AggregateChannel`. The websocket is read-only: it
+    counts once for its user and its nodes can still be opened by as many
+    node websockets. With several workers, it's served by the worker of its
+    experiment, which holds the sessions of all its nodes.
+    """
+
+    endpoint = "aggregate"
+
+    def initialize(self, api):
+        """Initialize the api and the channels."""
+        super(AggregateHandler, self).initialize(api)
+        self.text = True
+
+    @property
+    def frames(self):
+        """Return the number of frames sent on the websocket."""
+        return self.output.frames
+
+    @property
+    def buffered_bytes(self):
+        """Return the size of the output waiting to be written."""
+        return self.output.buffered_bytes
+
+    def open(self):
+        """Merge the output of all the nodes, unless over the user limit."""
+        self.set_nodelay(True)
+        LOGGER.debug(
+            "Aggregated websocket opened for experiment '{}'".format(
+                self.experiment_id
+            )
+        )
+        self.output = node_output(self, self.application.settings)
+        if not self.application.handle_mux_open(self):
+            return
+        for node in sorted(self.nodes):
+            channel = self.channels[node] = AggregateChannel(self, node)
+            self.application.handle_websocket_open(channel)
+
+    def on_message(self, message):
+        """Aggregated websockets are read-only."""
+
+    def on_close(self):
+        """Stop merging the output of the nodes."""
+        LOGGER.info(
+            "Aggregated websocket closed for experiment '{}', "
+            "code: {}, reason: '{}'".format(
+                self.experiment_id, self.close_code, self.close_reason
+            )
+        )
+        self.output.close()
+        for channel in list(self.channels.values()):
+            channel.close()
+        self.application.handle_mux_close(self)
@@ -0,0 +1,58 @@
+"""iotlabwebserial node output latency request handler."""
+
+import json
+
+from tornado import web
+
+from .metrics_handler import check_worker
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def _summary(histogram):
+    count = histogram.count
+    summary = {
+        "count": count,
+        "mean": histogram.sum / count if count else None,
+    }
+    for fraction in QUANTILES:
+        summary["p{}".format(round(fraction * 100))] = histogram.quantile(fraction)
+    return summary
+
+
+class LatencyHandler(web.RequestHandler):
+    # pylint:disable=abstract-method,arguments-differ
+    # pylint:disable=attribute-defined-outside-init
+    """Class that returns the latency of the sampled node output.
+
+    Latencies, in seconds, are summarized by node class for the fan-out to
+    the websockets and by node class and endpoint type for the write to the
+    websockets.
+    """
+
+    def initialize(self, metrics, sample_rate):
+        """Initialize the latency histograms and the sampling rate."""
+        self.metrics = metrics
+        self.sample_rate = sample_rate
+
+    def get(self, worker=None):
+        """Return the latency summaries as JSON."""
+        check_worker(self.metrics, worker)
+        fanout = {
+            key[0]: _summary(histogram)
+            for key, histogram in self.metrics.fanout_latency.children.items()
+        }
+        output = {}
+        for key, histogram in self.metrics.output_latency.children.items():
+            output.setdefault(key[0], {})[key[1]] = _summary(histogram)
+        self.set_header("Content-Type", "application/json")
+        self.finish(
+            json.dumps(
+                {
+                    "worker": self.metrics.worker,
+                    "sample_rate": self.sample_rate,
+                    "fanout": fanout,
+                    "output": output,
+                }
+            )
+        )
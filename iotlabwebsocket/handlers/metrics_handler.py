@@ -0,0 +1,31 @@
+"""iotlabwebserial metrics request handler."""
+
+from tornado import web
+
+from ..metrics import CONTENT_TYPE
+
+
+def check_worker(metrics, worker):
+    """Raise a 404 error if worker is not the worker of the metrics.
+
+    With several workers, the metrics of worker N are served on the
+    `/<path>/N` paths, `/<path>` serves the metrics of the first one.
+    """
+    if worker is not None and int(worker) != (metrics.worker or 0):
+        raise web.HTTPError(404)
+
+
+class MetricsHandler(web.RequestHandler):
+    # pylint:disable=abstract-method,arguments-differ
+    # pylint:disable=attribute-defined-outside-init
+    """Class that exports the application metrics to Prometheus."""
+
+    def initialize(self, metrics):
+        """Initialize the exported metrics."""
+        self.metrics = metrics
+
+    def get(self, worker=None):
+        """Return the metrics in the Prometheus text format."""
+        check_worker(self.metrics, worker)
+        self.set_header("Content-Type", CONTENT_TYPE)
+        self.finish(self.metrics.render())
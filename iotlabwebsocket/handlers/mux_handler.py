@@ -0,0 +1,214 @@
+"""iotlabwebserial multiplexed websocket connections handler."""
+
+import fnmatch
+import json
+
+from tornado.websocket import WebSocketClosedError
+
+from .. import mux
+from ..broadcast import BroadcastMessage
+from ..logger import LOGGER
+from .websocket_handler import WebsocketClientHandler, node_output
+
+
+class MuxChannel:
+    """Class that carries the websocket of a node on a multiplexed websocket.
+
+    Channels are attached to the node sessions like raw websockets: node
+    output is framed with the channel before it is written to the multiplexed
+    websocket, and closing a channel leaves this websocket open.
+    """
+
+    multiplexed = True
+    read_only = False
+    text = False
+    lines = False
+    endpoint = "mux"
+
+    def __init__(self, handler, channel, node):
+        self.handler = handler
+        self.channel = channel
+        self.node = node
+        self.site = handler.site
+        self.experiment_id = handler.experiment_id
+        self.user = handler.user
+        self.closed = False
+        self.output = node_output(self, handler.application.settings)
+
+    def send_node_output(self, message):
+        """Send node output, merged with pending output if any."""
+        if isinstance(message, BroadcastMessage):
+            # Shared frames can't be used, the payload is framed per channel
+            message = message.payload
+        self.output.write(message)
+
+    def write_message(self, message, binary=False):
+        """Send node output on the channel, or a status if it's not binary."""
+        if isinstance(message, str):
+            message = message.encode("utf-8")
+        kind = mux.OUTPUT if binary else mux.STATUS
+        return self.handler.write_message(
+            mux.encode(self.channel, kind, message), binary=True
+        )
+
+    def close(self, code=None, reason=None):
+        """Close the channel and tell the client why."""
+        # pylint:disable=unused-argument
+        if self.closed:
+            return
+        self.closed = True
+        self.handler.channels.pop(self.channel, None)
+        self.handler.closed_frames += self.output.frames
+        self.output.close()
+        self.handler.write_frame(self.channel, mux.CLOSED, reason or "")
+        self.handler.application.handle_websocket_close(self)
+
+
+class MuxHandler(WebsocketClientHandler):
+    # pylint:disable=abstract-method,arguments-differ
+    # pylint:disable=attribute-defined-outside-init
+    """Class that carries the websockets of several nodes on one websocket.
+
+    The token and the nodes of the experiment are checked once, on
+    connection. The client then subscribes to nodes of the experiment on the
+    site, writes to them and unsubscribes, see `mux` for the framing. It can
+    also write to a group of nodes at once, subscribed or not.
+
+    Each subscription counts as a websocket of its node, the multiplexed
+    websocket counts once for its user.
+    """
+
+    endpoint = "mux"
+
+    def initialize(self, api):
+        """Initialize the api and the channels."""
+        super(MuxHandler, self).initialize(api, text=False)
+        self.channels = {}
+        self.nodes = set()
+        self.closed_frames = 0
+
+    @property
+    def frames(self):
+        """Return the number of frames sent on the websocket."""
+        return self.closed_frames + sum(
+            channel.output.frames for channel in self.channels.values()
+        )
+
+    @property
+    def buffered_bytes(self):
+        """Return the size of the output waiting to be written."""
+        return sum(channel.output.buffered_bytes for channel in self.channels.values())
+
+    def _check_path(self):
+        # Path is /ws/<site>/<experiment_id>/<endpoint>
+        self.site, self.experiment_id = self.request.path.split("/")[-3:-1]
+        self.node = None
+        return True
+
+    async def _check_node(self):
+        nodes = await self.api.fetch_nodes_async(self.experiment_id)
+        self.application.handle_experiment_nodes(nodes)
+        for node in nodes:
+            node_elem = node.split(".")
+            if len(node_elem) > 1 and node_elem[1] == self.site:
+                self.nodes.add(node_elem[0])
+        if self.nodes:
+            return None
+        LOGGER.warning(
+            "No node for experiment id '{}' in site '{}'".format(
+                self.experiment_id, self.site
+            )
+        )
+        return "invalid_node", "No node in experiment on this site"
+
+    def open(self):
+        """Accept the multiplexed websocket, unless over the user limit."""
+        self.set_nodelay(True)
+        LOGGER.debug(
+            "Multiplexed websocket opened for experiment '{}'".format(
+                self.experiment_id
+            )
+        )
+        self.application.handle_mux_open(self)
+
+    def write_frame(self, channel, kind, text):
+        """Send a text frame, ignored if the websocket is closed."""
+        try:
+            self.write_message(
+                mux.encode(channel, kind, text.encode("utf-8")), binary=True
+            )
+        except WebSocketClosedError:
+            pass
+
+    def on_message(self, message):
+        """Handle a frame received from the websocket client.
+
+        Reading is never paused for a slow node, it would block all the
+        channels: input of a node with a full queue is rejected on its channel
+        with a status and skipped by broadcasts, the client has to resend it.
+        """
+        try:
+            channel, kind, payload = mux.decode(message)
+        except ValueError as exc:
+            LOGGER.warning("Invalid multiplexed frame: {}".format(exc))
+            self.close(code=1003, reason=str(exc))
+            return None
+        if kind == mux.SUBSCRIBE:
+            self._subscribe(channel, payload.decode("utf-8", "replace"))
+            return None
+        if kind == mux.BROADCAST:
+            self._broadcast(channel, payload)
+            return None
+        subscribed = self.channels.get(channel)
+        if subscribed is None:
+            self.write_frame(
+                channel, mux.CLOSED, "Channel {} is not subscribed".format(channel)
+            )
+            return None
+        if kind == mux.UNSUBSCRIBE:
+            subscribed.close(code=1000, reason="Unsubscribed")
+            return None
+        self.application.handle_websocket_data(subscribed, payload)
+        return None
+
+    def _subscribe(self, channel, node):
+        if channel in self.channels:
+            reason = "Channel {} is already subscribed".format(channel)
+        elif node not in self.nodes:
+            reason = "Invalid node '{}'".format(node)
+        else:
+            LOGGER.debug("Subscribing channel {} to node '{}'".format(channel, node))
+            subscribed = self.channels[channel] = MuxChannel(self, channel, node)
+            self.application.handle_websocket_open(subscribed)
+            return
+        self.write_frame(channel, mux.CLOSED, reason)
+
+    def _broadcast(self, channel, payload):
+        try:
+            patterns, data = mux.decode_broadcast(payload)
+        except ValueError as exc:
+            self.write_frame(channel, mux.DELIVERY, json.dumps({"error": str(exc)}))
+            return
+        statuses = {}
+        nodes = {}
+        for pattern in patterns:
+            matched = [
+                node for node in self.nodes if fnmatch.fnmatchcase(node, pattern)
+            ]
+            if not matched:
+                statuses[pattern] = "invalid_node"
+            nodes.update(dict.fromkeys(sorted(matched)))
+        statuses.update(self.application.handle_group_write(nodes, data))
+        self.write_frame(channel, mux.DELIVERY, json.dumps(statuses))
+
+    def on_close(self):
+        """Close the channels of the multiplexed websocket."""
+        LOGGER.info(
+            "Multiplexed websocket closed for experiment '{}', "
+            "code: {}, reason: '{}'".format(
+                self.experiment_id, self.close_code, self.close_reason
+            )
+        )
+        for channel in list(self.channels.values()):
+            channel.close()
+        self.application.handle_mux_close(self)
@@ -0,0 +1,115 @@
+"""iotlabwebserial recorded traffic replay handler."""
+
+import math
+import time
+from datetime import timedelta
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.websocket import WebSocketClosedError
+
+from ..logger import LOGGER
+from ..recorder import NODE_OUTPUT, read_recording
+from .websocket_handler import WebsocketClientHandler
+
+
+def _parse_speed(value):
+    """Return the replay speed of a query argument, None if invalid."""
+    try:
+        speed = float(value)
+    except ValueError:
+        return None
+    return speed if math.isfinite(speed) and speed >= 0 else None
+
+
+class ReplayHandler(WebsocketClientHandler):
+    # pylint:disable=abstract-method,arguments-differ
+    # pylint:disable=attribute-defined-outside-init
+    """Class that streams the recorded output of a node to a websocket.
+
+    Checks are the same as for the serial websockets. The `speed` query
+    argument sets the replay speed: 1 (default) for the original speed,
+    0 for as fast as possible; invalid, negative or infinite speeds are
+    answered with a 400. Replays count as websockets of their user and are
+    closed when the application drains.
+    """
+
+    def initialize(self, api, recorder, use_mmap=False):
+        """Initialize the api and the recordings location."""
+        super(ReplayHandler, self).initialize(api, text=False)
+        self.recorder = recorder
+        self.use_mmap = use_mmap
+
+    endpoint = "replay"
+
+    def _check_path(self):
+        # Path is /replay/<site>/<experiment_id>/<node>
+        self.site, self.experiment_id, self.node = self.request.path.split("/")[-3:]
+        return True
+
+    async def get(self, *args, **kwargs):
+        """Check the replay speed, then the same as the serial websockets."""
+        value = self.get_argument("speed", "1")
+        self.speed = _parse_speed(value)
+        if self.speed is None:
+            LOGGER.warning("Reject replay: invalid speed '{}'".format(value))
+            self._reject("invalid_argument", "Invalid speed", status=400)
+            return
+        await super(ReplayHandler, self).get(*args, **kwargs)
+
+    def open(self):
+        """Start streaming the recording, unless over the user limit."""
+        self.set_nodelay(True)
+        LOGGER.debug("Replaying recording of node '{}'".format(self.node))
+        self.stopped = Future()
+        if self.application.handle_replay_open(self):
+            IOLoop.current().spawn_callback(self._replay)
+
+    def _closed(self):
+        return self.ws_connection is None or self.ws_connection.is_closing()
+
+    async def _sleep(self, delay):
+        """Wait for delay seconds, return True if the websocket was closed."""
+        try:
+            await gen.with_timeout(timedelta(seconds=delay), self.stopped)
+        except gen.TimeoutError:
+            return self._closed()
+        return True
+
+    async def _replay(self):
+        path = self.recorder.path(self.experiment_id, self.node)
+        records = read_recording(path, self.use_mmap)
+        start = None
+        try:
+            # Records are read off the event loop, a batch at a time
+            while not self._closed():
+                batch = await self.recorder.read(records)
+                if not batch:
+                    break
+                for timestamp, direction, payload in batch:
+                    if direction != NODE_OUTPUT:
+                        continue
+                    if start is None:
+                        start = (time.monotonic(), timestamp)
+                    if self.speed:
+                        delay = (timestamp - start[1]) / self.speed
+                        delay -= time.monotonic() - start[0]
+                        if delay > 0 and await self._sleep(delay):
+                            return
+                    # Wait for the websocket to accept more data
+                    await self.write_message(payload, binary=True)
+        except WebSocketClosedError:
+            return
+        finally:
+            records.close()
+        self.close(code=1000, reason="End of recording")
+
+    def on_message(self, message):
+        """Replay websockets are read-only."""
+
+    def on_close(self):
+        """Manage the disconnection of the websocket."""
+        LOGGER.info("Replay websocket closed for node '{}'".format(self.node))
+        self.stopped.set_result(None)
+        self.application.handle_replay_close(self)
@@ -1,42 +1,121 @@
 """iotlabwebserial websocket connections handler."""
 
-from tornado import websocket, gen
+import time
 
+from tornado import gen, websocket
+from tornado.concurrent import future_add_done_callback
+from tornado.ioloop import IOLoop
+
+from ..broadcast import BroadcastMessage
+from ..coalescer import FrameCoalescer
 from ..logger import LOGGER
 
 
+def node_output(handler, settings):
+    """Return the coalescer of the node output sent to handler."""
+    # Lines are always sent in their own frame
+    return FrameCoalescer(
+        handler,
+        max_size=0 if handler.lines else settings["coalesce_max_size"],
+        max_delay=settings["coalesce_max_delay"],
+        max_buffered=settings["output_buffer_max"],
+        # Node is paused only when all its websockets are full
+        overflow="close" if settings["output_buffer_policy"] == "close" else "drop",
+    )
+
+
+def _ignore_result(future):
+    # Checks still running when the handshake ended are not awaited
+    if not future.cancelled():
+        future.exception()
+
+
 class WebsocketClientHandler(websocket.WebSocketHandler):
     # pylint:disable=abstract-method,arguments-differ
     # pylint:disable=attribute-defined-outside-init
     """Class that manage websocket connections."""
 
+    # Node websockets carried by another websocket, see MuxChannel
+    multiplexed = False
+    read_only = False
+
     def _check_path(self):
         # Check path is always correct
         path_elems = self.request.path.split("/")
-        if self.text:
-            self.site, self.experiment_id, self.node = path_elems[-4:-1]
-        else:
-            self.site, self.experiment_id, self.node = path_elems[-5:-2]
+        # Last 'serial' element, in case the node itself is named 'serial'
+        serial = len(path_elems) - 1 - path_elems[::-1].index("serial")
+        self.site, self.experiment_id, self.node = path_elems[serial - 3 : serial]
         return True
 
+    @property
+    def endpoint(self):
+        """Return the endpoint type of the websocket, for the metrics."""
+        if self.lines:
+            return "lines"
+        return "text" if self.text else "raw"
+
+    def _reject(self, outcome, message, status=401):
+        if outcome in ("invalid_token", "invalid_node"):
+            # The cached responses may be stale, fetch them on next handshake
+            self.api.invalidate(self.experiment_id)
+        self.application.metrics.handshakes.labels(outcome).inc()
+        self.set_status(status)  # 401: Authentication failed
+        self.finish(message)
+
+    def get_compression_options(self):
+        """Enable permessage-deflate, unless compression is disabled."""
+        settings = self.application.settings
+        if settings["compression"] == "off":
+            return None
+        return {
+            "compression_level": settings["compression_level"],
+            "mem_level": settings["compression_mem_level"],
+        }
+
+    def write_message(self, message, binary=False):
+        """Send a message, uncompressed below `compression_min_size` bytes.
+
+        Node output is compressed or not by `BroadcastMessage`, this applies
+        the same threshold to merged output, scrollback and status messages,
+        whatever the compression mode.
+        """
+        # pylint:disable=protected-access
+        protocol = self.ws_connection
+        if getattr(protocol, "_compressor", None) is not None:
+            min_size = self.application.settings["compression_min_size"]
+            shared = BroadcastMessage(message, binary, min_size)
+            if len(shared.payload) < min_size:
+                return shared.write_to(self)
+        return super(WebsocketClientHandler, self).write_message(message, binary)
+
+    def _disable_context_takeover(self):
+        """Compress the messages of this websocket without context takeover.
+
+        A message compressed without context doesn't depend on the previous
+        ones and can be shared with the other websockets. Clients keeping a
+        context still decompress it, they don't need to be told.
+        """
+        # pylint:disable=protected-access
+        compressor = getattr(self.ws_connection, "_compressor", None)
+        if compressor is not None:
+            compressor._compressor = None
+
     def select_subprotocol(self, subprotocols):
         """Only accept the 'token' subprotocol"""
         if "token" in subprotocols:
             return "token"
         return None
 
-    @gen.coroutine
     def _check_subprotocols(self, subprotocols):
         if len(subprotocols) != 3 or subprotocols[1].strip() != "token":
             LOGGER.warning("Reject websocket connection: invalib subprotocol")
-            self.set_status(401)  # Authentication failed
-            self.finish("Invalid subprotocols")
+            self._reject("invalid_subprotocols", "Invalid subprotocols")
             return False
+        return True
 
-        req_token = subprotocols[2].strip()
-
+    async def _check_token(self, req_token):
         # Fetch the token from the authentication server
-        api_token = yield self.api.fetch_token_async(self.experiment_id)
+        api_token = await self.api.fetch_token_async(self.experiment_id)
 
         LOGGER.debug(
             "Fetched token '%s' for experiment id '%s'", api_token, self.experiment_id
@@ -44,38 +123,72 @@ class WebsocketClientHandler(websocket.WebSocketHandler):
 
         if req_token != api_token:
             LOGGER.warning("Reject websocket connection: invalib token '{}'".format(req_token))
-            self.set_status(401)  # Authentication failed
-            self.finish("Invalid token '{}'".format(req_token))
-            return False
+            return "invalid_token", "Invalid token '{}'".format(req_token)
 
         LOGGER.debug("Provided token '{}' verified".format(req_token))
-        return True
+        return None
 
-    @gen.coroutine
-    def _check_node(self):
-        nodes = yield self.api.fetch_nodes_async(self.experiment_id)
+    async def _check_node(self):
+        nodes = await self.api.fetch_nodes_async(self.experiment_id)
+        self.application.handle_experiment_nodes(nodes)
         for node in nodes:
             node_elem = node.split(".")
             if node_elem[0] == self.node and node_elem[1] == self.site:
                 LOGGER.debug("Requested node found in experiment")
-                return True
+                return None
 
         LOGGER.warning(
             "Invalid node '{}' for experiment id "
             "'{}' in site '{}'".format(self.node, self.experiment_id, self.site)
         )
         # No node matches the requested ressource for the experiment and site.
-        self.set_status(401)  # Authentication failed
-        self.finish("Invalid node")
-        return False
+        return "invalid_node", "Invalid node"
+
+    async def _timed(self, phase, check):
+        start = time.monotonic()
+        try:
+            return await check
+        finally:
+            self.application.metrics.handshake_latency.labels(phase).observe(
+                time.monotonic() - start
+            )
 
-    def initialize(self, api, text):
-        """Initialize the api and binary information."""
+    async def _run_checks(self, *checks):
+        """Run the checks concurrently, return the first rejection if any.
+
+        Rejections are returned in the order of the checks, as soon as the
+        checks before them have passed: a client with an invalid token isn't
+        told whether its nodes are in the experiment.
+        Raise `gen.TimeoutError` if they don't end within the handshake
+        timeout.
+        """
+        futures = [gen.convert_yielded(check) for check in checks]
+        deadline = IOLoop.current().time() + self.application.settings[
+            "handshake_timeout"
+        ]
+        results = {}
+        try:
+            waiter = gen.WaitIterator(*futures)
+            while not waiter.done():
+                result = await gen.with_timeout(deadline, waiter.next())
+                results[waiter.current_index] = result
+                for index in range(len(futures)):
+                    if index not in results:
+                        break
+                    if results[index] is not None:
+                        return results[index]
+            return None
+        finally:
+            for future in futures:
+                future_add_done_callback(future, _ignore_result)
+
+    def initialize(self, api, text, lines=False):
+        """Initialize the api, binary and line framing information."""
         self.api = api
         self.text = text
+        self.lines = lines
 
-    @gen.coroutine
-    def get(self, *args, **kwargs):  # pylint: disable=invalid-overridden-method
+    async def get(self, *args, **kwargs):
         """Triggered before any websocket connection is opened.
 
         This method checks if the url path is valid: the url path be in the
@@ -85,6 +198,8 @@ class WebsocketClientHandler(websocket.WebSocketHandler):
         authentication host.
         Finally, it checks that the requested node belongs to the experiment
         and the site.
+        Both API checks run concurrently, the handshake is answered with a
+        503 if they don't end within `handshake_timeout` seconds.
         """
 
         LOGGER.info("Websocket connection request")
@@ -92,22 +207,38 @@ class WebsocketClientHandler(websocket.WebSocketHandler):
         # Check path is always True
         self._check_path()
 
-        # Verify token provided in subprotocols, since there's an asynchronous
-        # call to the API, we wait for it to complete.
         subprotocols = self.request.headers.get("Sec-WebSocket-Protocol", "").split(",")
-        valid_subprotocols = yield self._check_subprotocols(subprotocols)
-        if not valid_subprotocols:
+        if not self._check_subprotocols(subprotocols):
             return
 
         self.user = subprotocols[0].strip()
 
-        # Check that the requested node is in the experiment
-        node_valid = yield self._check_node()
-        if not node_valid:
+        # Verify the token provided in subprotocols and that the requested
+        # node is in the experiment, both need an asynchronous call to the
+        # API: run them concurrently and stop at the first rejection.
+        start = time.monotonic()
+        try:
+            rejection = await self._run_checks(
+                self._timed("token", self._check_token(subprotocols[2].strip())),
+                self._timed("nodes", self._check_node()),
+            )
+        except gen.TimeoutError:
+            LOGGER.warning(
+                "Reject websocket connection: checks of experiment id '{}' "
+                "timed out".format(self.experiment_id)
+            )
+            self._reject("timeout", "Handshake timed out, retry later", status=503)
+            return
+        finally:
+            self.application.metrics.handshake_latency.labels("total").observe(
+                time.monotonic() - start
+            )
+        if rejection is not None:
+            self._reject(*rejection)
             return
 
         # Let parent class correctly configure the websocket connection
-        yield super(WebsocketClientHandler, self).get(*args, **kwargs)
+        await super(WebsocketClientHandler, self).get(*args, **kwargs)
 
         LOGGER.info(
             "Websocket connection for experiment '{}' "
@@ -118,7 +249,6 @@ class WebsocketClientHandler(websocket.WebSocketHandler):
         """Allow connections from anywhere."""
         return True
 
-    @gen.coroutine
     def open(self):
         """Accept all incoming connections.
 
@@ -126,19 +256,29 @@ class WebsocketClientHandler(websocket.WebSocketHandler):
         """
         self.set_nodelay(True)
         LOGGER.debug("Websocket connection opened for node '{}'".format(self.node))
+        if self.application.settings["compression"] == "shared":
+            self._disable_context_takeover()
+        self.output = node_output(self, self.application.settings)
         self.application.handle_websocket_open(self)
 
-    @gen.coroutine
+    def send_node_output(self, message):
+        """Send node output, merged with pending output if any."""
+        self.output.write(message)
+
     def on_message(self, message):
-        """Triggered when data is received from the websocket client."""
+        """Triggered when data is received from the websocket client.
+
+        Next messages are read once the returned future, if any, is resolved:
+        when the node has consumed its input.
+        """
         if self.text:
             try:
                 data = message.encode("utf-8")
             except (UnicodeEncodeError, UnicodeDecodeError, AttributeError):
-                return
+                return None
         else:
             data = message
-        self.application.handle_websocket_data(self, data)
+        return self.application.handle_websocket_data(self, data)
 
     def on_close(self):
         """Manage the disconnection of the websocket."""
@@ -146,4 +286,5 @@ class WebsocketClientHandler(websocket.WebSocketHandler):
             "Websocket connection closed for node '{}', "
             "code: {}, reason: '{}'".format(self.node, self.close_code, self.close_reason)
         )
+        self.output.close()
         self.application.handle_websocket_close(self)
@@ -0,0 +1,89 @@
+"""Listening sockets handed over between the processes of the service."""
+
+import os
+import socket
+import subprocess
+import sys
+
+import tornado.netutil
+
+from .logger import LOGGER
+
+SYSTEMD_FDS_START = 3
+INHERITED_FDS = "IOTLABWEBSOCKET_LISTEN_FDS"
+SERVICE_COMMAND = "from iotlabwebsocket.service_cli import main; main()"
+
+
+def inherited_sockets():
+    """Return the listening sockets passed to this process, if any.
+
+    Sockets are passed by systemd socket activation (`LISTEN_PID` and
+    `LISTEN_FDS`) or by a previous process of the service, see
+    `spawn_successor`, which this process then replaces as the main process
+    of a systemd service. Variables are removed from the environment once
+    read.
+    """
+    fds = []
+    if os.environ.get("LISTEN_PID") == str(os.getpid()):
+        count = int(os.environ.get("LISTEN_FDS", "0"))
+        fds = range(SYSTEMD_FDS_START, SYSTEMD_FDS_START + count)
+    elif os.environ.get(INHERITED_FDS):
+        fds = [int(fd) for fd in os.environ[INHERITED_FDS].split(",")]
+        notify_main_pid()
+    for name in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES", INHERITED_FDS):
+        os.environ.pop(name, None)
+    sockets = []
+    for fd in fds:
+        sock = socket.socket(fileno=fd)
+        sock.setblocking(False)
+        sockets.append(sock)
+    return sockets
+
+
+def notify_main_pid():
+    """Tell systemd that this process is now the main one of the service.
+
+    The previous process can then exit without systemd stopping the
+    service, this needs `NotifyAccess=all` in the service unit. Nothing is
+    done when not started by systemd.
+    """
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return
+    if address.startswith("@"):
+        # Abstract namespace socket
+        address = "\0" + address[1:]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.sendto("MAINPID={}".format(os.getpid()).encode(), address)
+        except OSError as exc:
+            LOGGER.warning("Cannot notify systemd of the main process: {}".format(exc))
+
+
+def bind_sockets(port, address=None):
+    """Return the inherited listening sockets, or new ones bound to port."""
+    sockets = inherited_sockets()
+    if sockets:
+        LOGGER.info("Listening on {} inherited sockets".format(len(sockets)))
+        return sockets
+    return tornado.netutil.bind_sockets(port, address)
+
+
+def spawn_successor(sockets, args=None):
+    """Start a new process of the service, listening on the same sockets.
+
+    The new process is started with the same command line arguments as this
+    one, unless `args` is given. It outlives this one only if the supervisor
+    of the service lets it, see `notify_main_pid`: in a container, run the
+    service with workers, they are reloaded without a new process.
+    """
+    fds = [sock.fileno() for sock in sockets]
+    env = dict(os.environ)
+    env[INHERITED_FDS] = ",".join(str(fd) for fd in fds)
+    if args is None:
+        args = sys.argv[1:]
+    process = subprocess.Popen(
+        [sys.executable, "-c", SERVICE_COMMAND] + list(args), env=env, pass_fds=fds
+    )
+    LOGGER.info("Started new service process {}".format(process.pid))
+    return process
@@ -0,0 +1,387 @@
+"""Metrics of the application, exported in the Prometheus text format."""
+
+import bisect
+import itertools
+import re
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+MAX_NODE_LABELS = 100
+OTHER_LABEL = "other"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # s
+SIZE_BUCKETS = (0, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)  # bytes
+OUTPUT_LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+)  # seconds
+MAX_NODE_CLASSES = 32
+NODE_NUMBER = re.compile(r"-?[0-9]+$")
+ENDPOINTS = ("text", "raw", "lines", "replay", "mux", "aggregate")
+HANDSHAKE_OUTCOMES = (
+    "accepted",
+    "invalid_argument",
+    "invalid_subprotocols",
+    "invalid_token",
+    "invalid_node",
+    "refused",
+    "timeout",
+)
+HANDSHAKE_PHASES = ("token", "nodes", "total")
+NODE_STATES = ("connecting", "connected", "lingering")
+
+
+def node_class(node):
+    """Return the class of a node, its name without its number."""
+    return NODE_NUMBER.sub("", node) or node
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(
+                name,
+                str(value)
+                .replace("\\", "\\\\")
+                .replace('"', '\\"')
+                .replace("\n", "\\n"),
+            )
+            for name, value in labels
+        )
+    )
+
+
+class Value:
+    """Class that holds the value of a counter or a gauge."""
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        """Increment the value."""
+        self.value += amount
+
+    def dec(self, amount=1):
+        """Decrement the value."""
+        self.value -= amount
+
+    def set(self, value):
+        """Set the value."""
+        self.value = value
+
+    def samples(self, name, labels):
+        """Yield the samples of the value."""
+        yield name, labels, self.value
+
+
+class HistogramValue:
+    """Class that counts the observed values in buckets."""
+
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # Last count is for values above the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        """Count a value."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        """Return the number of observed values."""
+        return sum(self.counts)
+
+    def quantile(self, fraction):
+        """Return an estimate of a quantile of the observed values.
+
+        Values are assumed evenly spread in their bucket, values above the
+        last bucket are estimated at its bound. None is returned if no value
+        was observed.
+        """
+        count = self.count
+        if not count:
+            return None
+        rank = fraction * count
+        total = 0
+        lower = 0
+        for bound, bucket_count in zip(self.buckets, self.counts):
+            if bucket_count and total + bucket_count >= rank:
+                return lower + (bound - lower) * (rank - total) / bucket_count
+            total += bucket_count
+            lower = bound
+        return self.buckets[-1]
+
+    def reset(self):
+        """Forget all the observed values."""
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+
+    def samples(self, name, labels):
+        """Yield the cumulative samples of the buckets, sum and count."""
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield name + "_bucket", labels + (("le", _format_value(bound)),), total
+        yield name + "_sum", labels, self.sum
+        yield name + "_count", labels, total
+
+
+class Metric:
+    """Class that holds a metric with one value for each set of labels.
+
+    The values of the label sets listed in `values` are allocated once, when
+    the metric is created, and are updated in place: a hot path keeps the
+    value returned by `labels` and updates it without any lookup or lock,
+    the application runs in a single thread.
+
+    When `max_values` is set, the first label takes any value, up to
+    `max_values` different ones. Above that, it is replaced by 'other'.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=(), values=(), max_values=None):
+        # pylint:disable=too-many-arguments
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.max_values = max_values
+        self.children = {}
+        if not labels:
+            self.children[()] = self._new_value()
+        elif values:
+            for key in itertools.product(*values):
+                self.children[key] = self._new_value()
+        self._first_values = {key[0] for key in self.children if key}
+
+    def _new_value(self):
+        return Value()
+
+    def labels(self, *values):
+        """Return the value of a set of labels."""
+        child = self.children.get(values)
+        if child is not None:
+            return child
+        if self.max_values is None:
+            raise KeyError("Unknown labels {} for {}".format(values, self.name))
+        if values[0] not in self._first_values:
+            if len(self._first_values) >= self.max_values:
+                values = (OTHER_LABEL,) + values[1:]
+                child = self.children.get(values)
+                if child is not None:
+                    return child
+            self._first_values.add(values[0])
+        child = self.children[values] = self._new_value()
+        return child
+
+    def render(self, const_labels=()):
+        """Return the metric in the Prometheus text format.
+
+        `const_labels` are (name, value) pairs added to all the samples.
+        """
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.kind),
+        ]
+        for key, child in self.children.items():
+            labels = tuple(const_labels) + tuple(zip(self.label_names, key))
+            for name, sample_labels, value in child.samples(self.name, labels):
+                lines.append(
+                    "{}{} {}".format(
+                        name, _format_labels(sample_labels), _format_value(value)
+                    )
+                )
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Class that counts events."""
+
+    kind = "counter"
+
+
+class Gauge(Metric):
+    """Class that holds values that go up and down."""
+
+    kind = "gauge"
+
+
+class Histogram(Metric):
+    """Class that counts observed values in buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets, **kwargs):
+        self.buckets = tuple(buckets)
+        super(Histogram, self).__init__(name, documentation, **kwargs)
+
+    def _new_value(self):
+        return HistogramValue(self.buckets)
+
+
+class Metrics:
+    """Class that holds the metrics of the application.
+
+    Metrics are updated where the events happen, and values that are cheaper
+    to read than to maintain are updated by the collectors, called before
+    the metrics are rendered. With several worker processes, the samples of
+    each one are labelled with its `worker` index.
+    """
+
+    # pylint:disable=too-many-instance-attributes
+    def __init__(self, max_nodes=MAX_NODE_LABELS, worker=None):
+        self.worker = worker
+        self.metrics = []
+        self.collectors = []
+        self.websockets = self.add(
+            Gauge(
+                "iotlabwebsocket_websockets",
+                "Open websockets by endpoint type, nodes carried for 'mux' and "
+                "'aggregate'.",
+                labels=("endpoint",),
+                values=(ENDPOINTS,),
+            )
+        )
+        self.handshakes = self.add(
+            Counter(
+                "iotlabwebsocket_handshakes_total",
+                "Websocket handshakes by outcome.",
+                labels=("outcome",),
+                values=(HANDSHAKE_OUTCOMES,),
+            )
+        )
+        self.handshake_latency = self.add(
+            Histogram(
+                "iotlabwebsocket_handshake_seconds",
+                "Duration of the websocket handshake checks by phase, 'total' "
+                "for the concurrent token and nodes checks.",
+                LATENCY_BUCKETS,
+                labels=("phase",),
+                values=(HANDSHAKE_PHASES,),
+            )
+        )
+        self.node_connections = self.add(
+            Gauge(
+                "iotlabwebsocket_node_connections",
+                "TCP connections to the nodes by state.",
+                labels=("state",),
+                values=(NODE_STATES,),
+            )
+        )
+        self.node_bytes = self.add(
+            Counter(
+                "iotlabwebsocket_node_bytes_total",
+                "Bytes received from ('output') and sent to ('input') the nodes.",
+                labels=("node", "direction"),
+                max_values=max_nodes,
+            )
+        )
+        self.frames = self.add(
+            Counter(
+                "iotlabwebsocket_websocket_frames_total",
+                "Websocket frames sent ('out') and received ('in'), "
+                "rate() gives the frames per second.",
+                labels=("direction",),
+                values=(("in", "out"),),
+            )
+        )
+        self.throttles = self.add(
+            Counter(
+                "iotlabwebsocket_node_throttles_total",
+                "Times a node was throttled for sending above its rate.",
+            )
+        )
+        self.api_latency = self.add(
+            Histogram(
+                "iotlabwebsocket_api_request_seconds",
+                "Latency of the REST API requests.",
+                LATENCY_BUCKETS,
+                labels=("resource", "outcome"),
+                values=(("token", "nodes"), ("ok", "error")),
+            )
+        )
+        self.api_cache = self.add(
+            Counter(
+                "iotlabwebsocket_api_cache_total",
+                "Lookups in the cache of the REST API responses by result, "
+                "'shared' when waiting for the request of another lookup.",
+                labels=("resource", "result"),
+                values=(("token", "nodes"), ("hit", "miss", "shared")),
+            )
+        )
+        self.write_buffers = self.add(
+            Histogram(
+                "iotlabwebsocket_write_buffer_bytes",
+                "Bytes waiting to be written on each websocket and node "
+                "connection, when scraped.",
+                SIZE_BUCKETS,
+                labels=("connection",),
+                values=(("websocket", "node"),),
+            )
+        )
+        self.fanout_latency = self.add(
+            Histogram(
+                "iotlabwebsocket_node_output_fanout_seconds",
+                "Time from reading sampled node output to handing it to the "
+                "websockets, by node class.",
+                OUTPUT_LATENCY_BUCKETS,
+                labels=("node_class",),
+                max_values=MAX_NODE_CLASSES,
+            )
+        )
+        self.output_latency = self.add(
+            Histogram(
+                "iotlabwebsocket_node_output_latency_seconds",
+                "Time from reading sampled node output to writing it to the "
+                "websocket sockets, by node class and endpoint type.",
+                OUTPUT_LATENCY_BUCKETS,
+                labels=("node_class", "endpoint"),
+                max_values=MAX_NODE_CLASSES,
+            )
+        )
+
+    def add(self, metric):
+        """Register a metric, return it."""
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """Register a function called before the metrics are rendered."""
+        self.collectors.append(collector)
+
+    def render(self):
+        """Return all the metrics in the Prometheus text format."""
+        for collector in self.collectors:
+            collector()
+        const_labels = ()
+        if self.worker is not None:
+            const_labels = (("worker", self.worker),)
+        return (
+            "\n".join(metric.render(const_labels) for metric in self.metrics) + "\n"
+        )
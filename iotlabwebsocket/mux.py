@@ -0,0 +1,78 @@
+"""Binary framing of the nodes multiplexed on one websocket.
+
+Each websocket message carries one frame: a header with the channel of the
+node (unsigned 16 bits, chosen by the client when subscribing) and the frame
+kind (unsigned 8 bits), followed by the payload, all in network order:
+
+- `SUBSCRIBE` (client): open the channel to the node named in the payload
+- `UNSUBSCRIBE` (client): close the channel, without payload
+- `INPUT` (client): bytes sent to the node of the channel
+- `BROADCAST` (client): bytes sent to a group of nodes, see `encode_broadcast`,
+  the channel only identifies the request
+- `OUTPUT` (server): bytes received from the node of the channel
+- `STATUS` (server): UTF-8 notice about the channel, e.g. node reconnecting
+- `CLOSED` (server): the channel is closed, the payload is the UTF-8 reason
+- `DELIVERY` (server): JSON object with the delivery status of each node of
+  the `BROADCAST` request of the channel
+"""
+
+import struct
+
+SUBSCRIBE = 1
+UNSUBSCRIBE = 2
+INPUT = 3
+OUTPUT = 4
+STATUS = 5
+CLOSED = 6
+BROADCAST = 7
+DELIVERY = 8
+CLIENT_KINDS = (SUBSCRIBE, UNSUBSCRIBE, INPUT, BROADCAST)
+MAX_CHANNEL = 0xFFFF
+
+HEADER = struct.Struct("!HB")
+SELECTOR_SIZE = struct.Struct("!H")
+
+
+def encode(channel, kind, payload=b""):
+    """Return the frame of payload on channel."""
+    return HEADER.pack(channel, kind) + payload
+
+
+def decode(frame):
+    """Return the channel, kind and payload of a client frame.
+
+    Raise ValueError if the frame is invalid.
+    """
+    if not isinstance(frame, bytes) or len(frame) < HEADER.size:
+        raise ValueError("Invalid frame")
+    channel, kind = HEADER.unpack_from(frame)
+    if kind not in CLIENT_KINDS:
+        raise ValueError("Invalid frame kind {}".format(kind))
+    return channel, kind, frame[HEADER.size :]
+
+
+def encode_broadcast(selector, data):
+    """Return the payload of a `BROADCAST` frame.
+
+    The selector is a comma separated list of node names or patterns, with
+    shell-style wildcards. It is prefixed by its size (unsigned 16 bits) and
+    followed by the data sent to the nodes.
+    """
+    selector = selector.encode("utf-8")
+    return SELECTOR_SIZE.pack(len(selector)) + selector + data
+
+
+def decode_broadcast(payload):
+    """Return the node patterns and the data of a `BROADCAST` payload.
+
+    Raise ValueError if the payload is invalid.
+    """
+    if len(payload) < SELECTOR_SIZE.size:
+        raise ValueError("Invalid broadcast")
+    (size,) = SELECTOR_SIZE.unpack_from(payload)
+    end = SELECTOR_SIZE.size + size
+    if len(payload) < end:
+        raise ValueError("Invalid broadcast selector")
+    selector = payload[SELECTOR_SIZE.size : end].decode("utf-8", "replace")
+    patterns = [pattern.strip() for pattern in selector.split(",")]
+    return [pattern for pattern in patterns if pattern], payload[end:]
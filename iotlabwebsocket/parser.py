@@ -4,6 +4,28 @@ import os
 import argparse
 
 from . import DEFAULT_APPLICATION_PORT, DEFAULT_API_HOST, DEFAULT_API_PORT
+from .api import API_CACHE_SIZE, API_CACHE_TTL, API_TIMEOUT
+from .clients.tcp_client import (
+    NODE_RATE,
+    NODE_BURST,
+    NODE_RECONNECT_WINDOW,
+    WRITE_HIGH_WATER,
+    WRITE_LOW_WATER,
+)
+from .coalescer import MAX_FRAME_SIZE, MAX_FRAME_DELAY, MAX_BUFFERED_BYTES
+from .scrollback import SCROLLBACK_SIZE, SCROLLBACK_BUDGET
+from .broadcast import COMPRESSION_LEVEL, COMPRESSION_MEM_LEVEL, COMPRESSION_MIN_SIZE
+from .metrics import MAX_NODE_LABELS
+from .web_application import (
+    MAX_LINGERING_NODES,
+    LINGER_POLICIES,
+    WRITE_POLICIES,
+    COMPRESSION_MODES,
+    OUTPUT_POLICIES,
+    DRAIN_TIMEOUT,
+    RETRY_AFTER,
+    HANDSHAKE_TIMEOUT,
+)
 
 
 def service_cli_parser():
@@ -15,6 +37,20 @@ def service_cli_parser():
         default=DEFAULT_APPLICATION_PORT,
         help="websocket server port",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="number of worker processes behind a dispatcher process, all the "
+        "websockets of an experiment are handled by the same worker (0 serves "
+        "them in the main process)",
+    )
+    parser.add_argument(
+        "--event-loop",
+        default="asyncio",
+        choices=["asyncio", "uvloop"],
+        help="event loop implementation (uvloop must be installed)",
+    )
     parser.add_argument(
         "--token",
         type=str,
@@ -47,6 +83,24 @@ def service_cli_parser():
         default=os.getenv("API_PASSWORD", ""),
         help="password used to connect to the REST API",
     )
+    parser.add_argument(
+        "--api-cache-size",
+        type=int,
+        default=API_CACHE_SIZE,
+        help="maximum number of experiments whose REST API responses are cached",
+    )
+    parser.add_argument(
+        "--api-cache-ttl",
+        type=float,
+        default=API_CACHE_TTL,
+        help="number of seconds a REST API response is cached (0 to disable)",
+    )
+    parser.add_argument(
+        "--api-timeout",
+        type=float,
+        default=API_TIMEOUT,
+        help="number of seconds after which a REST API request fails",
+    )
     parser.add_argument(
         "--use-local-api",
         action="store_true",
@@ -64,4 +118,202 @@ def service_cli_parser():
         default=os.getenv("http_proxy") or os.getenv("HTTP_PROXY"), 
         help="HTTP proxy to use for API requests (format: http://host:port)"
     )
+    parser.add_argument(
+        "--node-rate",
+        type=int,
+        default=NODE_RATE,
+        help="maximum output rate of a node in bytes/s (0 for no limit)",
+    )
+    parser.add_argument(
+        "--node-burst",
+        type=int,
+        default=NODE_BURST,
+        help="maximum output burst of a node in bytes",
+    )
+    parser.add_argument(
+        "--node-disconnect-after",
+        type=float,
+        default=None,
+        help="disconnect nodes throttled for more than this number of seconds",
+    )
+    parser.add_argument(
+        "--node-reconnect-window",
+        type=float,
+        default=NODE_RECONNECT_WINDOW,
+        help="number of seconds during which a lost node connection is "
+        "reopened before closing websockets (0 to disable)",
+    )
+    parser.add_argument(
+        "--node-linger",
+        type=float,
+        default=0,
+        help="number of seconds a node connection is kept open after its "
+        "last websocket is closed",
+    )
+    parser.add_argument(
+        "--node-linger-policy",
+        default="drop",
+        choices=LINGER_POLICIES,
+        help="what to do with the output of a node without websocket",
+    )
+    parser.add_argument(
+        "--node-linger-max",
+        type=int,
+        default=MAX_LINGERING_NODES,
+        help="maximum number of node connections kept open without websocket "
+        "(0 to disable)",
+    )
+    parser.add_argument(
+        "--node-write-high-water",
+        type=int,
+        default=WRITE_HIGH_WATER,
+        help="number of bytes queued for a node above which websocket input "
+        "is paused or rejected",
+    )
+    parser.add_argument(
+        "--node-write-low-water",
+        type=int,
+        default=WRITE_LOW_WATER,
+        help="number of bytes queued for a node below which websocket input "
+        "is resumed",
+    )
+    parser.add_argument(
+        "--node-write-policy",
+        default="pause",
+        choices=WRITE_POLICIES,
+        help="what to do with websocket input when a node input queue is full",
+    )
+    parser.add_argument(
+        "--preload-node-addresses",
+        action="store_true",
+        help="resolve the addresses of all the nodes of an experiment on its "
+        "first connection",
+    )
+    parser.add_argument(
+        "--scrollback-size",
+        type=int,
+        default=SCROLLBACK_SIZE,
+        help="number of bytes of recent node output replayed to new "
+        "websockets (0 to disable)",
+    )
+    parser.add_argument(
+        "--scrollback-lines",
+        type=int,
+        default=None,
+        help="maximum number of lines of recent node output replayed to new "
+        "websockets",
+    )
+    parser.add_argument(
+        "--scrollback-budget",
+        type=int,
+        default=SCROLLBACK_BUDGET,
+        help="maximum number of bytes used by the scrollback of all nodes",
+    )
+    parser.add_argument(
+        "--zero-copy",
+        action="store_true",
+        help="read node output in preallocated buffers",
+    )
+    parser.add_argument(
+        "--coalesce-max-size",
+        type=int,
+        default=MAX_FRAME_SIZE,
+        help="maximum size of frames merging output for busy websockets "
+        "(0 to disable)",
+    )
+    parser.add_argument(
+        "--coalesce-max-delay",
+        type=float,
+        default=MAX_FRAME_DELAY,
+        help="maximum delay in seconds before merged output is sent",
+    )
+    parser.add_argument(
+        "--record-dir",
+        type=str,
+        default=None,
+        help="directory where node traffic is recorded, enables replay",
+    )
+    parser.add_argument(
+        "--record-mmap",
+        action="store_true",
+        help="read recordings with mmap when replaying them",
+    )
+    parser.add_argument(
+        "--compression",
+        default="off",
+        choices=COMPRESSION_MODES,
+        help="permessage-deflate compression of websocket messages ('shared' "
+        "compresses node output once for all websockets)",
+    )
+    parser.add_argument(
+        "--compression-level",
+        type=int,
+        default=COMPRESSION_LEVEL,
+        help="zlib compression level (0-9)",
+    )
+    parser.add_argument(
+        "--compression-mem-level",
+        type=int,
+        default=COMPRESSION_MEM_LEVEL,
+        help="zlib memory level (1-9)",
+    )
+    parser.add_argument(
+        "--compression-min-size",
+        type=int,
+        default=COMPRESSION_MIN_SIZE,
+        help="size in bytes below which websocket messages are not compressed "
+        "('context' and 'shared' modes)",
+    )
+    parser.add_argument(
+        "--output-buffer-max",
+        type=int,
+        default=MAX_BUFFERED_BYTES,
+        help="number of bytes of node output buffered for a websocket above "
+        "which it is too slow (0 for no limit)",
+    )
+    parser.add_argument(
+        "--output-buffer-policy",
+        default="drop",
+        choices=OUTPUT_POLICIES,
+        help="what to do with too slow websockets",
+    )
+    parser.add_argument(
+        "--metrics",
+        action="store_true",
+        help="export Prometheus metrics on /metrics",
+    )
+    parser.add_argument(
+        "--metrics-max-nodes",
+        type=int,
+        default=MAX_NODE_LABELS,
+        help="maximum number of nodes with their own metrics",
+    )
+    parser.add_argument(
+        "--latency-sample-rate",
+        type=float,
+        default=0,
+        help="fraction of node reads whose latency to the websockets is "
+        "measured and served on /admin/latency (0 to disable)",
+    )
+    parser.add_argument(
+        "--handshake-timeout",
+        type=float,
+        default=HANDSHAKE_TIMEOUT,
+        help="seconds after which a websocket handshake waiting for the REST "
+        "API is answered with a 503",
+    )
+    parser.add_argument(
+        "--drain-timeout",
+        type=float,
+        default=DRAIN_TIMEOUT,
+        help="seconds websockets are left open on SIGTERM or SIGHUP (restart) "
+        "before they are closed",
+    )
+    parser.add_argument(
+        "--retry-after",
+        type=int,
+        default=RETRY_AFTER,
+        help="seconds after which clients of drained websockets are told to "
+        "reconnect",
+    )
     return parser
@@ -0,0 +1,206 @@
+"""Recording of the serial traffic of the nodes on disk."""
+
+import os
+import mmap
+import time
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from .logger import LOGGER
+
+NODE_OUTPUT = 0
+NODE_INPUT = 1
+RECORD_HEADER = struct.Struct("!dBI")  # timestamp, direction, payload size
+SEGMENT_SIZE = 16 * 1024 * 1024  # bytes
+BATCH_SIZE = 65536  # bytes
+READ_SIZE = 65536  # bytes
+FLUSH_INTERVAL = 0.5  # seconds
+SEGMENT_SUFFIX = ".rec"
+
+
+def recording_path(directory, experiment_id, node):
+    """Return the directory of the recording of a node."""
+    return os.path.join(directory, str(experiment_id), node)
+
+
+def read_recording(path, use_mmap=False):
+    """Iterate over the (timestamp, direction, payload) records of a node.
+
+    Segments are read `READ_SIZE` bytes at a time, this blocks on the disk:
+    use `Recorder.read` from the event loop.
+    """
+    if not os.path.isdir(path):
+        return
+    segments = sorted(
+        name for name in os.listdir(path) if name.endswith(SEGMENT_SUFFIX)
+    )
+    for segment in segments:
+        with open(os.path.join(path, segment), "rb") as segment_file:
+            if use_mmap:
+                if not os.fstat(segment_file.fileno()).st_size:
+                    continue
+                with mmap.mmap(
+                    segment_file.fileno(), 0, access=mmap.ACCESS_READ
+                ) as data:
+                    yield from _records(data)
+            else:
+                yield from _read_records(segment_file)
+
+
+def _read_records(segment_file):
+    rest = b""
+    for chunk in iter(lambda: segment_file.read(READ_SIZE), b""):
+        data = rest + chunk
+        offset = 0
+        for record in _records(data):
+            yield record
+            offset += RECORD_HEADER.size + len(record[2])
+        # Record continued in the next chunk
+        rest = data[offset:]
+
+
+def _records(data):
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        timestamp, direction, size = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        if offset + size > len(data):
+            # Truncated record, recording was interrupted
+            return
+        yield timestamp, direction, data[offset : offset + size]
+        offset += size
+
+
+def _next_records(records):
+    batch = []
+    size = 0
+    for record in records:
+        batch.append(record)
+        size += len(record[2])
+        if size >= READ_SIZE:
+            break
+    return batch
+
+
+class _Recording:
+    """Segmented, append-only, files of the recording of a node.
+
+    Only used from the writer thread.
+    """
+
+    def __init__(self, path, segment_size):
+        self.path = path
+        self.segment_size = segment_size
+        self._file = None
+        self._size = 0
+
+    def _next_segment(self):
+        if self._file is not None:
+            self._file.close()
+        os.makedirs(self.path, exist_ok=True)
+        segments = [
+            name for name in os.listdir(self.path) if name.endswith(SEGMENT_SUFFIX)
+        ]
+        name = "{:08d}{}".format(len(segments), SEGMENT_SUFFIX)
+        self._file = open(  # pylint:disable=consider-using-with
+            os.path.join(self.path, name), "ab"
+        )
+        self._size = 0
+
+    def write(self, data):
+        """Append a batch of records."""
+        if self._file is None or self._size >= self.segment_size:
+            self._next_segment()
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+
+    def close(self):
+        """Close the current segment."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class Recorder:
+    """Class that records the serial traffic of the nodes.
+
+    Records are batched in memory and written by a dedicated thread, every
+    `FLUSH_INTERVAL` seconds or once `BATCH_SIZE` bytes are pending, so the
+    event loop never waits for the disk.
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self._recordings = {}
+        self._batches = {}
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._flusher = PeriodicCallback(self.flush, FLUSH_INTERVAL * 1000)
+
+    def path(self, experiment_id, node):
+        """Return the directory of the recording of a node."""
+        return recording_path(self.directory, experiment_id, node)
+
+    def open(self, node, experiment_id):
+        """Start recording the traffic of a node."""
+        if node in self._recordings:
+            return
+        LOGGER.debug("Recording traffic of node '{}'".format(node))
+        self._recordings[node] = _Recording(
+            self.path(experiment_id, node), self.segment_size
+        )
+        self._batches[node] = bytearray()
+        if not self._flusher.is_running():
+            self._flusher.start()
+
+    def record(self, node, direction, data):
+        """Add a record to the recording of a node, if any."""
+        batch = self._batches.get(node)
+        if batch is None:
+            return
+        batch += RECORD_HEADER.pack(time.time(), direction, len(data))
+        batch += data
+        if len(batch) >= BATCH_SIZE:
+            self._flush_node(node)
+
+    def _flush_node(self, node):
+        batch = self._batches[node]
+        if not batch:
+            return
+        self._batches[node] = bytearray()
+        self._executor.submit(self._recordings[node].write, batch)
+
+    def flush(self):
+        """Write all pending records."""
+        for node in self._batches:
+            self._flush_node(node)
+
+    def close(self, node):
+        """Stop recording the traffic of a node."""
+        if node not in self._recordings:
+            return None
+        self._flush_node(node)
+        recording = self._recordings.pop(node)
+        self._batches.pop(node)
+        if not self._recordings:
+            self._flusher.stop()
+        return self._executor.submit(recording.close)
+
+    def read(self, records):
+        """Return a future of the next records of `read_recording`.
+
+        Records are read in the writer thread, up to `READ_SIZE` bytes of
+        payload. The list is empty once all the records were read.
+        """
+        return IOLoop.current().run_in_executor(
+            self._executor, _next_records, records
+        )
+
+    def stop(self):
+        """Stop all recordings and wait for pending writes."""
+        for node in list(self._recordings):
+            self.close(node)
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,52 @@
+"""Scrollback of the recent output of a node."""
+
+SCROLLBACK_SIZE = 16384  # bytes per node
+SCROLLBACK_BUDGET = 64 * 1024 * 1024  # bytes for all nodes
+
+
+class RingBuffer:
+    """Class that keeps the last `size` bytes written to it.
+
+    Bytes are copied in a buffer allocated once, writing doesn't allocate
+    any object.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._view = memoryview(bytearray(size))
+        self._end = 0
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def write(self, data):
+        """Append data, overwriting the oldest bytes if full."""
+        data = memoryview(data)
+        size = len(data)
+        if size >= self.size:
+            self._view[:] = data[size - self.size :]
+            self._end = 0
+            self._length = self.size
+            return
+        first = min(size, self.size - self._end)
+        self._view[self._end : self._end + first] = data[:first]
+        self._view[: size - first] = data[first:]
+        self._end = (self._end + size) % self.size
+        self._length = min(self.size, self._length + size)
+
+    def read(self, lines=None):
+        """Return the buffered bytes, or only the last `lines` lines."""
+        start = (self._end - self._length) % self.size
+        if start + self._length <= self.size:
+            data = bytes(self._view[start : start + self._length])
+        else:
+            data = bytes(self._view[start:]) + bytes(self._view[: self._end])
+        if lines is None:
+            return data
+        end = len(data) - 1 if data.endswith(b"\n") else len(data)
+        for _ in range(lines):
+            end = data.rfind(b"\n", 0, end)
+            if end == -1:
+                return data
+        return data[end + 1 :]
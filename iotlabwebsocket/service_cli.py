@@ -1,18 +1,54 @@
 """iotlabwebserial application command line interface"""
 
+import asyncio
 import os
+import signal
+
 import tornado
 
 from .logger import LOGGER, setup_server_logger
 from .web_application import WebApplication
 from .api import ApiClient
+from .counters import SharedUserCounters
 from .parser import service_cli_parser
+from .workers import run_workers
+
+
+def _use_event_loop(name):
+    """Run on the uvloop event loop if requested, it's an optional dependency."""
+    if name != "uvloop":
+        return
+    try:
+        import uvloop  # pylint:disable=import-outside-toplevel
+    except ImportError as exc:
+        raise SystemExit("Cannot use the uvloop event loop: {}".format(exc))
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    LOGGER.info("Using the uvloop event loop")
+
+
+def _drain_on_signals(io_loop, app, drain_timeout, retry_after):
+    """Drain websockets on SIGTERM, restart in a new process on SIGHUP."""
+
+    async def _shutdown(restart):
+        if app.draining is not None:
+            return
+        if restart:
+            await app.restart(drain_timeout, retry_after)
+        else:
+            await app.drain(drain_timeout, retry_after)
+        io_loop.stop()
+
+    for signum, restart in ((signal.SIGTERM, False), (signal.SIGHUP, True)):
+        io_loop.asyncio_loop.add_signal_handler(
+            signum, io_loop.spawn_callback, _shutdown, restart
+        )
 
 
 def main(args=None):
     """Main function of the web application."""
     args = service_cli_parser().parse_args(args)
     setup_server_logger(log_file=args.log_file, log_console=args.log_console)
+    _use_event_loop(args.event_loop)
     
     # Get proxy from args or environment
     proxy = args.http_proxy or os.environ.get('http_proxy') or os.environ.get('HTTP_PROXY')
@@ -25,14 +61,65 @@ def main(args=None):
         args.api_port,
         args.api_user,
         args.api_password,
-        proxy=proxy
+        proxy=proxy,
+        cache_size=args.api_cache_size,
+        cache_ttl=args.api_cache_ttl,
+        timeout=args.api_timeout,
+    )
+    settings = dict(
+        use_local_api=args.use_local_api,
+        token=args.token,
+        node_rate=args.node_rate,
+        node_burst=args.node_burst,
+        node_disconnect_after=args.node_disconnect_after,
+        node_zero_copy=args.zero_copy,
+        node_reconnect_window=args.node_reconnect_window,
+        node_linger=args.node_linger,
+        node_linger_policy=args.node_linger_policy,
+        node_linger_max=args.node_linger_max,
+        node_write_high_water=args.node_write_high_water,
+        node_write_low_water=args.node_write_low_water,
+        node_write_policy=args.node_write_policy,
+        node_address_preload=args.preload_node_addresses,
+        scrollback_size=args.scrollback_size,
+        scrollback_lines=args.scrollback_lines,
+        scrollback_budget=args.scrollback_budget,
+        coalesce_max_size=args.coalesce_max_size,
+        coalesce_max_delay=args.coalesce_max_delay,
+        record_dir=args.record_dir,
+        record_mmap=args.record_mmap,
+        compression=args.compression,
+        compression_level=args.compression_level,
+        compression_mem_level=args.compression_mem_level,
+        compression_min_size=args.compression_min_size,
+        output_buffer_max=args.output_buffer_max,
+        output_buffer_policy=args.output_buffer_policy,
+        metrics=args.metrics,
+        metrics_max_nodes=args.metrics_max_nodes,
+        latency_sample_rate=args.latency_sample_rate,
+        handshake_timeout=args.handshake_timeout,
     )
-    app = WebApplication(api, use_local_api=args.use_local_api, token=args.token)
+    if args.workers > 0:
+        # Websockets of a user are counted in all workers
+        user_counters = SharedUserCounters()
+        run_workers(
+            args.workers,
+            args.port,
+            lambda index: WebApplication(
+                api, user_counters=user_counters, worker=index, **settings
+            ),
+            drain_timeout=args.drain_timeout,
+            retry_after=args.retry_after,
+        )
+        return
+    app = WebApplication(api, **settings)
+    io_loop = tornado.ioloop.IOLoop.instance()
     try:
         app.listen(args.port)
         LOGGER.info("Application started, listening on port {}".format(args.port))
-        tornado.ioloop.IOLoop.instance().start()
+        _drain_on_signals(io_loop, app, args.drain_timeout, args.retry_after)
+        io_loop.start()
     except KeyboardInterrupt:
         LOGGER.debug("Shuting down service")
         app.stop()
-        tornado.ioloop.IOLoop.instance().stop()
+        io_loop.stop()
@@ -0,0 +1,182 @@
+"""Registry of the connections to the nodes and of their websockets."""
+
+from collections import OrderedDict
+
+from .counters import UserCounters
+from .metrics import Value
+
+# Bytes of the sessions of a registry without `node_bytes`, never reported
+UNCOUNTED_BYTES = Value()
+
+
+class NodeSession:
+    """Class that holds the state of the connection to a node.
+
+    Websockets are stored in a tuple, in their connection order: a node has
+    only a few of them, and sessions without websocket share the empty tuple.
+    The linger timeout and buffered output are kept in one attribute, only
+    set while lingering.
+    """
+
+    __slots__ = (
+        "node",
+        "tcp_client",
+        "websockets",
+        "decoder",
+        "scrollback",
+        "linger",
+        "output_bytes",
+        "input_bytes",
+    )
+
+    def __init__(self, node, tcp_client):
+        self.node = node
+        self.tcp_client = tcp_client
+        self.websockets = ()
+        self.decoder = None
+        self.scrollback = None
+        self.linger = None
+        self.output_bytes = UNCOUNTED_BYTES
+        self.input_bytes = UNCOUNTED_BYTES
+
+    @property
+    def lingering(self):
+        """Return True if the node connection is kept open without websocket."""
+        return self.linger is not None
+
+    @property
+    def linger_timeout(self):
+        """Return the timeout closing the lingering connection, if any."""
+        return self.linger[0] if self.linger is not None else None
+
+    @property
+    def linger_buffer(self):
+        """Return the output buffered while lingering, None if dropped."""
+        return self.linger[1] if self.linger is not None else None
+
+
+class SessionRegistry:
+    """Class that holds the node sessions and the websockets of the users.
+
+    Sessions are indexed by node. A session is only created for a websocket
+    that passed the limits, and removed with its node connection.
+
+    When `node_bytes` is given, the bytes exchanged with each node are
+    counted in this metric.
+    """
+
+    def __init__(self, user_counters=None, node_bytes=None):
+        self.sessions = {}
+        self.users = user_counters or UserCounters()
+        self.node_bytes = node_bytes
+        # Sessions without websocket, ordered from the oldest one
+        self.lingering = OrderedDict()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __iter__(self):
+        return iter(list(self.sessions.values()))
+
+    def get(self, node):
+        """Return the session of node, None if there is none."""
+        return self.sessions.get(node)
+
+    def websockets(self, node):
+        """Return the websockets of node."""
+        session = self.sessions.get(node)
+        return list(session.websockets) if session is not None else []
+
+    def open(self, node, tcp_client):
+        """Create the session of node."""
+        session = self.sessions[node] = NodeSession(node, tcp_client)
+        if self.node_bytes is not None:
+            session.output_bytes = self.node_bytes.labels(node, "output")
+            session.input_bytes = self.node_bytes.labels(node, "input")
+        return session
+
+    def close(self, node):
+        """Remove the session of node, return it."""
+        session = self.sessions.pop(node, None)
+        if session is not None:
+            self.lingering.pop(node, None)
+        return session
+
+    def reserve(self, websocket, max_per_node, max_per_user):
+        """Check the limits for a new websocket and count it for its user.
+
+        Return why the websocket is refused, None if it is accepted. Nothing
+        is changed when it is refused.
+
+        The websocket is not counted for its user if `max_per_user` is None:
+        nodes multiplexed on one websocket are counted once, with it, see
+        `reserve_user`. Nor is the number of websockets of the node limited
+        if `max_per_node` is None, read-only websockets are not part of it.
+        """
+        node = websocket.node
+        session = self.sessions.get(node)
+        if (
+            max_per_node is not None
+            and session is not None
+            and sum(not other.read_only for other in session.websockets)
+            >= max_per_node
+        ):
+            return "Cannot open more than {} connections to node {}.".format(
+                max_per_node, node
+            )
+        if max_per_user is None:
+            return None
+        return self.reserve_user(websocket.user, websocket.site, max_per_user)
+
+    def reserve_user(self, user, site, max_per_user):
+        """Count a new websocket for user, return why it is refused if it is."""
+        if not self.users.acquire(user, max_per_user):
+            return (
+                "Max number of connections ({}) reached for user {} "
+                "on site {}.".format(max_per_user, user, site)
+            )
+        return None
+
+    def release_user(self, user):
+        """Forget a websocket of user counted with `reserve_user`."""
+        self.users.release(user)
+
+    @staticmethod
+    def attach(session, websocket):
+        """Add a reserved websocket to a session."""
+        session.websockets += (websocket,)
+
+    def detach(self, websocket, release_user=True):
+        """Remove a websocket from its session, return the session.
+
+        None is returned if the websocket was not attached. The websocket is
+        no longer counted for its user, unless `release_user` is False.
+        """
+        session = self.sessions.get(websocket.node)
+        if session is None:
+            return None
+        websockets = session.websockets
+        try:
+            index = websockets.index(websocket)
+        except ValueError:
+            return None
+        session.websockets = websockets[:index] + websockets[index + 1 :]
+        if release_user:
+            self.users.release(websocket.user)
+        return session
+
+    def linger(self, session, timeout, buffer=None):
+        """Keep the session of a node without websocket."""
+        session.linger = (timeout, buffer)
+        self.lingering[session.node] = session
+
+    def unlinger(self, session):
+        """Stop lingering, return the linger timeout and buffered output."""
+        self.lingering.pop(session.node, None)
+        timeout, buffer = session.linger_timeout, session.linger_buffer
+        session.linger = None
+        return timeout, buffer
+
+    def oldest_lingering(self):
+        """Return the session lingering for the longest time."""
+        return next(iter(self.lingering.values()))
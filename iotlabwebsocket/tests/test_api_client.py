@@ -2,12 +2,15 @@
 
 import json
 import io
+import time
 import unittest
 import mock
 
+import tornado.httpclient
+from tornado import gen
 from tornado.testing import AsyncHTTPTestCase, gen_test
 
-from iotlabwebsocket.api import ApiClient
+from iotlabwebsocket.api import API_TIMEOUT, ApiCache, ApiClient
 from iotlabwebsocket.handlers.http_handler import NODES
 from iotlabwebsocket.web_application import WebApplication
 
@@ -31,6 +34,67 @@ class TestApiClientAsync(AsyncHTTPTestCase):
         token = yield self.api.fetch_token_async("123")
         assert token == "token"
 
+    @gen_test
+    def test_fetch_cached(self):
+        with mock.patch.object(
+            self.api, "_fetch_async", wraps=self.api._fetch_async
+        ) as fetch:
+            for _ in range(2):
+                assert (yield self.api.fetch_token_async("123")) == "token"
+                assert (yield self.api.fetch_nodes_async("123")) == NODES["nodes"]
+            assert fetch.call_count == 2
+            assert (self.api.cache.hits, self.api.cache.misses) == (2, 2)
+
+            # Invalidated and expired responses are fetched again
+            self.api.invalidate("123")
+            yield self.api.fetch_token_async("123")
+            assert fetch.call_count == 3
+            entry = self.api.cache.entries["123"]
+            entry["token"] = (entry["token"][0], time.monotonic())
+            yield self.api.fetch_token_async("123")
+            assert fetch.call_count == 4
+
+    @gen_test
+    def test_fetch_shared(self):
+        self.api.cache.ttl = 0
+        with mock.patch.object(
+            self.api, "_fetch_async", wraps=self.api._fetch_async
+        ) as fetch:
+            tokens = yield [self.api.fetch_token_async("123") for _ in range(3)]
+            assert tokens == ["token"] * 3
+            assert fetch.call_count == 1
+            assert not self.api.pending
+
+            # Errors are raised to all the callers, and are not shared after
+            fetch.side_effect = tornado.httpclient.HTTPClientError(599, "Timeout")
+            futures = [
+                gen.convert_yielded(self.api.fetch_nodes_async("123"))
+                for _ in range(2)
+            ]
+            for future in futures:
+                with self.assertRaises(tornado.httpclient.HTTPClientError):
+                    yield future
+            assert fetch.call_count == 2
+            assert not self.api.pending
+            fetch.side_effect = None
+            assert (yield self.api.fetch_nodes_async("123")) == NODES["nodes"]
+
+
+def test_api_cache():
+    cache = ApiCache(max_size=2, ttl=10)
+    assert cache.get("1", "token") is None
+    for exp_id in ("1", "2"):
+        cache.put(exp_id, "token", "token-" + exp_id)
+    assert cache.get("1", "token") == "token-1"
+    # Least recently used experiment is forgotten
+    cache.put("3", "token", "token-3")
+    assert list(cache.entries) == ["1", "3"]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    cache = ApiCache(ttl=0)
+    cache.put("1", "token", "token")
+    assert cache.get("1", "token") is None
+
 
 class ResponseBuffer(object):
     def __init__(self, buf):
@@ -63,5 +127,10 @@ class TestApiClientSync(unittest.TestCase):
         args, kwargs = request.call_args
         assert len(args) == 1
         assert args[0] == "{}/{}/{}".format(self.api.url, "123", "")
-        assert kwargs == dict(auth_username="test", auth_password="test")
+        assert kwargs == dict(
+            auth_username="test",
+            auth_password="test",
+            connect_timeout=API_TIMEOUT,
+            request_timeout=API_TIMEOUT,
+        )
         assert nodes == NODES["nodes"]
@@ -0,0 +1,74 @@
+"""iotlabwebsocket broadcast message tests."""
+
+import pytest
+
+import tornado
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from tornado.websocket import WebSocketClosedError, WebSocketHandler
+
+from iotlabwebsocket.broadcast import BroadcastMessage, encode_frame
+
+
+class BroadcastHandler(WebSocketHandler):
+    # pylint:disable=abstract-method
+    def initialize(self, websockets, compression):
+        self.websockets = websockets
+        self.compression = compression
+
+    def get_compression_options(self):
+        return {} if self.compression else None
+
+    def open(self):
+        self.websockets.append(self)
+
+
+def test_encode_frame():
+    assert encode_frame(b"abc", 0x1) == b"\x81\x03abc"
+    assert encode_frame(b"a" * 126, 0x2)[:4] == b"\x82\x7e\x00\x7e"
+    assert encode_frame(b"a" * 65536, 0x2)[:10] == b"\x82\x7f" + (65536).to_bytes(
+        8, "big"
+    )
+    assert encode_frame(b"", 0x1, flags=0x40) == b"\xc1\x00"
+
+
+class TestBroadcastMessage(AsyncHTTPTestCase):
+    def get_app(self):
+        self.websockets = []
+        return tornado.web.Application(
+            [
+                (r"/ws", BroadcastHandler, dict(websockets=self.websockets, compression=False)),
+                (r"/zws", BroadcastHandler, dict(websockets=self.websockets, compression=True)),
+            ]
+        )
+
+    @gen_test
+    def test_broadcast_message(self):
+        url = f"ws://localhost:{self.get_http_port()}/ws"
+        clients = []
+        for _ in range(2):
+            client = yield tornado.websocket.websocket_connect(url)
+            clients.append(client)
+        # Compressed connections encode their own frame
+        client = yield tornado.websocket.websocket_connect(
+            url.replace("/ws", "/zws"), compression_options={}
+        )
+        clients.append(client)
+
+        for message, binary in (
+            ("tést", False),
+            (b"\x00" * 200, True),
+            (b"x" * 70000, True),
+        ):
+            broadcast = BroadcastMessage(message, binary)
+            for websocket in self.websockets:
+                yield broadcast.write_to(websocket)
+            for client in clients:
+                received = yield client.read_message()
+                assert received == message
+
+        assert self.websockets[0].ws_connection._message_bytes_out == 5 + 200 + 70000
+
+        clients[0].close()
+        yield tornado.gen.sleep(0.1)
+        with pytest.raises(WebSocketClosedError):
+            BroadcastMessage("closed", False).write_to(self.websockets[0])
@@ -0,0 +1,25 @@
+"""iotlabwebsocket buffer pool tests."""
+
+from iotlabwebsocket.clients.buffer_pool import BufferPool
+
+
+def test_buffer_pool_reuse():
+    pool = BufferPool()
+    buf = pool.get(1024)
+    assert len(buf) == 1024
+    assert not buf.readonly
+    assert pool.get(1024) is buf
+    assert len(pool) == 1
+
+
+def test_buffer_pool_eviction():
+    pool = BufferPool(max_buffers=2)
+    buf_1k = pool.get(1024)
+    buf_2k = pool.get(2048)
+    assert pool.get(1024) is buf_1k
+
+    # 2048 is the least recently used size
+    pool.get(4096)
+    assert len(pool) == 2
+    assert pool.get(1024) is buf_1k
+    assert pool.get(2048) is not buf_2k
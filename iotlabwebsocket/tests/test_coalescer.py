@@ -0,0 +1,207 @@
+"""iotlabwebsocket frame coalescer tests."""
+
+import mock
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.testing import AsyncTestCase, gen_test
+from tornado.websocket import WebSocketClosedError
+
+from iotlabwebsocket.broadcast import BroadcastMessage
+from iotlabwebsocket.coalescer import FrameCoalescer
+
+
+class WebsocketStub:
+    def __init__(self, text=False):
+        self.text = text
+        self.writes = []
+
+    def write_message(self, message, binary=False):
+        future = Future()
+        self.writes.append((message, binary, future))
+        return future
+
+    def complete(self):
+        for _, _, future in self.writes:
+            if not future.done():
+                future.set_result(None)
+
+    @property
+    def messages(self):
+        return [message for message, _, _ in self.writes]
+
+
+class FrameCoalescerTest(AsyncTestCase):
+    @gen_test
+    def test_coalescer_idle(self):
+        websocket = WebsocketStub()
+        coalescer = FrameCoalescer(websocket)
+
+        # Nothing pending: messages are sent immediately
+        coalescer.write(b"a")
+        assert websocket.writes[0][:2] == (b"a", True)
+        websocket.complete()
+        yield gen.moment
+        assert not coalescer.busy
+        coalescer.write(b"b")
+        assert websocket.messages == [b"a", b"b"]
+
+    @gen_test
+    def test_coalescer_busy(self):
+        websocket = WebsocketStub(text=True)
+        coalescer = FrameCoalescer(websocket, max_delay=10)
+
+        coalescer.write("a")
+        coalescer.write("b")
+        coalescer.write("c")
+        assert websocket.messages == ["a"]
+
+        # Pending messages are merged when the previous write completes
+        websocket.complete()
+        yield gen.moment
+        assert websocket.messages == ["a", "bc"]
+        assert websocket.writes[1][1] is False
+        assert coalescer.frames == 2
+
+    @gen_test
+    def test_coalescer_broadcast(self):
+        websocket = WebsocketStub()
+        coalescer = FrameCoalescer(websocket, max_delay=10)
+
+        # Shared frame is only written when the message is sent alone
+        with mock.patch.object(BroadcastMessage, "write_to") as write_to:
+            write_to.return_value = Future()
+            coalescer.write(BroadcastMessage(b"a", True))
+            write_to.assert_called_once_with(websocket)
+            coalescer.write(BroadcastMessage(b"b", True))
+            coalescer.write(b"c")
+            write_to.return_value.set_result(None)
+            yield gen.moment
+        assert websocket.messages == [b"bc"]
+
+    @gen_test
+    def test_coalescer_max_size(self):
+        websocket = WebsocketStub()
+        coalescer = FrameCoalescer(websocket, max_size=4, max_delay=10)
+
+        coalescer.write(b"a")
+        coalescer.write(b"bb")
+        coalescer.write(b"cc")
+        assert websocket.messages == [b"a", b"bbcc"]
+
+    @gen_test
+    def test_coalescer_max_delay(self):
+        websocket = WebsocketStub()
+        coalescer = FrameCoalescer(websocket, max_delay=0.01)
+
+        coalescer.write(b"a")
+        coalescer.write(b"b")
+        yield gen.sleep(0.05)
+        assert websocket.messages == [b"a", b"b"]
+
+    @gen_test
+    def test_coalescer_disabled(self):
+        websocket = WebsocketStub()
+        coalescer = FrameCoalescer(websocket, max_size=0)
+
+        coalescer.write(b"a")
+        coalescer.write(b"b")
+        assert websocket.messages == [b"a", b"b"]
+
+    @gen_test
+    def test_coalescer_on_written(self):
+        websocket = WebsocketStub(text=True)
+        coalescer = FrameCoalescer(websocket, max_delay=10)
+        written = []
+
+        # Nothing being written
+        coalescer.on_written(lambda: written.append("idle"))
+        assert written == ["idle"]
+
+        # Called when the frame being written is sent
+        coalescer.write("a")
+        coalescer.on_written(lambda: written.append("a"))
+        yield gen.moment
+        assert written == ["idle"]
+        websocket.complete()
+        yield gen.moment
+        assert written == ["idle", "a"]
+
+        # Or when the frame merging the queued messages is sent
+        coalescer.write("b")
+        coalescer.write("c")
+        coalescer.on_written(lambda: written.append("c"))
+        websocket.complete()
+        yield gen.moment
+        assert websocket.messages == ["a", "b", "c"]
+        assert written == ["idle", "a"]
+        websocket.complete()
+        yield gen.moment
+        assert written == ["idle", "a", "c"]
+
+        # Callbacks are forgotten on close
+        coalescer.write("d")
+        coalescer.write("e")
+        coalescer.on_written(lambda: written.append("e"))
+        coalescer.close()
+        websocket.complete()
+        yield gen.moment
+        assert written == ["idle", "a", "c"]
+
+    @gen_test
+    def test_coalescer_closed(self):
+        websocket = mock.Mock(text=False)
+        websocket.write_message.side_effect = WebSocketClosedError
+        coalescer = FrameCoalescer(websocket)
+
+        coalescer.write(b"a")
+        assert not coalescer.busy
+        assert coalescer.frames == 0
+
+    @gen_test
+    def test_coalescer_overflow_drop(self):
+        websocket = WebsocketStub(text=True)
+        coalescer = FrameCoalescer(websocket, max_delay=10, max_buffered=4)
+
+        coalescer.write("ab")
+        coalescer.write("c")
+        coalescer.write("d")
+        assert coalescer.full
+        assert coalescer.buffered_bytes == 4
+        drained = coalescer.drained()
+
+        # Oldest queued messages are dropped, not the one being written
+        coalescer.write("ef")
+        assert coalescer.buffered_bytes == 4
+        assert coalescer.dropped_bytes == 2
+        assert not drained.done()
+
+        websocket.complete()
+        yield gen.moment
+        assert websocket.messages == ["ab", "2 bytes dropped.\n", "ef"]
+        assert websocket.writes[1][1] is False
+        websocket.complete()
+        yield gen.moment
+        assert drained.done()
+        assert coalescer.stats == {
+            "buffered_bytes": 0,
+            "peak_buffered_bytes": 19,
+            "dropped_bytes": 2,
+        }
+
+    @gen_test
+    def test_coalescer_overflow_close(self):
+        websocket = WebsocketStub()
+        websocket.node = "node-1"
+        websocket.close = mock.Mock()
+        coalescer = FrameCoalescer(websocket, max_buffered=2, overflow="close")
+
+        coalescer.write(b"ab")
+        drained = coalescer.drained()
+        coalescer.write(b"c")
+        websocket.close.assert_called_once_with(
+            code=1008, reason="Websocket is too slow, 2 bytes of output buffered"
+        )
+        assert coalescer.buffered_bytes == 0
+        assert drained.done()
+        assert websocket.messages == [b"ab"]
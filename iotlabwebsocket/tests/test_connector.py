@@ -0,0 +1,142 @@
+"""iotlabwebsocket node connector tests."""
+
+import socket
+
+import mock
+
+from tornado.concurrent import Future
+from tornado.testing import AsyncTestCase, gen_test
+
+from iotlabwebsocket.clients.connector import CachingResolver, NodeConnector
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class ResolverStub:
+    def __init__(self):
+        self.calls = []
+        self.pending = {}
+
+    def resolve(self, host, port, family=socket.AF_UNSPEC):
+        self.calls.append(host)
+        future = Future()
+        if host.startswith("unknown"):
+            future.set_exception(IOError("Cannot resolve {}".format(host)))
+        elif host.startswith("slow"):
+            self.pending[host] = future
+        else:
+            address = "10.0.0.{}".format(len(self.calls))
+            future.set_result([(socket.AF_INET, (address, port))])
+        return future
+
+    def close(self):
+        pass
+
+
+class CachingResolverTest(AsyncTestCase):
+    @gen_test
+    def test_resolver_cache(self):
+        clock = FakeClock()
+        stub = ResolverStub()
+        resolver = CachingResolver(resolver=stub, ttl=10, clock=clock)
+
+        first = yield resolver.resolve("node-1", 20000)
+        second = yield resolver.resolve("node-1", 20000)
+        assert first == second == [(socket.AF_INET, ("10.0.0.1", 20000))]
+        assert stub.calls == ["node-1"]
+        assert (resolver.hits, resolver.misses) == (1, 1)
+
+        # Entries expire after the TTL
+        clock.now = 11
+        third = yield resolver.resolve("node-1", 20000)
+        assert third == [(socket.AF_INET, ("10.0.0.2", 20000))]
+        assert stub.calls == ["node-1", "node-1"]
+
+    @gen_test
+    def test_resolver_negative_cache(self):
+        clock = FakeClock()
+        stub = ResolverStub()
+        resolver = CachingResolver(resolver=stub, negative_ttl=1, clock=clock)
+
+        for _ in range(2):
+            try:
+                yield resolver.resolve("unknown-1", 20000)
+            except IOError:
+                pass
+            else:
+                assert False, "IOError not raised"
+        assert stub.calls == ["unknown-1"]
+
+        clock.now = 2
+        try:
+            yield resolver.resolve("unknown-1", 20000)
+        except IOError:
+            pass
+        assert stub.calls == ["unknown-1", "unknown-1"]
+
+    @gen_test
+    def test_resolver_concurrent(self):
+        stub = ResolverStub()
+        resolver = CachingResolver(resolver=stub)
+
+        # Concurrent resolutions share the same request
+        first = resolver.resolve("slow-1", 20000)
+        second = resolver.resolve("slow-1", 20000)
+        assert stub.calls == ["slow-1"]
+        stub.pending["slow-1"].set_result([(socket.AF_INET, ("10.0.0.1", 20000))])
+        results = yield [first, second]
+        assert results[0] == results[1]
+
+    @gen_test
+    def test_resolver_max_entries(self):
+        stub = ResolverStub()
+        resolver = CachingResolver(resolver=stub, max_entries=4)
+        for i in range(10):
+            yield resolver.resolve("node-{}".format(i), 20000)
+        assert len(resolver._cache) <= 4
+
+
+class NodeConnectorTest(AsyncTestCase):
+    @gen_test
+    def test_load_nodes(self):
+        stub = ResolverStub()
+        connector = NodeConnector(resolver=CachingResolver(resolver=stub))
+
+        yield connector.load_nodes(
+            ["node-1.grenoble.iot-lab.info", "unknown-1.lille.iot-lab.info", "local"]
+        )
+        assert connector.addresses == {("grenoble", "node-1"): "10.0.0.1"}
+
+        # Already known nodes are not resolved again
+        yield connector.load_nodes(["node-1.grenoble.iot-lab.info"])
+        assert len(stub.calls) == 2
+
+    @gen_test
+    def test_connect(self):
+        connector = NodeConnector(resolver=CachingResolver(resolver=ResolverStub()))
+        connector.addresses[("grenoble", "node-1")] = "10.0.0.1"
+        stream = mock.Mock()
+        # connect is a native coroutine, patched with an AsyncMock
+        with mock.patch.object(connector._client, "connect") as connect:
+            connect.return_value = stream
+            result = yield connector.connect("node-1", 20000, site="grenoble")
+            assert result is stream
+            connect.assert_called_with("10.0.0.1", 20000)
+
+            # Nodes without known address are resolved by name
+            yield connector.connect("node-2", 20000, site="grenoble")
+            connect.assert_called_with("node-2", 20000)
+
+            # Addresses of failed connections are forgotten
+            connect.side_effect = IOError
+            try:
+                yield connector.connect("node-1", 20000, site="grenoble")
+            except IOError:
+                pass
+            assert not connector.addresses
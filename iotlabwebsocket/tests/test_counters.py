@@ -0,0 +1,64 @@
+"""iotlabwebsocket user counters tests."""
+
+import multiprocessing
+
+import pytest
+
+from iotlabwebsocket.counters import UserCounters, SharedUserCounters
+
+
+@pytest.mark.parametrize("counters", [UserCounters(), SharedUserCounters(slots=8)])
+def test_user_counters(counters):
+    assert counters["user"] == 0
+    assert counters.acquire("user", 2)
+    assert counters.acquire("user", 2)
+    assert not counters.acquire("user", 2)
+    assert counters.acquire("other", 2)
+    assert counters["user"] == 2
+    assert counters["other"] == 1
+
+    counters.release("user")
+    assert counters["user"] == 1
+    counters.release("user")
+    counters.release("user")
+    assert counters["user"] == 0
+    counters.release("unknown")
+    assert counters["unknown"] == 0
+
+
+def test_shared_user_counters_full():
+    counters = SharedUserCounters(slots=2)
+    assert counters.acquire("user1", 1)
+    assert counters.acquire("user2", 1)
+    # Table is full: no limit
+    assert counters.acquire("user3", 1)
+    assert counters["user3"] == 0
+
+    # Slot of a user without websocket is reused
+    counters.release("user1")
+    assert counters.acquire("user3", 1)
+    assert not counters.acquire("user3", 1)
+    assert counters["user2"] == 1
+    assert counters["user1"] == 0
+
+
+def _acquire(counters, results):
+    results.put([counters.acquire("user", 10) for _ in range(10)])
+
+
+def test_shared_user_counters_processes():
+    counters = SharedUserCounters()
+    results = multiprocessing.get_context("fork").Queue()
+    processes = [
+        multiprocessing.get_context("fork").Process(
+            target=_acquire, args=(counters, results)
+        )
+        for _ in range(3)
+    ]
+    for process in processes:
+        process.start()
+    acquired = sum(sum(results.get(timeout=10)) for _ in processes)
+    for process in processes:
+        process.join()
+    assert acquired == 10
+    assert counters["user"] == 10
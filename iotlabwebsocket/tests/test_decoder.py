@@ -0,0 +1,37 @@
+"""iotlabwebsocket node decoder tests."""
+# -*- coding: utf-8 -*-
+
+from iotlabwebsocket.decoder import NodeDecoder
+
+
+def test_decoder_split_character():
+    decoder = NodeDecoder()
+    data = "aé°".encode("utf-8")
+
+    # Multi-byte characters split between chunks are not lost
+    assert decoder.decode(data[:2]) == "a"
+    assert decoder.decode(data[2:4]) == "é"
+    assert decoder.decode(memoryview(data)[4:]) == "°"
+
+
+def test_decoder_invalid():
+    decoder = NodeDecoder()
+    assert decoder.decode(b"\xaa\xbb\xcc\xff") is None
+
+    # Decoder is usable again after invalid data
+    assert decoder.decode("é".encode("utf-8")) == "é"
+
+
+def test_decoder_lines():
+    decoder = NodeDecoder()
+    assert decoder.lines("abc") == []
+    assert decoder.lines("def\nghi\r\n") == ["abcdef", "ghi"]
+    assert decoder.lines("\n\nj") == ["", ""]
+    assert decoder.lines("\n") == ["j"]
+
+
+def test_decoder_long_lines():
+    decoder = NodeDecoder(max_line_length=4)
+    assert decoder.lines("abc") == []
+    assert decoder.lines("defghij") == ["abcd", "efgh"]
+    assert decoder.lines("\n") == ["ij"]
@@ -0,0 +1,96 @@
+"""iotlabwebsocket listening sockets handover tests."""
+
+import os
+import socket
+
+import mock
+
+from iotlabwebsocket.listeners import (
+    INHERITED_FDS,
+    SERVICE_COMMAND,
+    bind_sockets,
+    inherited_sockets,
+    notify_main_pid,
+    spawn_successor,
+)
+
+
+def test_inherited_sockets():
+    listener = socket.socket()
+    listener.bind(("localhost", 0))
+    listener.listen()
+    fd = os.dup(listener.fileno())
+    with mock.patch.dict(os.environ, {INHERITED_FDS: str(fd)}):
+        sockets = inherited_sockets()
+        assert INHERITED_FDS not in os.environ
+    assert [sock.fileno() for sock in sockets] == [fd]
+    assert sockets[0].getsockname() == listener.getsockname()
+    sockets[0].close()
+    listener.close()
+
+
+def test_inherited_sockets_notify(tmpdir):
+    # Process started by a previous one becomes the main process of systemd
+    notify = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    notify.bind(str(tmpdir.join("notify")))
+    listener = socket.socket()
+    env = {
+        INHERITED_FDS: str(os.dup(listener.fileno())),
+        "NOTIFY_SOCKET": str(tmpdir.join("notify")),
+    }
+    with mock.patch.dict(os.environ, env):
+        sockets = inherited_sockets()
+    assert notify.recv(64) == "MAINPID={}".format(os.getpid()).encode()
+    for sock in sockets + [listener, notify]:
+        sock.close()
+
+
+def test_notify_main_pid():
+    notify = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    notify.bind("\0iotlabwebsocket-test-{}".format(os.getpid()))
+    env = {"NOTIFY_SOCKET": "@iotlabwebsocket-test-{}".format(os.getpid())}
+    with mock.patch.dict(os.environ, env):
+        notify_main_pid()
+    assert notify.recv(64) == "MAINPID={}".format(os.getpid()).encode()
+    notify.close()
+
+    # Nothing is done without systemd, or when it is gone
+    with mock.patch.dict(os.environ, env):
+        notify_main_pid()
+    with mock.patch.dict(os.environ, {"NOTIFY_SOCKET": ""}):
+        notify_main_pid()
+
+
+def test_inherited_sockets_systemd():
+    # Sockets of another process are ignored
+    env = {"LISTEN_PID": str(os.getpid() + 1), "LISTEN_FDS": "1"}
+    with mock.patch.dict(os.environ, env):
+        assert inherited_sockets() == []
+        assert "LISTEN_FDS" not in os.environ
+
+    with mock.patch.dict(os.environ, {"LISTEN_PID": str(os.getpid())}):
+        with mock.patch("socket.socket") as socket_mock:
+            os.environ["LISTEN_FDS"] = "2"
+            sockets = inherited_sockets()
+    assert len(sockets) == 2
+    assert socket_mock.call_args_list == [
+        mock.call(fileno=3),
+        mock.call(fileno=4),
+    ]
+
+
+@mock.patch("tornado.netutil.bind_sockets")
+def test_bind_sockets(tornado_bind_sockets):
+    assert bind_sockets(8000) is tornado_bind_sockets.return_value
+    tornado_bind_sockets.assert_called_once_with(8000, None)
+
+
+@mock.patch("subprocess.Popen")
+def test_spawn_successor(popen):
+    sockets = [mock.Mock(**{"fileno.return_value": fd}) for fd in (5, 6)]
+    spawn_successor(sockets, ["--port", "8000"])
+
+    args, kwargs = popen.call_args
+    assert args[0][1:] == ["-c", SERVICE_COMMAND, "--port", "8000"]
+    assert kwargs["pass_fds"] == [5, 6]
+    assert kwargs["env"][INHERITED_FDS] == "5,6"
@@ -0,0 +1,109 @@
+"""iotlabwebsocket metrics tests."""
+
+import pytest
+
+from iotlabwebsocket.metrics import Counter, Gauge, Histogram, Metrics, node_class
+
+
+def test_counter():
+    counter = Counter(
+        "test_total", "Test counter.", labels=("direction",), values=(("in", "out"),)
+    )
+    value = counter.labels("in")
+    value.inc()
+    value.inc(2)
+    assert counter.labels("in") is value
+    with pytest.raises(KeyError):
+        counter.labels("unknown")
+    assert counter.render() == (
+        "# HELP test_total Test counter.\n"
+        "# TYPE test_total counter\n"
+        'test_total{direction="in"} 3\n'
+        'test_total{direction="out"} 0'
+    )
+
+
+def test_gauge_without_labels():
+    gauge = Gauge("test", "Test gauge.")
+    gauge.labels().inc(5)
+    gauge.labels().dec()
+    assert gauge.render().splitlines()[-1] == "test 4"
+
+
+def test_capped_labels():
+    counter = Counter("test_total", "Test.", labels=("node", "dir"), max_values=2)
+    counter.labels("node-1", "in").inc()
+    counter.labels("node-2", "in").inc()
+    counter.labels("node-2", "out").inc()
+    # Nodes above the limit are counted together
+    other = counter.labels("node-3", "in")
+    assert counter.labels("node-4", "in") is other
+    other.inc(2)
+    assert counter.labels("node-1", "out") is not other
+    assert counter.render().splitlines()[2:] == [
+        'test_total{node="node-1",dir="in"} 1',
+        'test_total{node="node-2",dir="in"} 1',
+        'test_total{node="node-2",dir="out"} 1',
+        'test_total{node="other",dir="in"} 2',
+        'test_total{node="node-1",dir="out"} 0',
+    ]
+
+
+def test_histogram():
+    histogram = Histogram("test_seconds", "Test.", (0.1, 1))
+    value = histogram.labels()
+    for observed in (0.05, 0.1, 0.5, 2):
+        value.observe(observed)
+    assert histogram.render().splitlines()[2:] == [
+        'test_seconds_bucket{le="0.1"} 2',
+        'test_seconds_bucket{le="1"} 3',
+        'test_seconds_bucket{le="+Inf"} 4',
+        "test_seconds_sum 2.65",
+        "test_seconds_count 4",
+    ]
+    value.reset()
+    assert histogram.render().splitlines()[-1] == "test_seconds_count 0"
+
+
+def test_metrics_render():
+    metrics = Metrics(max_nodes=1)
+    collected = []
+    metrics.add_collector(lambda: collected.append(True))
+    text = metrics.render()
+    assert collected == [True]
+    assert text.endswith("\n")
+    assert 'iotlabwebsocket_websockets{endpoint="raw"} 0' in text
+    assert "# TYPE iotlabwebsocket_api_request_seconds histogram" in text
+
+    # Samples of a worker are labelled with its index
+    text = Metrics(worker=2).render()
+    assert 'iotlabwebsocket_websockets{worker="2",endpoint="raw"} 0' in text
+    assert 'iotlabwebsocket_node_throttles_total{worker="2"} 0' in text
+
+
+def test_histogram_quantile():
+    histogram = Histogram("test_seconds", "Test.", (1, 2, 4)).labels()
+    assert histogram.quantile(0.5) is None
+    for observed in (0.5, 1.5, 1.5, 3):
+        histogram.observe(observed)
+    assert histogram.count == 4
+    assert histogram.quantile(0.25) == 1
+    assert histogram.quantile(0.5) == 1.5
+    assert histogram.quantile(1) == 4
+    # Values above the last bucket are estimated at its bound
+    histogram.observe(10)
+    assert histogram.quantile(1) == 4
+
+
+@pytest.mark.parametrize(
+    "node,name",
+    [
+        ("m3-12", "m3"),
+        ("st-lrwan1-2", "st-lrwan1"),
+        ("a8-1", "a8"),
+        ("localhost", "localhost"),
+        ("12", "12"),
+    ],
+)
+def test_node_class(node, name):
+    assert node_class(node) == name
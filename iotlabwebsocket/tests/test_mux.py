@@ -0,0 +1,30 @@
+"""iotlabwebsocket multiplexed frames tests."""
+
+import pytest
+
+from iotlabwebsocket import mux
+
+
+def test_mux_frames():
+    frame = mux.encode(258, mux.INPUT, b"data")
+    assert frame == b"\x01\x02\x03data"
+    assert mux.decode(frame) == (258, mux.INPUT, b"data")
+    assert mux.decode(mux.encode(1, mux.UNSUBSCRIBE)) == (1, mux.UNSUBSCRIBE, b"")
+
+
+@pytest.mark.parametrize(
+    "frame", [b"\x00", "\x00\x01\x03text", mux.encode(1, mux.OUTPUT, b"data")]
+)
+def test_mux_invalid_frames(frame):
+    with pytest.raises(ValueError):
+        mux.decode(frame)
+
+
+def test_mux_broadcast():
+    payload = mux.encode_broadcast("m3-1, m3-*,", b"data")
+    assert payload == b"\x00\x0bm3-1, m3-*,data"
+    assert mux.decode_broadcast(payload) == (["m3-1", "m3-*"], b"data")
+    assert mux.decode(mux.encode(1, mux.BROADCAST, payload))[1] == mux.BROADCAST
+    for payload in (b"\x00", b"\x00\x05m3"):
+        with pytest.raises(ValueError):
+            mux.decode_broadcast(payload)
@@ -0,0 +1,92 @@
+"""iotlabwebsocket recorder tests."""
+
+import os
+
+import mock
+import pytest
+
+from iotlabwebsocket.recorder import (
+    Recorder,
+    read_recording,
+    NODE_INPUT,
+    NODE_OUTPUT,
+)
+
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+def test_recorder(tmpdir, use_mmap):
+    recorder = Recorder(str(tmpdir))
+    recorder.open("node-1", "123")
+    recorder.record("node-1", NODE_OUTPUT, b"hello")
+    recorder.record("node-1", NODE_INPUT, memoryview(b"reset"))
+    recorder.record("node-1", NODE_OUTPUT, b"world")
+    # Nodes not opened are not recorded
+    recorder.record("node-2", NODE_OUTPUT, b"ignored")
+    recorder.close("node-1").result()
+
+    path = recorder.path("123", "node-1")
+    records = list(read_recording(path, use_mmap))
+    assert [(direction, payload) for _, direction, payload in records] == [
+        (NODE_OUTPUT, b"hello"),
+        (NODE_INPUT, b"reset"),
+        (NODE_OUTPUT, b"world"),
+    ]
+    timestamps = [timestamp for timestamp, _, _ in records]
+    assert timestamps == sorted(timestamps)
+    assert not os.path.exists(recorder.path("123", "node-2"))
+    assert not list(read_recording(recorder.path("123", "node-2"), use_mmap))
+    recorder.stop()
+
+
+def test_recorder_segments(tmpdir):
+    recorder = Recorder(str(tmpdir), segment_size=10)
+    recorder.open("node-1", "123")
+    for index in range(3):
+        recorder.record("node-1", NODE_OUTPUT, b"data")
+        recorder.flush()
+    recorder.close("node-1").result()
+
+    # Recording is reopened in a new segment
+    recorder.open("node-1", "123")
+    recorder.record("node-1", NODE_OUTPUT, b"more")
+    recorder.stop()
+
+    path = recorder.path("123", "node-1")
+    assert sorted(os.listdir(path)) == [
+        "00000000.rec",
+        "00000001.rec",
+        "00000002.rec",
+        "00000003.rec",
+    ]
+    assert [payload for _, _, payload in read_recording(path)] == [b"data"] * 3 + [
+        b"more"
+    ]
+
+
+def test_recorder_truncated(tmpdir):
+    recorder = Recorder(str(tmpdir))
+    recorder.open("node-1", "123")
+    recorder.record("node-1", NODE_OUTPUT, b"complete")
+    recorder.record("node-1", NODE_OUTPUT, b"interrupted")
+    recorder.stop()
+
+    path = recorder.path("123", "node-1")
+    segment = os.path.join(path, "00000000.rec")
+    with open(segment, "rb+") as segment_file:
+        segment_file.truncate(os.path.getsize(segment) - 2)
+    assert [payload for _, _, payload in read_recording(path)] == [b"complete"]
+
+
+@mock.patch("iotlabwebsocket.recorder.READ_SIZE", 8)
+def test_recorder_chunks(tmpdir):
+    recorder = Recorder(str(tmpdir))
+    recorder.open("node-1", "123")
+    payloads = [b"a", b"larger than a chunk", b"b"]
+    for payload in payloads:
+        recorder.record("node-1", NODE_OUTPUT, payload)
+    recorder.close("node-1").result()
+    recorder.stop()
+
+    # Records spanning several chunks are read whole
+    path = recorder.path("123", "node-1")
+    assert [payload for _, _, payload in read_recording(path)] == payloads
@@ -0,0 +1,41 @@
+"""iotlabwebsocket scrollback tests."""
+
+from iotlabwebsocket.scrollback import RingBuffer
+
+
+def test_ring_buffer():
+    ring = RingBuffer(8)
+    assert len(ring) == 0
+    assert ring.read() == b""
+
+    ring.write(b"abc")
+    ring.write(memoryview(b"def"))
+    assert len(ring) == 6
+    assert ring.read() == b"abcdef"
+
+    # Oldest bytes are overwritten
+    ring.write(b"ghij")
+    assert len(ring) == 8
+    assert ring.read() == b"cdefghij"
+    ring.write(b"k")
+    assert ring.read() == b"defghijk"
+
+
+def test_ring_buffer_large_write():
+    ring = RingBuffer(4)
+    ring.write(b"ab")
+    ring.write(b"0123456789")
+    assert ring.read() == b"6789"
+    ring.write(b"x")
+    assert ring.read() == b"789x"
+
+
+def test_ring_buffer_lines():
+    ring = RingBuffer(32)
+    ring.write(b"line1\nline2\nline3\n")
+    assert ring.read(lines=2) == b"line2\nline3\n"
+    assert ring.read(lines=10) == b"line1\nline2\nline3\n"
+
+    # Partial line counts as a line
+    ring.write(b"li")
+    assert ring.read(lines=2) == b"line3\nli"
@@ -1,13 +1,69 @@
 """iotlabwebsocket service cli tests."""
 
+import asyncio
 import os
 import os.path
+import signal
+import subprocess
 import unittest
 
 import mock
+import pytest
 
 from iotlabwebsocket.api import ApiClient
 from iotlabwebsocket.service_cli import main
+from iotlabwebsocket.counters import SharedUserCounters
+from iotlabwebsocket.broadcast import (
+    COMPRESSION_LEVEL,
+    COMPRESSION_MEM_LEVEL,
+    COMPRESSION_MIN_SIZE,
+)
+from iotlabwebsocket.clients.tcp_client import (
+    NODE_RATE,
+    NODE_BURST,
+    NODE_RECONNECT_WINDOW,
+    WRITE_HIGH_WATER,
+    WRITE_LOW_WATER,
+)
+from iotlabwebsocket.coalescer import MAX_FRAME_SIZE, MAX_FRAME_DELAY, MAX_BUFFERED_BYTES
+from iotlabwebsocket.metrics import MAX_NODE_LABELS
+from iotlabwebsocket.parser import service_cli_parser
+from iotlabwebsocket.scrollback import SCROLLBACK_SIZE, SCROLLBACK_BUDGET
+from iotlabwebsocket.web_application import HANDSHAKE_TIMEOUT, MAX_LINGERING_NODES
+
+INIT_SCRIPT = os.path.join(os.path.dirname(__file__), "..", "..", "init.sh")
+
+DEFAULT_SETTINGS = dict(
+    node_rate=NODE_RATE,
+    node_burst=NODE_BURST,
+    node_disconnect_after=None,
+    node_zero_copy=False,
+    node_reconnect_window=NODE_RECONNECT_WINDOW,
+    node_linger=0,
+    node_linger_policy="drop",
+    node_linger_max=MAX_LINGERING_NODES,
+    node_write_high_water=WRITE_HIGH_WATER,
+    node_write_low_water=WRITE_LOW_WATER,
+    node_write_policy="pause",
+    node_address_preload=False,
+    scrollback_size=SCROLLBACK_SIZE,
+    scrollback_lines=None,
+    scrollback_budget=SCROLLBACK_BUDGET,
+    coalesce_max_size=MAX_FRAME_SIZE,
+    coalesce_max_delay=MAX_FRAME_DELAY,
+    record_dir=None,
+    record_mmap=False,
+    compression="off",
+    compression_level=COMPRESSION_LEVEL,
+    compression_mem_level=COMPRESSION_MEM_LEVEL,
+    compression_min_size=COMPRESSION_MIN_SIZE,
+    output_buffer_max=MAX_BUFFERED_BYTES,
+    output_buffer_policy="drop",
+    metrics=False,
+    metrics_max_nodes=MAX_NODE_LABELS,
+    latency_sample_rate=0,
+    handshake_timeout=HANDSHAKE_TIMEOUT,
+)
 
 
 @mock.patch("iotlabwebsocket.web_application.WebApplication.stop")
@@ -26,7 +82,7 @@ class ServiceCliTest(unittest.TestCase):
         args, kwargs = init.call_args
         assert len(args) == 1
         assert args[0] == default_api
-        assert kwargs == dict(use_local_api=False, token="")
+        assert kwargs == dict(use_local_api=False, token="", **DEFAULT_SETTINGS)
         listen.assert_called_with("8000")
 
     def test_main_service_cli_args(self, ioloop, init, listen, stop_app):
@@ -53,7 +109,7 @@ class ServiceCliTest(unittest.TestCase):
         args, kwargs = init.call_args
         assert len(args) == 1
         assert args[0] == api_test
-        assert kwargs == dict(use_local_api=True, token=token_test)
+        assert kwargs == dict(use_local_api=True, token=token_test, **DEFAULT_SETTINGS)
         listen.assert_called_with(port_test)
 
     def test_main_service_http(self, ioloop, init, listen, stop_app):
@@ -67,9 +123,34 @@ class ServiceCliTest(unittest.TestCase):
         args, kwargs = init.call_args
         assert len(args) == 1
         assert args[0] == http_api
-        assert kwargs == dict(use_local_api=False, token="")
+        assert kwargs == dict(use_local_api=False, token="", **DEFAULT_SETTINGS)
         listen.assert_called_with("8000")
 
+    def test_main_service_api_cache(self, ioloop, init, listen, stop_app):
+        init.return_value = None
+        main(["--api-cache-size", "10", "--api-cache-ttl", "0", "--api-timeout", "2"])
+
+        args, _ = init.call_args
+        assert args[0] == ApiClient("https", cache_size=10, cache_ttl=0, timeout=2)
+        assert args[0] != ApiClient("https")
+
+    def test_main_service_node_rate(self, ioloop, init, listen, stop_app):
+        init.return_value = None
+        args = [
+            "--node-rate",
+            "1000",
+            "--node-burst",
+            "2000",
+            "--node-disconnect-after",
+            "10",
+        ]
+        main(args)
+
+        _, kwargs = init.call_args
+        assert kwargs["node_rate"] == 1000
+        assert kwargs["node_burst"] == 2000
+        assert kwargs["node_disconnect_after"] == 10
+
     @mock.patch("iotlabwebsocket.service_cli.setup_server_logger")
     def test_main_service_logging(self, setup_logger, ioloop, init, listen, stop_app):
         init.return_value = None
@@ -80,6 +161,56 @@ class ServiceCliTest(unittest.TestCase):
         ioloop.assert_called_once()  # for the start
         setup_logger.assert_called_with(log_file=log_file_test, log_console=True)
 
+    @mock.patch(
+        "iotlabwebsocket.web_application.WebApplication.drain",
+        new_callable=mock.AsyncMock,
+    )
+    @mock.patch(
+        "iotlabwebsocket.web_application.WebApplication.restart",
+        new_callable=mock.AsyncMock,
+    )
+    def test_main_service_signals(
+        self, restart, drain, ioloop, init, listen, stop_app
+    ):
+        init.return_value = None
+        main(["--drain-timeout", "10", "--retry-after", "3"])
+
+        io_loop = ioloop.return_value
+        handlers = {
+            args[0]: args[1:]
+            for args, _ in io_loop.asyncio_loop.add_signal_handler.call_args_list
+        }
+        assert set(handlers) == {signal.SIGTERM, signal.SIGHUP}
+        for signum in (signal.SIGTERM, signal.SIGHUP):
+            spawn, shutdown, restarting = handlers[signum]
+            assert spawn == io_loop.spawn_callback
+            with mock.patch(
+                "iotlabwebsocket.web_application.WebApplication.draining",
+                None,
+                create=True,
+            ):
+                asyncio.run(shutdown(restarting))
+        drain.assert_awaited_once_with(10, 3)
+        restart.assert_awaited_once_with(10, 3)
+        assert io_loop.stop.call_count == 2
+
+    @mock.patch("asyncio.set_event_loop_policy")
+    def test_main_service_event_loop(
+        self, set_policy, ioloop, init, listen, stop_app
+    ):
+        init.return_value = None
+        main([])
+        set_policy.assert_not_called()
+
+        uvloop = mock.Mock()
+        with mock.patch.dict("sys.modules", {"uvloop": uvloop}):
+            main(["--event-loop", "uvloop"])
+        set_policy.assert_called_once_with(uvloop.EventLoopPolicy.return_value)
+
+        with mock.patch.dict("sys.modules", {"uvloop": None}):
+            with self.assertRaises(SystemExit):
+                main(["--event-loop", "uvloop"])
+
     def test_main_service_exit(self, ioloop, init, listen, stop_app):
         init.return_value = None
         listen.side_effect = KeyboardInterrupt
@@ -120,5 +251,49 @@ class ServiceCliTest(unittest.TestCase):
         args, kwargs = init.call_args
         assert len(args) == 1
         assert args[0] == api_test
-        assert kwargs == dict(use_local_api=True, token=token_test)
+        assert kwargs == dict(use_local_api=True, token=token_test, **DEFAULT_SETTINGS)
         listen.assert_called_with(port_test)
+
+
+@mock.patch("iotlabwebsocket.service_cli.run_workers")
+@mock.patch("iotlabwebsocket.service_cli.WebApplication")
+def test_main_service_workers(web_application, run_workers):
+    main(["--workers", "4", "--port", "8082"])
+
+    web_application.assert_not_called()
+    count, port, make_application = run_workers.call_args[0]
+    assert (count, port) == (4, "8082")
+    assert run_workers.call_args[1] == dict(drain_timeout=30, retry_after=5)
+
+    # Applications of the workers share the user counters
+    make_application(0)
+    make_application(1)
+    (_, first), (_, second) = web_application.call_args_list
+    user_counters = first.pop("user_counters")
+    assert isinstance(user_counters, SharedUserCounters)
+    assert first.pop("worker") == 0
+    assert first == dict(use_local_api=False, token="", **DEFAULT_SETTINGS)
+    assert second["user_counters"] is user_counters
+    assert second["worker"] == 1
+
+
+@pytest.mark.skipif(not os.path.exists(INIT_SCRIPT), reason="no init.sh")
+def test_init_script(tmpdir):
+    # Prints the parent process and the arguments of the service
+    python = tmpdir.join("python3")
+    python.write('#!/bin/sh\necho $PPID "$@"\n')
+    python.chmod(0o755)
+    env = dict(os.environ, PATH="{}:{}".format(tmpdir, os.environ["PATH"]))
+    output = subprocess.check_output(["bash", INIT_SCRIPT], env=env).split()
+
+    # Service replaces the script: it gets the signals of the container
+    assert int(output[0]) == os.getpid()
+    assert output[1] == b"/usr/local/bin/iotlab-websocket-service"
+    args = service_cli_parser().parse_args([arg.decode() for arg in output[2:]])
+    assert args.workers == 1
+    assert args.port == "8080"
+
+    env["WORKERS"] = "4"
+    output = subprocess.check_output(["bash", INIT_SCRIPT], env=env).split()
+    args = service_cli_parser().parse_args([arg.decode() for arg in output[2:]])
+    assert args.workers == 4
@@ -0,0 +1,114 @@
+"""iotlabwebsocket session registry tests."""
+
+import mock
+
+from iotlabwebsocket.sessions import NodeSession, SessionRegistry
+
+
+def _websocket(node="node-1", user="user", read_only=False):
+    return mock.Mock(node=node, user=user, site="local", read_only=read_only)
+
+
+def test_session_slots():
+    session = NodeSession("node-1", mock.Mock())
+    assert not hasattr(session, "__dict__")
+    assert not session.lingering
+
+
+def test_registry_attach_detach():
+    registry = SessionRegistry()
+    websockets = [_websocket() for _ in range(3)]
+    assert registry.get("node-1") is None
+    assert registry.websockets("node-1") == []
+
+    session = registry.open("node-1", mock.Mock())
+    for websocket in websockets:
+        assert registry.reserve(websocket, 10, 10) is None
+        registry.attach(session, websocket)
+    assert len(registry) == 1
+    assert registry.websockets("node-1") == websockets
+    assert registry.users["user"] == 3
+
+    # Websockets are detached in any order, only once
+    assert registry.detach(websockets[1]) is session
+    assert registry.detach(websockets[1]) is None
+    assert registry.websockets("node-1") == [websockets[0], websockets[2]]
+    assert registry.users["user"] == 2
+
+    assert registry.close("node-1") is session
+    assert registry.close("node-1") is None
+    assert not len(registry)
+
+
+def test_registry_limits():
+    registry = SessionRegistry()
+    session = registry.open("node-1", mock.Mock())
+    websocket = _websocket()
+    assert registry.reserve(websocket, 1, 2) is None
+    registry.attach(session, websocket)
+
+    # Refused websockets are not counted
+    assert registry.reserve(_websocket(), 1, 2) == (
+        "Cannot open more than 1 connections to node node-1."
+    )
+    assert registry.users["user"] == 1
+    assert registry.reserve(_websocket("node-2"), 1, 2) is None
+    assert registry.reserve(_websocket("node-3"), 1, 2) == (
+        "Max number of connections (2) reached for user user on site local."
+    )
+    assert registry.users["user"] == 2
+
+    # Users without websocket are forgotten
+    registry.detach(websocket)
+    registry.users.release("user")
+    assert not registry.users._counts
+
+
+def test_registry_read_only():
+    registry = SessionRegistry()
+    session = registry.open("node-1", mock.Mock())
+    aggregated = _websocket(read_only=True)
+    assert registry.reserve(aggregated, None, None) is None
+    registry.attach(session, aggregated)
+
+    # Read-only websockets don't count for their node
+    websocket = _websocket()
+    assert registry.reserve(websocket, 1, None) is None
+    registry.attach(session, websocket)
+    assert registry.reserve(_websocket(), 1, None) is not None
+
+
+def test_registry_multiplexed():
+    registry = SessionRegistry()
+    assert registry.reserve_user("user", "local", 1) is None
+    session = registry.open("node-1", mock.Mock())
+    channels = [_websocket() for _ in range(2)]
+    # Channels of a multiplexed websocket are only counted with it
+    for channel in channels:
+        assert registry.reserve(channel, 2, None) is None
+        registry.attach(session, channel)
+    assert registry.reserve(_websocket(), 2, None) is not None
+    assert registry.users["user"] == 1
+
+    assert registry.detach(channels[0], release_user=False) is session
+    assert registry.users["user"] == 1
+    registry.release_user("user")
+    assert registry.users["user"] == 0
+
+
+def test_registry_linger():
+    registry = SessionRegistry()
+    sessions = [registry.open(node, mock.Mock()) for node in ("node-1", "node-2")]
+    for session in sessions:
+        registry.linger(session, "timeout", bytearray())
+    assert sessions[0].lingering
+    assert registry.oldest_lingering() is sessions[0]
+
+    assert registry.unlinger(sessions[0]) == ("timeout", bytearray())
+    assert not sessions[0].lingering
+    assert sessions[0].linger_buffer is None
+    assert registry.oldest_lingering() is sessions[1]
+
+    # Closed sessions don't linger
+    registry.close("node-2")
+    assert not registry.lingering
@@ -2,13 +2,14 @@
 # -*- coding: utf-8 -*-
 
 import sys
-import math
+import socket
 
 import mock
 
 from tornado.tcpserver import TCPServer
 from tornado.iostream import StreamClosedError
 from tornado import gen
+from tornado.concurrent import Future
 
 from tornado.testing import AsyncTestCase, gen_test, bind_unused_port
 
@@ -16,7 +17,7 @@ from iotlabwebsocket.clients.tcp_client import (
     TCPClient,
     NODE_TCP_PORT,
     CHUNK_SIZE,
-    MAX_BYTES_RECEIVED_PER_PERIOD,
+    MAX_CHUNK_SIZE,
 )
 
 
@@ -36,10 +37,19 @@ class TCPServerStub(TCPServer):
                 break
 
 
+class SlowTCPServerStub(TCPServer):
+
+    stream = None
+
+    def handle_stream(self, stream, address):
+        # Don't read anything until asked
+        self.stream = stream
+
+
 class NodeHandlerTest(AsyncTestCase):
     @gen_test
     def test_tcp_connection(self):
-        client = TCPClient()
+        client = TCPClient(reconnect_window=0)
 
         sock, _ = bind_unused_port()
         server = TCPServerStub()
@@ -69,10 +79,12 @@ class NodeHandlerTest(AsyncTestCase):
         on_data.assert_called_with("localhost", message)
         on_data.call_count = 0
 
+        # Read size grew after the previous full chunk
         message = b"a" * (CHUNK_SIZE + 1)
         server.stream.write(message)
         yield gen.sleep(0.01)
-        assert on_data.call_count == 2
+        on_data.assert_called_once()
+        on_data.assert_called_with("localhost", message)
         on_data.call_count = 0
 
         # Raw bytes data are correctly sent to the connected websockets
@@ -123,7 +135,7 @@ class NodeHandlerTest(AsyncTestCase):
 
     @gen_test
     def test_tcp_too_fast(self):
-        client = TCPClient()
+        client = TCPClient(rate=10000, burst=2000)
 
         sock, _ = bind_unused_port()
         server = TCPServerStub()
@@ -138,18 +150,239 @@ class NodeHandlerTest(AsyncTestCase):
         assert client.ready
         assert client.node == "localhost"
 
-        # String is sent via websocket character by character
-        message = b"A" * MAX_BYTES_RECEIVED_PER_PERIOD
+        # The node bursts above its rate: reading is paused, not closed
+        server.stream.write(b"A" * 4000)
+        yield gen.sleep(0.05)
+        received = sum(len(args[1]) for args, _ in on_data.call_args_list)
+        assert received < 4000
+        assert client.stats["throttled_time"] > 0
+        assert client.stats["deferred_bytes"] > 0
+        assert client.stats["throttles"] == 1
+
+        # Throttled bytes are delivered once the node is back under its rate
+        yield gen.sleep(0.3)
+        received = sum(len(args[1]) for args, _ in on_data.call_args_list)
+        assert received == 4000
+        on_close.assert_not_called()
+        assert client.ready
+
+    @gen_test
+    def test_tcp_too_fast_disconnect(self):
+        client = TCPClient(rate=10000, burst=CHUNK_SIZE, disconnect_after=0.05)
+
+        sock, _ = bind_unused_port()
+        server = TCPServerStub()
+        server.add_socket(sock)
+        server.listen(NODE_TCP_PORT)
+
+        on_close = mock.Mock()
+        on_data = mock.Mock()
+
+        yield client.start("localhost", on_data, on_close)
+        assert client.ready
+
+        # Node is throttled for longer than allowed, it is disconnected
+        server.stream.write(b"A" * 4 * CHUNK_SIZE)
+        yield gen.sleep(0.3)
+        on_close.assert_called_once()
+        _, kwargs = on_close.call_args
+        assert kwargs == dict(reason="Node localhost is sending too fast")
+
+    @gen_test
+    def test_tcp_no_rate_limit(self):
+        client = TCPClient(rate=0)
+
+        sock, _ = bind_unused_port()
+        server = TCPServerStub()
+        server.add_socket(sock)
+        server.listen(NODE_TCP_PORT)
+
+        on_close = mock.Mock()
+        on_data = mock.Mock()
+
+        yield client.start("localhost", on_data, on_close)
+        server.stream.write(b"A" * 100 * CHUNK_SIZE)
+        yield gen.sleep(0.1)
+        received = sum(len(args[1]) for args, _ in on_data.call_args_list)
+        assert received == 100 * CHUNK_SIZE
+        assert client.stats == dict(
+            throttled_time=0, throttles=0, deferred_bytes=0, queued_bytes=0
+        )
+
+    def test_tcp_sample_reads(self):
+        client = TCPClient(sample_interval=3)
+        read_times = []
+        for _ in range(6):
+            client._sample_read()
+            read_times.append(client.read_time)
+        assert [read_time is not None for read_time in read_times] == [
+            False,
+            False,
+            True,
+        ] * 2
+
+    @gen_test
+    def test_tcp_pause(self):
+        client = TCPClient(rate=0)
+
+        sock, _ = bind_unused_port()
+        server = TCPServerStub()
+        server.add_socket(sock)
+        server.listen(NODE_TCP_PORT)
+
+        resume = Future()
+        on_data = mock.Mock(side_effect=lambda *_: client.pause(resume))
+
+        yield client.start("localhost", on_data, mock.Mock())
+        server.stream.write(b"A")
+        yield gen.sleep(0.1)
+        server.stream.write(b"B")
+        yield gen.sleep(0.1)
+        # Node is not read until resumed
+        assert on_data.call_count == 1
+        resume.set_result(None)
+        yield gen.sleep(0.1)
+        assert on_data.call_count == 2
+
+    @gen_test
+    def test_tcp_zero_copy(self):
+        client = TCPClient(rate=0, zero_copy=True)
+
+        sock, _ = bind_unused_port()
+        server = TCPServerStub()
+        server.add_socket(sock)
+        server.listen(NODE_TCP_PORT)
+
+        received = []
+
+        def on_data(node, data):
+            assert isinstance(data, memoryview)
+            received.append(bytes(data))
+
+        on_close = mock.Mock()
+
+        yield client.start("localhost", on_data, on_close)
+        message = b"Hello\nWorld"
         server.stream.write(message)
         yield gen.sleep(0.01)
-        assert (
-            on_data.call_count
-            == (math.floor(MAX_BYTES_RECEIVED_PER_PERIOD / CHUNK_SIZE)) + 1
+        assert received == [message]
+
+        # Reads grow with the node rate and are served from reused buffers
+        received.clear()
+        message = bytes(range(256)) * 1024
+        server.stream.write(message)
+        yield gen.sleep(0.1)
+        assert b"".join(received) == message
+        assert max(len(data) for data in received) > CHUNK_SIZE
+        assert max(len(data) for data in received) <= MAX_CHUNK_SIZE
+        assert len(client._buffers) <= 2
+
+    def test_tcp_chunk_size(self):
+        assert TCPClient._next_chunk_size(CHUNK_SIZE, CHUNK_SIZE) == 2 * CHUNK_SIZE
+        assert TCPClient._next_chunk_size(MAX_CHUNK_SIZE, MAX_CHUNK_SIZE) == (
+            MAX_CHUNK_SIZE
+        )
+        assert TCPClient._next_chunk_size(4 * CHUNK_SIZE, 10) == 2 * CHUNK_SIZE
+        assert TCPClient._next_chunk_size(CHUNK_SIZE, 10) == CHUNK_SIZE
+        assert TCPClient._next_chunk_size(4 * CHUNK_SIZE, 2 * CHUNK_SIZE) == (
+            4 * CHUNK_SIZE
+        )
+
+    @mock.patch("iotlabwebsocket.clients.tcp_client.RECONNECT_MIN_DELAY", 0.01)
+    @gen_test
+    def test_tcp_reconnection(self):
+        client = TCPClient(reconnect_window=1)
+
+        sock, _ = bind_unused_port()
+        server = TCPServerStub()
+        server.add_socket(sock)
+        server.listen(NODE_TCP_PORT)
+
+        on_close = mock.Mock()
+        on_data = mock.Mock()
+        on_status = mock.Mock()
+
+        yield client.start("localhost", on_data, on_close, on_status)
+        assert client.ready
+        sock_opt = client._tcp.socket.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+        assert sock_opt
+
+        # Connection is lost then restored, websockets are kept open
+        first_stream = server.stream
+        first_stream.close()
+        yield gen.sleep(0.1)
+        on_close.assert_not_called()
+        assert client.ready
+        assert server.stream is not first_stream
+        assert on_status.call_args_list == [
+            mock.call("localhost", "Connection to node localhost lost, reconnecting"),
+            mock.call("localhost", "Connection to node localhost restored"),
+        ]
+
+        # Restored connection forwards node output
+        server.stream.write(b"test")
+        yield gen.sleep(0.01)
+        on_data.assert_called_with("localhost", b"test")
+
+        # Node is gone for longer than the reconnection window
+        server.stop()
+        server.stream.close()
+        yield gen.sleep(1.2)
+        on_close.assert_called_once_with(
+            "localhost", "Connection to localhost is closed"
         )
-        yield gen.sleep(1)
-        server.stream.write(b"Too fast")
+        assert not client.ready
+
+    @mock.patch("iotlabwebsocket.clients.tcp_client.RECONNECT_MIN_DELAY", 0.01)
+    @gen_test
+    def test_tcp_reconnection_stopped(self):
+        client = TCPClient(reconnect_window=1)
+
+        sock, _ = bind_unused_port()
+        server = TCPServerStub()
+        server.add_socket(sock)
+        server.listen(NODE_TCP_PORT)
+
+        on_close = mock.Mock()
+        yield client.start("localhost", mock.Mock(), on_close)
+        server.stop()
+        server.stream.close()
+        yield gen.sleep(0.05)
+
+        # Stopping the client cancels the reconnection
+        client.stop()
+        yield gen.sleep(1.2)
+        on_close.assert_not_called()
+        assert not client.ready
+
+    @gen_test
+    def test_tcp_write_backpressure(self):
+        client = TCPClient(write_high_water=1000, write_low_water=100)
+
+        sock, _ = bind_unused_port()
+        server = SlowTCPServerStub()
+        server.add_socket(sock)
+        server.listen(NODE_TCP_PORT)
+
+        yield client.start("localhost", mock.Mock(), mock.Mock())
+        assert client.writable
+        drained = client.drained()
+        assert drained.done()
+
+        # Bytes are queued until the node reads them
+        size = 32 * 1024 * 1024
+        client.send(b"a" * size)
+        assert client.queued_bytes > 0
+        assert client.stats["queued_bytes"] == client.queued_bytes
+        assert not client.writable
+        drained = client.drained()
         yield gen.sleep(0.01)
-        on_close.assert_called_once()
+        assert not drained.done()
+
+        yield server.stream.read_bytes(size)
+        yield drained
+        assert client.queued_bytes == 0
+        assert client.writable
 
     @gen_test
     def test_tcp_failed_connection(self):
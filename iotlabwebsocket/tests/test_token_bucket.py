@@ -0,0 +1,46 @@
+"""iotlabwebsocket token bucket tests."""
+
+from iotlabwebsocket.clients.token_bucket import TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket_burst():
+    clock = FakeClock()
+    bucket = TokenBucket(100, 50, clock=clock)
+
+    # Consuming within the burst size doesn't require waiting
+    assert bucket.consume(30) == 0
+    assert bucket.consume(20) == 0
+
+    # Bucket is now in debt
+    assert bucket.consume(10) == 0.1
+    assert bucket.tokens == -10
+
+
+def test_token_bucket_refill():
+    clock = FakeClock()
+    bucket = TokenBucket(100, 50, clock=clock)
+
+    assert bucket.consume(60) == 0.1
+    clock.now = 0.1
+    assert bucket.consume(10) == 0.1
+
+    # Refill never exceeds the burst size
+    clock.now = 10
+    assert bucket.consume(0) == 0
+    assert bucket.tokens == 50
+
+
+def test_token_bucket_reset():
+    clock = FakeClock()
+    bucket = TokenBucket(100, 50, clock=clock)
+    bucket.consume(200)
+    bucket.reset()
+    assert bucket.tokens == 50
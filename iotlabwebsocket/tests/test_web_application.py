@@ -3,34 +3,56 @@
 
 import json
 import sys
+import time
 
 import mock
 
 import tornado
 from tornado import gen
+from tornado.concurrent import Future
 from tornado.tcpserver import TCPServer
 from tornado.iostream import StreamClosedError
 from tornado.testing import AsyncHTTPTestCase, gen_test, bind_unused_port
 
+from iotlabwebsocket import mux
 from iotlabwebsocket.api import ApiClient
 from iotlabwebsocket.web_application import (
     WebApplication,
     MAX_WEBSOCKETS_PER_NODE,
     MAX_WEBSOCKETS_PER_USER,
 )
-from iotlabwebsocket.clients.tcp_client import NODE_TCP_PORT
+from iotlabwebsocket.clients.tcp_client import CHUNK_SIZE, NODE_TCP_PORT
+from iotlabwebsocket.broadcast import deflate
+from iotlabwebsocket.decoder import NodeDecoder
+from iotlabwebsocket.recorder import NODE_INPUT, NODE_OUTPUT
+from iotlabwebsocket.scrollback import SCROLLBACK_SIZE
+from iotlabwebsocket.sessions import SessionRegistry
+
+
+def sent_messages(websocket):
+    """Return the node output messages sent to a websocket mock."""
+    return [args[0].message for args, _ in websocket.send_node_output.call_args_list]
+
+
+def add_session(application, node, websockets=(), tcp_client=None):
+    """Add a node session with mocks to application."""
+    session = application.sessions.open(node, tcp_client or mock.Mock(read_time=None))
+    for websocket in websockets:
+        SessionRegistry.attach(session, websocket)
+    return session
 
 
 class TCPServerStub(TCPServer):
 
     stream = None
+    received = b""
 
     @gen.coroutine
     def handle_stream(self, stream, address):
         self.stream = stream
         while True:
             try:
-                yield self.stream.read_bytes(1)
+                self.received += yield self.stream.read_bytes(1)
             except StreamClosedError:
                 break
 
@@ -45,7 +67,7 @@ class TestWebApplication(AsyncHTTPTestCase):
         super(TestWebApplication, self).setUp()
         self.api.port = self.get_http_port()
 
-        assert len(self.application.websockets) == 0
+        assert len(self.application.sessions) == 0
 
     @mock.patch("iotlabwebsocket.clients.tcp_client.TCPClient.send")
     @mock.patch("iotlabwebsocket.clients.tcp_client.TCPClient.stop")
@@ -60,9 +82,9 @@ class TestWebApplication(AsyncHTTPTestCase):
             url, subprotocols=["user", "token", "token"]
         )
 
-        assert len(self.application.websockets["node-1"]) == 1
-        assert self.application.websockets["node-1"][0].user == "user"
-        assert self.application.websockets["node-1"][0].node == "node-1"
+        assert len(self.application.sessions.websockets("node-1")) == 1
+        assert self.application.sessions.websockets("node-1")[0].user == "user"
+        assert self.application.sessions.websockets("node-1")[0].node == "node-1"
 
         start.assert_called_once()
         args, kwargs = start.call_args
@@ -72,10 +94,12 @@ class TestWebApplication(AsyncHTTPTestCase):
         assert kwargs == dict(
             on_data=self.application.handle_tcp_data,
             on_close=self.application.handle_tcp_close,
+            on_status=self.application.handle_tcp_status,
+            site="local",
         )
 
         # Forcing TCP client to be ready, just for the test
-        self.application.tcp_clients["node-1"].ready = True
+        self.application.sessions.get("node-1").tcp_client.ready = True
 
         # another websocket connection for the same node doesn't start a new
         # TCP connection
@@ -85,8 +109,8 @@ class TestWebApplication(AsyncHTTPTestCase):
         )
 
         assert start.call_count == 0
-        assert len(self.application.websockets["node-1"]) == 2
-        for ws in self.application.websockets["node-1"]:
+        assert len(self.application.sessions.websockets("node-1")) == 2
+        for ws in self.application.sessions.websockets("node-1"):
             assert ws.user == "user"
             assert ws.node == "node-1"
 
@@ -96,7 +120,7 @@ class TestWebApplication(AsyncHTTPTestCase):
         # There's still a websocket connection opened, so TCP client is not
         # closed
         assert stop.call_count == 0
-        assert len(self.application.websockets["node-1"]) == 1
+        assert len(self.application.sessions.websockets("node-1")) == 1
 
         # Send some data
         websocket.write_message(b"test", binary=True)
@@ -110,8 +134,278 @@ class TestWebApplication(AsyncHTTPTestCase):
         yield gen.sleep(0.1)
 
         assert stop.call_count == 1
-        assert len(self.application.websockets["node-1"]) == 0
-        assert "node-1" not in self.application.tcp_clients
+        assert len(self.application.sessions.websockets("node-1")) == 0
+        assert self.application.sessions.get("node-1") is None
+
+    @mock.patch("iotlabwebsocket.clients.tcp_client.TCPClient.stop")
+    @mock.patch("iotlabwebsocket.clients.tcp_client.TCPClient.start")
+    @mock.patch("iotlabwebsocket.handlers.http_handler._nodes")
+    @gen_test
+    def test_tcp_linger(self, nodes, start, stop):
+        url = f"ws://localhost:{self.api.port}/ws/local/123/node-1/serial/raw"
+        nodes.return_value = json.dumps({"nodes": ["node-1.local"]})
+        self.application.settings["node_linger"] = 10
+        self.application.settings["node_linger_policy"] = "buffer"
+
+        websocket = yield tornado.websocket.websocket_connect(
+            url, subprotocols=["user", "token", "token"]
+        )
+        start.assert_called_once()
+        tcp_client = self.application.sessions.get("node-1").tcp_client
+        # Forcing TCP client to be ready, just for the test
+        tcp_client.ready = True
+
+        # Last websocket leaves: the TCP connection is kept open
+        websocket.close()
+        yield gen.sleep(0.1)
+        stop.assert_not_called()
+        assert "node-1" in self.application.sessions.lingering
+
+        # Output received meanwhile is buffered
+        self.application.handle_tcp_data("node-1", b"boot")
+        self.application.handle_tcp_data("node-1", memoryview(b"ed\n"))
+
+        # A new websocket reuses the connection and gets the buffered output
+        websocket = yield tornado.websocket.websocket_connect(
+            url, subprotocols=["user", "token", "token"]
+        )
+        start.assert_called_once()
+        assert "node-1" not in self.application.sessions.lingering
+        assert self.application.sessions.get("node-1").tcp_client is tcp_client
+        message = yield websocket.read_message()
+        assert message == b"booted\n"
+
+        # Lingering connections are closed after the linger period
+        self.application.settings["node_linger"] = 0.05
+        websocket.close()
+        yield gen.sleep(0.2)
+        stop.assert_called_once()
+        assert "node-1" not in self.application.sessions.lingering
+        assert self.application.sessions.get("node-1") is None
+
+    @mock.patch("iotlabwebsocket.clients.tcp_client.TCPClient.stop")
+    @mock.patch("iotlabwebsocket.clients.tcp_client.TCPClient.start")
+    @mock.patch("iotlabwebsocket.handlers.http_handler._nodes")
+    @gen_test
+    def test_tcp_linger_max(self, nodes, start, stop):
+        url = "ws://localhost:{}/ws/local/123/{}/serial/raw"
+        nodes.return_value = json.dumps({"nodes": ["node-1.local", "node-2.local"]})
+        self.application.settings["node_linger"] = 10
+        self.application.settings["node_linger_max"] = 1
+
+        for node in ("node-1", "node-2"):
+            websocket = yield tornado.websocket.websocket_connect(
+                url.format(self.api.port, node),
+                subprotocols=["user", "token", "token"],
+            )
+            self.application.sessions.get(node).tcp_client.ready = True
+            websocket.close()
+            yield gen.sleep(0.1)
+
+        # The oldest lingering connection was closed
+        stop.assert_called_once()
+        assert list(self.application.sessions.lingering) == ["node-2"]
+        assert self.application.sessions.get("node-1") is None
+
+        # Output of lingering nodes is dropped by default
+        self.application.handle_tcp_data("node-2", b"dropped")
+        assert self.application.sessions.get("node-2").linger_buffer is None
+        assert self.application.sessions.get("node-2").scrollback.read() == b""
+
+        # Lingering connections lost on the node side are forgotten
+        self.application.handle_tcp_close("node-2")
+        assert not self.application.sessions.lingering
+        assert self.application.sessions.get("node-2") is None
+        assert stop.call_count == 2
+
+        # No connection is kept open without lingering slots
+        self.application.settings["node_linger_max"] = 0
+        websocket = yield tornado.websocket.websocket_connect(
+            url.format(self.api.port, "node-1"),
+            subprotocols=["user", "token", "token"],
+        )
+        self.application.sessions.get("node-1").tcp_client.ready = True
+        websocket.close()
+        yield gen.sleep(0.1)
+        assert stop.call_count == 3
+        assert self.application.sessions.get("node-1") is None
+
+    @mock.patch("iotlabwebsocket.handlers.http_handler._nodes")
+    @gen_test
+    def test_tcp_linger_refused(self, nodes):
+        url = f"ws://localhost:{self.api.port}/ws/local/123/localhost/serial/raw"
+        nodes.return_value = json.dumps({"nodes": ["localhost.local"]})
+        self.application.settings["node_linger"] = 5
+        self.application.settings["node_reconnect_window"] = 0
+
+        # No node is listening: the connection is dropped, not kept
+        websocket = yield tornado.websocket.websocket_connect(
+            url, subprotocols=["user", "token", "token"]
+        )
+        message = yield websocket.read_message()
+        assert message is None
+        assert websocket.close_reason == "Cannot connect to node localhost"
+        yield gen.sleep(0.1)
+        assert not self.application.sessions.lingering
+        assert self.application.sessions.get("localhost") is None
+
+    @mock.patch("iotlabwebsocket.handlers.http_handler._nodes")
+    @gen_test
+    def test_tcp_linger_rate_closed(self, nodes):
+        url = f"ws://localhost:{self.api.port}/ws/local/123/localhost/serial/raw"
+        nodes.return_value = json.dumps({"nodes": ["localhost.local"]})
+        self.application.settings["node_linger"] = 5
+        self.application.settings["node_rate"] = 10000
+        self.application.settings["node_burst"] = CHUNK_SIZE
+        self.application.settings["node_disconnect_after"] = 0.05
+
+        sock, _ = bind_unused_port()
+        server = TCPServerStub()
+        server.add_socket(sock)
+        server.listen(NODE_TCP_PORT)
+
+        websocket = yield tornado.websocket.websocket_connect(
+            url, subprotocols=["user", "token", "token"]
+        )
+        yield gen.sleep(0.1)
+        tcp_client = self.application.sessions.get("localhost").tcp_client
+        assert tcp_client.ready
+
+        # Node closed for its rate is dropped, not kept
+        server.stream.write(b"A" * 4 * CHUNK_SIZE)
+        while (yield websocket.read_message()) is not None:
+            pass
+        assert websocket.close_reason == "Node localhost is sending too fast"
+        yield gen.sleep(0.1)
+        assert not tcp_client.ready
+        assert not self.application.sessions.lingering
+        assert self.application.sessions.get("localhost") is None
+        assert server.stream.closed()
+
+    @mock.patch("iotlabwebsocket.web_application.MAX_WEBSOCKETS_PER_NODE", 3)
+    @mock.patch("iotlabwebsocket.clients.tcp_client.TCPClient.stop")
+    @mock.patch("iotlabwebsocket.clients.tcp_client.TCPClient.start")
+    @mock.patch("iotlabwebsocket.handlers.http_handler._nodes")
+    @gen_test
+    def test_scrollback(self, nodes, start, stop):
+        url = f"ws://localhost:{self.api.port}/ws/local/123/node-1/serial"
+        nodes.return_value = json.dumps({"nodes": ["node-1.local"]})
+
+        websocket = yield tornado.websocket.websocket_connect(
+            url + "/raw", subprotocols=["user", "token", "token"]
+        )
+        assert self.application.scrollback_memory == SCROLLBACK_SIZE
+        self.application.handle_tcp_data("node-1", b"boot\r\n")
+        self.application.handle_tcp_data("node-1", memoryview(b"log\npart"))
+        message = yield websocket.read_message()
+        assert message == b"boot\r\n"
+
+        # Late websockets get the recent output in one message
+        text_ws = yield tornado.websocket.websocket_connect(
+            url, subprotocols=["user", "token", "token"]
+        )
+        message = yield text_ws.read_message()
+        assert message == "boot\r\nlog\npart"
+
+        # Or its complete lines for line websockets
+        lines_ws = yield tornado.websocket.websocket_connect(
+            url + "/lines", subprotocols=["user", "token", "token"]
+        )
+        lines = []
+        for _ in range(2):
+            message = yield lines_ws.read_message()
+            lines.append(message)
+        assert lines == ["boot", "log"]
+
+        # Scrollback is released with the node connection
+        for ws in (websocket, text_ws, lines_ws):
+            ws.close()
+        yield gen.sleep(0.1)
+        assert self.application.sessions.get("node-1") is None
+        assert self.application.scrollback_memory == 0
+
+    @mock.patch("iotlabwebsocket.clients.tcp_client.TCPClient.start")
+    @mock.patch("iotlabwebsocket.handlers.http_handler._nodes")
+    @gen_test
+    def test_shared_compression(self, nodes, start):
+        url = f"ws://localhost:{self.api.port}/ws/local/123/node-1/serial"
+        nodes.return_value = json.dumps({"nodes": ["node-1.local"]})
+        self.application.settings["compression"] = "shared"
+        self.application.settings["scrollback_size"] = 0
+
+        websockets = []
+        for _ in range(2):
+            websocket = yield tornado.websocket.websocket_connect(
+                url,
+                subprotocols=["user", "token", "token"],
+                compression_options={},
+            )
+            websockets.append(websocket)
+        # Server doesn't keep a compression context
+        for server_ws in self.application.sessions.websockets("node-1"):
+            assert server_ws.ws_connection._compressor._compressor is None
+
+        # Node output is compressed once for all websockets
+        data = b"0123456789" * 100
+        with mock.patch(
+            "iotlabwebsocket.broadcast.deflate", wraps=deflate
+        ) as deflate_mock:
+            self.application.handle_tcp_data("node-1", data)
+            for websocket in websockets:
+                message = yield websocket.read_message()
+                assert message == data.decode()
+            assert deflate_mock.call_count == 1
+
+            # Small messages are not compressed
+            self.application.handle_tcp_data("node-1", b"small")
+            for websocket in websockets:
+                message = yield websocket.read_message()
+                assert message == "small"
+            assert deflate_mock.call_count == 1
+
+        server_ws = self.application.sessions.websockets("node-1")[0]
+        assert server_ws.ws_connection._wire_bytes_out < len(data)
+
+    @mock.patch("iotlabwebsocket.clients.tcp_client.TCPClient.start")
+    @mock.patch("iotlabwebsocket.handlers.http_handler._nodes")
+    @gen_test
+    def test_context_compression(self, nodes, start):
+        url = f"ws://localhost:{self.api.port}/ws/local/123/node-1/serial"
+        nodes.return_value = json.dumps({"nodes": ["node-1.local"]})
+        self.application.settings["compression"] = "context"
+
+        websocket = yield tornado.websocket.websocket_connect(
+            url, subprotocols=["user", "token", "token"], compression_options={}
+        )
+        server_ws = self.application.sessions.websockets("node-1")[0]
+        compressor = server_ws.ws_connection._compressor
+        assert compressor._compressor is not None
+        with mock.patch.object(
+            compressor, "compress", wraps=compressor.compress
+        ) as compress:
+            # Small status messages are not compressed
+            self.application.handle_tcp_status("node-1", "Reconnecting")
+            assert (yield websocket.read_message()) == "Reconnecting.\n"
+            compress.assert_not_called()
+
+            data = "0123456789" * 100
+            server_ws.write_message(data)
+            assert (yield websocket.read_message()) == data
+            compress.assert_called_once()
+
+    @mock.patch("iotlabwebsocket.clients.tcp_client.TCPClient.start")
+    @mock.patch("iotlabwebsocket.handlers.http_handler._nodes")
+    @gen_test
+    def test_scrollback_budget(self, nodes, start):
+        url = f"ws://localhost:{self.api.port}/ws/local/123/node-1/serial/raw"
+        nodes.return_value = json.dumps({"nodes": ["node-1.local"]})
+        self.application.settings["scrollback_budget"] = SCROLLBACK_SIZE - 1
+
+        yield tornado.websocket.websocket_connect(
+            url, subprotocols=["user", "token", "token"]
+        )
+        assert self.application.sessions.get("node-1").scrollback is None
+        assert self.application.scrollback_memory == 0
 
     @mock.patch("iotlabwebsocket.handlers.http_handler._nodes")
     @gen_test
@@ -128,41 +422,46 @@ class TestWebApplication(AsyncHTTPTestCase):
             url, subprotocols=["user", "token", "token"]
         )
 
-        assert len(self.application.websockets["localhost"]) == 1
+        assert len(self.application.sessions.websockets("localhost")) == 1
 
         # Leave some time for the TCP connection to be ready
         yield gen.sleep(0.1)
-        assert self.application.tcp_clients["localhost"].ready
+        assert self.application.sessions.get("localhost").tcp_client.ready
 
         # Send some data
-        websocket_srv = self.application.websockets["localhost"][0]
-        websocket_srv.write_message = mock.Mock()
         message = "test°°°ééààà"
         if sys.version_info[0] > 2:
             message = message.encode("utf-8")
         yield server.stream.write(message)
 
-        yield gen.sleep(0.1)
-        assert websocket_srv.write_message.call_count == 1
-        websocket_srv.write_message.call_count = 0
+        received = yield websocket.read_message()
+        assert received == message
+        websocket_srv = self.application.sessions.websockets("localhost")[0]
+        websocket_srv.write_message = mock.Mock()
 
         # Smoke test to check that the websocket gets a message when the TCP
         # connection is not opened yet
-        self.application.tcp_clients["localhost"].ready = False
+        self.application.sessions.get("localhost").tcp_client.ready = False
         websocket.write_message(b"test", binary=True)
         yield gen.sleep(0.1)
         websocket_srv.write_message.assert_called_with(
             "No TCP connection opened, cannot send message 'test'.\n"
         )
-        self.application.tcp_clients["localhost-1"].ready = True
+        # Binary input doesn't close the websocket
+        websocket.write_message(b"\xfftest", binary=True)
+        yield gen.sleep(0.1)
+        websocket_srv.write_message.assert_called_with(
+            "No TCP connection opened, cannot send message '\ufffdtest'.\n"
+        )
+        assert websocket.close_code is None
 
         # Force close from TCP server, all websockets should be closed
         # automatically and TCP client connection as well
         server.stream.close()
         yield gen.sleep(0.1)
 
-        assert not self.application.tcp_clients["localhost"].ready
-        assert len(self.application.websockets["node-1"]) == 0
+        assert not self.application.sessions.get("localhost").tcp_client.ready
+        assert len(self.application.sessions.websockets("node-1")) == 0
 
     @mock.patch("iotlabwebsocket.handlers.http_handler._nodes")
     @gen_test
@@ -175,28 +474,25 @@ class TestWebApplication(AsyncHTTPTestCase):
         server.add_socket(sock)
         server.listen(NODE_TCP_PORT)
 
-        _ = yield tornado.websocket.websocket_connect(
+        websocket = yield tornado.websocket.websocket_connect(
             url, subprotocols=["user", "token", "token"]
         )
 
-        assert len(self.application.websockets["localhost"]) == 1
+        assert len(self.application.sessions.websockets("localhost")) == 1
 
         # Leave some time for the TCP connection to be ready
         yield gen.sleep(0.1)
-        assert self.application.tcp_clients["localhost"].ready
+        assert self.application.sessions.get("localhost").tcp_client.ready
 
         # Send some data
-        websocket_srv = self.application.websockets["localhost"][0]
-        websocket_srv.write_message = mock.Mock()
         message = "test".encode("utf-8")
         yield server.stream.write(message)
 
-        yield gen.sleep(0.1)
-        assert websocket_srv.write_message.call_count == 1
+        received = yield websocket.read_message()
+        assert received == "test"
 
         # Send some pure binary data
-        websocket_srv.write_message.call_count = 0
-        websocket_srv = self.application.websockets["localhost"][0]
+        websocket_srv = self.application.sessions.websockets("localhost")[0]
         websocket_srv.write_message = mock.Mock()
         message = b"\xaa\xbb\xcc\xff"
         yield server.stream.write(message)
@@ -204,6 +500,237 @@ class TestWebApplication(AsyncHTTPTestCase):
         yield gen.sleep(0.1)
         assert websocket_srv.write_message.call_count == 0
 
+    def test_tcp_data_fan_out(self):
+        text_ws = mock.Mock(text=True, lines=False)
+        raw_ws = mock.Mock(text=False, lines=False)
+        raw_ws2 = mock.Mock(text=False, lines=False)
+        add_session(self.application, "node-1", [text_ws, raw_ws, raw_ws2])
+
+        # Zero-copy reads hand memoryviews on reused buffers
+        buf = bytearray("test°".encode("utf-8"))
+        self.application.handle_tcp_data("node-1", memoryview(buf))
+        buf[:] = b"\x00" * len(buf)
+
+        assert sent_messages(text_ws) == ["test°"]
+        assert sent_messages(raw_ws) == ["test°".encode()]
+        # Raw websockets share the same message, framed once
+        assert sent_messages(raw_ws2) == ["test°".encode()]
+        assert raw_ws.send_node_output.call_args == raw_ws2.send_node_output.call_args
+
+        # Binary data is still forwarded to raw websockets after a text one
+        text_ws.send_node_output.reset_mock()
+        raw_ws.send_node_output.reset_mock()
+        self.application.handle_tcp_data("node-1", b"\xaa\xbb")
+        text_ws.send_node_output.assert_not_called()
+        assert sent_messages(raw_ws) == [b"\xaa\xbb"]
+
+    def test_tcp_data_text_decoding(self):
+        text_ws = mock.Mock(text=True, lines=False)
+        text_ws2 = mock.Mock(text=True, lines=False)
+        lines_ws = mock.Mock(text=True, lines=True)
+        add_session(self.application, "node-1", [text_ws, text_ws2, lines_ws])
+
+        # A character split between chunks is decoded once for all websockets
+        data = "é°\nline2\nli".encode("utf-8")
+        decode = NodeDecoder.decode
+        with mock.patch.object(
+            NodeDecoder, "decode", autospec=True, side_effect=decode
+        ) as decode_mock:
+            self.application.handle_tcp_data("node-1", data[:1])
+            text_ws.send_node_output.assert_not_called()
+            self.application.handle_tcp_data("node-1", data[1:])
+            assert decode_mock.call_count == 2
+        assert sent_messages(text_ws) == ["é°\nline2\nli"]
+        assert sent_messages(text_ws2) == ["é°\nline2\nli"]
+
+        # Lines websockets get one message per complete line
+        assert sent_messages(lines_ws) == ["é°", "line2"]
+        lines_ws.send_node_output.reset_mock()
+        self.application.handle_tcp_data("node-1", b"ne3\n")
+        assert sent_messages(lines_ws) == ["line3"]
+
+    def test_websocket_data_backpressure(self):
+        websocket = mock.Mock(node="node-1", multiplexed=False)
+        tcp_client = mock.Mock(ready=True, writable=True, queued_bytes=0)
+        add_session(self.application, "node-1", tcp_client=tcp_client)
+
+        assert self.application.handle_websocket_data(websocket, b"test") is None
+        tcp_client.send.assert_called_once_with(b"test")
+
+        # Node input queue is full: websocket is paused until it is drained
+        tcp_client.writable = False
+        drained = self.application.handle_websocket_data(websocket, b"test")
+        assert drained is tcp_client.drained.return_value
+        assert tcp_client.send.call_count == 2
+
+        # Or message is rejected
+        self.application.settings["node_write_policy"] = "reject"
+        tcp_client.queued_bytes = 1234
+        assert self.application.handle_websocket_data(websocket, b"test") is None
+        assert tcp_client.send.call_count == 2
+        websocket.write_message.assert_called_once_with(
+            "Node node-1 input queue is full (1234 bytes), cannot send message.\n"
+        )
+
+    def test_websocket_data_multiplexed_backpressure(self):
+        # One slow node never pauses the channels of a multiplexed websocket
+        channel = mock.Mock(node="node-1", multiplexed=True)
+        tcp_client = mock.Mock(ready=True, writable=True, queued_bytes=1234)
+        add_session(self.application, "node-1", tcp_client=tcp_client)
+        add_session(self.application, "node-2", tcp_client=mock.Mock(ready=True))
+        assert self.application.settings["node_write_policy"] == "pause"
+
+        assert self.application.handle_websocket_data(channel, b"test") is None
+        tcp_client.writable = False
+        assert self.application.handle_websocket_data(channel, b"test") is None
+        assert tcp_client.send.call_count == 1
+        channel.write_message.assert_called_once_with(
+            "Node node-1 input queue is full (1234 bytes), cannot send message.\n"
+        )
+
+        statuses = self.application.handle_group_write(["node-1", "node-2"], b"test")
+        assert statuses == {"node-1": "queue_full", "node-2": "sent"}
+        assert tcp_client.send.call_count == 1
+
+    def test_recording(self):
+        websocket = mock.Mock(node="node-1", experiment_id="123")
+        tcp_client = mock.Mock(ready=True, writable=True, throttles=0, read_time=None)
+        session = add_session(self.application, "node-1", tcp_client=tcp_client)
+        self.application.recorder = mock.Mock()
+
+        self.application.handle_tcp_data("node-1", b"output")
+        self.application.handle_websocket_data(websocket, b"input")
+        self.application._close_session(session)
+        assert self.application.recorder.mock_calls == [
+            mock.call.record("node-1", NODE_OUTPUT, b"output"),
+            mock.call.record("node-1", NODE_INPUT, b"input"),
+            mock.call.close("node-1"),
+        ]
+
+    @gen_test
+    def test_tcp_data_slow_websockets(self):
+        websockets = [
+            mock.Mock(
+                text=False,
+                lines=False,
+                user="user",
+                output=mock.Mock(full=full, stats={"buffered_bytes": 0}),
+            )
+            for full in (True, False)
+        ]
+        tcp_client = mock.Mock(read_time=None)
+        add_session(self.application, "node-1", websockets, tcp_client)
+        self.application.settings["output_buffer_policy"] = "pause"
+
+        self.application.handle_tcp_data("node-1", b"test")
+        tcp_client.pause.assert_not_called()
+
+        # Node is paused when all its websockets are full, until one drains
+        drained = [Future(), Future()]
+        for websocket, future in zip(websockets, drained):
+            websocket.output.full = True
+            websocket.output.drained.return_value = future
+        self.application.handle_tcp_data("node-1", b"test")
+        resume = tcp_client.pause.call_args[0][0]
+        assert not resume.done()
+        drained[1].set_result(None)
+        drained[0].set_result(None)
+        yield gen.moment
+        assert resume.done()
+
+        assert self.application.output_stats() == {
+            "node-1": [{"buffered_bytes": 0, "user": "user"}] * 2
+        }
+
+    def test_metrics_disabled(self):
+        response = self.fetch("/metrics")
+        assert response.code == 404
+        response = self.fetch("/admin/latency")
+        assert response.code == 404
+
+    @gen_test
+    def test_experiment_nodes_preload(self):
+        nodes = ["node-1.grenoble.iot-lab.info"]
+        with mock.patch.object(
+            self.application.node_connector, "load_nodes"
+        ) as load_nodes:
+            self.application.handle_experiment_nodes(nodes)
+            yield gen.moment
+            load_nodes.assert_not_called()
+
+            self.application.settings["node_address_preload"] = True
+            self.application.handle_experiment_nodes(nodes)
+            # Addresses are resolved in the background
+            load_nodes.assert_not_called()
+            yield gen.moment
+            load_nodes.assert_called_once_with(nodes)
+
+    def test_tcp_status(self):
+        text_ws = mock.Mock(text=True, lines=False)
+        raw_ws = mock.Mock(text=False, lines=False)
+        raw_ws.write_message.side_effect = tornado.websocket.WebSocketClosedError
+        add_session(self.application, "node-1", [raw_ws, text_ws])
+
+        self.application.handle_tcp_status("node-1", "Connection lost")
+        raw_ws.write_message.assert_called_once_with("Connection lost.\n")
+        text_ws.write_message.assert_called_once_with("Connection lost.\n")
+
+    @mock.patch("iotlabwebsocket.handlers.http_handler._nodes")
+    @gen_test
+    def test_application_drain(self, nodes):
+        url = f"ws://localhost:{self.api.port}/ws/local/123/localhost/serial/raw"
+        nodes.return_value = json.dumps({"nodes": ["localhost.local"]})
+
+        sock, _ = bind_unused_port()
+        server = TCPServerStub()
+        server.add_socket(sock)
+        server.listen(NODE_TCP_PORT)
+
+        websockets = []
+        for _ in range(2):
+            websocket = yield tornado.websocket.websocket_connect(
+                url, subprotocols=["user", "token", "token"]
+            )
+            websockets.append(websocket)
+        yield gen.sleep(0.1)
+
+        # Websockets are left open during the drain timeout
+        draining = gen.convert_yielded(
+            self.application.drain(timeout=0.3, retry_after=3)
+        )
+        yield gen.sleep(0.1)
+        assert not draining.done()
+        yield server.stream.write(b"output")
+        for websocket in websockets:
+            message = yield websocket.read_message()
+            assert message == b"output"
+
+        # New websockets are refused
+        late = yield tornado.websocket.websocket_connect(
+            url, subprotocols=["user", "token", "token"]
+        )
+        message = yield late.read_message()
+        assert message is None
+        assert late.close_code == 1012
+
+        # Then closed with a retry hint
+        websockets[0].close()
+        yield draining
+        message = yield websockets[1].read_message()
+        assert message is None
+        assert websockets[1].close_code == 1012
+        assert websockets[1].close_reason == (
+            "Server is restarting, retry after 3 seconds"
+        )
+
+    @mock.patch("iotlabwebsocket.web_application.spawn_successor")
+    @gen_test
+    def test_application_restart(self, spawn_successor):
+        self.application.listeners = [mock.Mock()]
+        yield self.application.restart(timeout=0)
+        spawn_successor.assert_called_once_with(self.application.listeners)
+        assert self.application.draining
+
     @mock.patch("iotlabwebsocket.handlers.http_handler._nodes")
     @gen_test
     def test_application_stop(self, nodes):
@@ -220,11 +747,11 @@ class TestWebApplication(AsyncHTTPTestCase):
                 url, subprotocols=["user", "token", "token"]
             )
 
-        assert len(self.application.websockets["localhost"]) == MAX_WEBSOCKETS_PER_NODE
+        assert len(self.application.sessions.websockets("localhost")) == MAX_WEBSOCKETS_PER_NODE
 
         self.application.stop()
         yield gen.sleep(0.1)
-        assert len(self.application.websockets["localhost"]) == 0
+        assert len(self.application.sessions.websockets("localhost")) == 0
 
     @mock.patch("iotlabwebsocket.web_application.MAX_WEBSOCKETS_PER_NODE", 20)
     @gen_test
@@ -243,13 +770,375 @@ class TestWebApplication(AsyncHTTPTestCase):
                 url, subprotocols=["user", "token", "token"]
             )
 
-        self.application.user_connections["user"] == MAX_WEBSOCKETS_PER_USER
+        assert self.application.sessions.users["user"] == MAX_WEBSOCKETS_PER_USER
 
         i = 1
-        for websockets in self.application.websockets.values():
-            websockets[0].close(code=1234, reason="Too many connections test")
+        for session in self.application.sessions:
+            next(iter(session.websockets)).close(
+                code=1234, reason="Too many connections test"
+            )
             yield gen.sleep(0.1)
             assert (
-                self.application.user_connections["user"] == MAX_WEBSOCKETS_PER_USER - i
+                self.application.sessions.users["user"] == MAX_WEBSOCKETS_PER_USER - i
             )
             i += 1
+
+    @mock.patch("iotlabwebsocket.handlers.http_handler._nodes")
+    @gen_test
+    def test_mux_connection(self, nodes):
+        url = f"ws://localhost:{self.api.port}/ws/local/123/mux"
+        nodes.return_value = json.dumps(
+            {"nodes": ["localhost.local", "node-1.grenoble"]}
+        )
+
+        sock, _ = bind_unused_port()
+        server = TCPServerStub()
+        server.add_socket(sock)
+        server.listen(NODE_TCP_PORT)
+
+        websocket = yield tornado.websocket.websocket_connect(
+            url, subprotocols=["user", "token", "token"]
+        )
+        for channel in (1, 2):
+            websocket.write_message(
+                mux.encode(channel, mux.SUBSCRIBE, b"localhost"), binary=True
+            )
+        yield gen.sleep(0.1)
+        # Subscriptions count as node websockets, not as user websockets
+        assert len(self.application.sessions.websockets("localhost")) == 2
+        assert self.application.sessions.users["user"] == 1
+        # nor as handshakes
+        handshakes = self.application.metrics.handshakes
+        assert handshakes.labels("accepted").value == 1
+
+        yield server.stream.write(b"output")
+        frames = []
+        for _ in range(2):
+            frames.append((yield websocket.read_message()))
+        assert sorted(frames) == [
+            mux.encode(1, mux.OUTPUT, b"output"),
+            mux.encode(2, mux.OUTPUT, b"output"),
+        ]
+
+        websocket.write_message(mux.encode(2, mux.INPUT, b"input"), binary=True)
+        yield gen.sleep(0.1)
+        assert server.received == b"input"
+
+        # Invalid channels and nodes, the websocket is left open
+        for channel, kind, payload, reason in (
+            (1, mux.SUBSCRIBE, b"localhost", b"Channel 1 is already subscribed"),
+            (3, mux.SUBSCRIBE, b"node-1", b"Invalid node 'node-1'"),
+            (3, mux.INPUT, b"input", b"Channel 3 is not subscribed"),
+        ):
+            websocket.write_message(mux.encode(channel, kind, payload), binary=True)
+            message = yield websocket.read_message()
+            assert message == mux.encode(channel, mux.CLOSED, reason)
+        with mock.patch("iotlabwebsocket.web_application.MAX_WEBSOCKETS_PER_NODE", 2):
+            websocket.write_message(
+                mux.encode(3, mux.SUBSCRIBE, b"localhost"), binary=True
+            )
+            message = yield websocket.read_message()
+        assert message[:3] == mux.encode(3, mux.CLOSED)
+        assert handshakes.labels("accepted").value == 1
+        assert handshakes.labels("refused").value == 0
+
+        websocket.write_message(mux.encode(1, mux.UNSUBSCRIBE), binary=True)
+        message = yield websocket.read_message()
+        assert message == mux.encode(1, mux.CLOSED, b"Unsubscribed")
+        assert len(self.application.sessions.websockets("localhost")) == 1
+
+        # Invalid frames close the websocket
+        websocket.write_message(b"\x00", binary=True)
+        assert (yield websocket.read_message()) is None
+        assert websocket.close_code == 1003
+        yield gen.sleep(0.1)
+        assert self.application.sessions.get("localhost") is None
+        assert self.application.sessions.users["user"] == 0
+        assert not self.application.multiplexers
+        server.stop()
+
+    @mock.patch("iotlabwebsocket.handlers.http_handler._nodes")
+    @gen_test
+    def test_mux_broadcast(self, nodes):
+        url = f"ws://localhost:{self.api.port}/ws/local/123/mux"
+        nodes.return_value = json.dumps(
+            {"nodes": ["localhost.local", "node-1.local", "m3-1.grenoble"]}
+        )
+
+        sock, _ = bind_unused_port()
+        server = TCPServerStub()
+        server.add_socket(sock)
+        server.listen(NODE_TCP_PORT)
+
+        websocket = yield tornado.websocket.websocket_connect(
+            url, subprotocols=["user", "token", "token"]
+        )
+        websocket.write_message(
+            mux.encode(1, mux.SUBSCRIBE, b"localhost"), binary=True
+        )
+        yield gen.sleep(0.1)
+
+        payload = mux.encode_broadcast("localhost,node-*,m3-*", b"reset\n")
+        websocket.write_message(mux.encode(9, mux.BROADCAST, payload), binary=True)
+        message = yield websocket.read_message()
+        assert message[:3] == mux.encode(9, mux.DELIVERY)
+        assert json.loads(message[3:]) == {
+            "localhost": "sent",
+            "node-1": "not_connected",
+            "m3-*": "invalid_node",
+        }
+        yield gen.sleep(0.1)
+        assert server.received == b"reset\n"
+
+        # Invalid broadcasts leave the websocket open
+        websocket.write_message(mux.encode(9, mux.BROADCAST, b"\x00"), binary=True)
+        message = yield websocket.read_message()
+        assert json.loads(message[3:]) == {"error": "Invalid broadcast"}
+        assert len(self.application.sessions.websockets("localhost")) == 1
+        websocket.close()
+        yield gen.sleep(0.1)
+        server.stop()
+
+    @mock.patch("iotlabwebsocket.handlers.http_handler._nodes")
+    @gen_test
+    def test_mux_invalid(self, nodes):
+        url = f"ws://localhost:{self.api.port}/ws/local/123/mux"
+        nodes.return_value = json.dumps({"nodes": ["node-1.grenoble"]})
+        with self.assertRaises(tornado.httpclient.HTTPClientError) as context:
+            yield tornado.websocket.websocket_connect(
+                url, subprotocols=["user", "token", "token"]
+            )
+        assert context.exception.code == 401
+
+        # Draining servers close multiplexed websockets too
+        self.application.draining = "Server is restarting"
+        nodes.return_value = json.dumps({"nodes": ["node-1.local"]})
+        websocket = yield tornado.websocket.websocket_connect(
+            url, subprotocols=["user", "token", "token"]
+        )
+        assert (yield websocket.read_message()) is None
+        assert websocket.close_code == 1012
+
+    @mock.patch("iotlabwebsocket.handlers.http_handler._nodes")
+    @gen_test
+    def test_aggregate_connection(self, nodes):
+        url = "ws://localhost:{}/ws/local/123/{}"
+        nodes.return_value = json.dumps(
+            {"nodes": ["localhost.local", "node-1.grenoble"]}
+        )
+
+        sock, _ = bind_unused_port()
+        server = TCPServerStub()
+        server.add_socket(sock)
+        server.listen(NODE_TCP_PORT)
+
+        for _ in range(MAX_WEBSOCKETS_PER_NODE):
+            yield tornado.websocket.websocket_connect(
+                url.format(self.api.port, "localhost/serial/raw"),
+                subprotocols=["user", "token", "token"],
+            )
+        yield gen.sleep(0.1)
+        tcp_client = self.application.sessions.get("localhost").tcp_client
+
+        # The node connection is shared, even when the node has all its
+        # websockets
+        websocket = yield tornado.websocket.websocket_connect(
+            url.format(self.api.port, "aggregate"),
+            subprotocols=["user", "token", "token"],
+        )
+        session = self.application.sessions.get("localhost")
+        assert session.tcp_client is tcp_client
+        assert len(session.websockets) == MAX_WEBSOCKETS_PER_NODE + 1
+        assert self.application.sessions.users["user"] == MAX_WEBSOCKETS_PER_NODE + 1
+
+        before = time.time()
+        yield server.stream.write(b"line 1\nline 2\npartial")
+        received = ""
+        while received.count("\n") < 2:
+            received += yield websocket.read_message()
+        lines = [line.split(";") for line in received.splitlines()]
+        assert [line[1:] for line in lines] == [
+            ["localhost", "line 1"],
+            ["localhost", "line 2"],
+        ]
+        assert before <= float(lines[0][0]) <= time.time()
+
+        # Aggregated websockets are read-only
+        websocket.write_message("input")
+        yield gen.sleep(0.1)
+        assert server.received == b""
+        text = self.application.metrics.render()
+        assert 'iotlabwebsocket_websockets{endpoint="aggregate"} 1' in text
+        assert 'iotlabwebsocket_websocket_frames_total{direction="out"} 0' not in text
+
+        websocket.close()
+        yield gen.sleep(0.1)
+        assert len(session.websockets) == MAX_WEBSOCKETS_PER_NODE
+        assert self.application.sessions.users["user"] == MAX_WEBSOCKETS_PER_NODE
+        assert not self.application.multiplexers
+        server.stop()
+
+    @mock.patch("iotlabwebsocket.handlers.http_handler._nodes")
+    @gen_test
+    def test_aggregate_connection_first(self, nodes):
+        url = "ws://localhost:{}/ws/local/123/{}"
+        nodes.return_value = json.dumps({"nodes": ["localhost.local"]})
+
+        sock, _ = bind_unused_port()
+        server = TCPServerStub()
+        server.add_socket(sock)
+        server.listen(NODE_TCP_PORT)
+
+        yield tornado.websocket.websocket_connect(
+            url.format(self.api.port, "aggregate"),
+            subprotocols=["user", "token", "token"],
+        )
+        yield gen.sleep(0.1)
+
+        # The aggregated websocket doesn't take a websocket of the node
+        for _ in range(MAX_WEBSOCKETS_PER_NODE):
+            yield tornado.websocket.websocket_connect(
+                url.format(self.api.port, "localhost/serial/raw"),
+                subprotocols=["user", "token", "token"],
+            )
+        yield gen.sleep(0.1)
+        session = self.application.sessions.get("localhost")
+        assert len(session.websockets) == MAX_WEBSOCKETS_PER_NODE + 1
+        assert self.application.metrics.handshakes.labels("refused").value == 0
+        server.stop()
+
+
+class TestWebApplicationMetrics(AsyncHTTPTestCase):
+    def get_app(self):
+        self.application = WebApplication(
+            self.api,
+            use_local_api=True,
+            token="token",
+            metrics=True,
+            latency_sample_rate=1,
+        )
+        return self.application
+
+    def setUp(self):
+        self.api = ApiClient("http")
+        super(TestWebApplicationMetrics, self).setUp()
+        self.api.port = self.get_http_port()
+
+    @mock.patch("iotlabwebsocket.handlers.http_handler._nodes")
+    @gen_test
+    def test_metrics(self, nodes):
+        url = f"ws://localhost:{self.api.port}/ws/local/123/localhost/serial/raw"
+        nodes.return_value = json.dumps({"nodes": ["localhost.local"]})
+
+        sock, _ = bind_unused_port()
+        server = TCPServerStub()
+        server.add_socket(sock)
+        server.listen(NODE_TCP_PORT)
+
+        websocket = yield tornado.websocket.websocket_connect(
+            url, subprotocols=["user", "token", "token"]
+        )
+        with self.assertRaises(tornado.httpclient.HTTPClientError):
+            yield tornado.websocket.websocket_connect(
+                url, subprotocols=["user", "token", "invalid"]
+            )
+        yield gen.sleep(0.1)
+        yield server.stream.write(b"output")
+        yield websocket.read_message()
+        yield websocket.write_message(b"input", binary=True)
+        yield gen.sleep(0.1)
+
+        response = yield self.http_client.fetch(self.get_url("/metrics"))
+        assert response.headers["Content-Type"].startswith("text/plain")
+        samples = dict(
+            line.rsplit(" ", 1)
+            for line in response.body.decode().splitlines()
+            if not line.startswith("#")
+        )
+        assert samples['iotlabwebsocket_websockets{endpoint="raw"}'] == "1"
+        assert samples['iotlabwebsocket_handshakes_total{outcome="accepted"}'] == "1"
+        assert (
+            samples['iotlabwebsocket_handshakes_total{outcome="invalid_token"}'] == "1"
+        )
+        assert samples['iotlabwebsocket_node_connections{state="connected"}'] == "1"
+        assert (
+            samples[
+                'iotlabwebsocket_node_bytes_total{node="localhost",direction="output"}'
+            ]
+            == "6"
+        )
+        assert (
+            samples[
+                'iotlabwebsocket_node_bytes_total{node="localhost",direction="input"}'
+            ]
+            == "5"
+        )
+        assert samples['iotlabwebsocket_websocket_frames_total{direction="in"}'] == "1"
+        assert samples['iotlabwebsocket_websocket_frames_total{direction="out"}'] == "1"
+        assert (
+            samples[
+                'iotlabwebsocket_api_request_seconds_count'
+                '{resource="token",outcome="ok"}'
+            ]
+            == "1"
+        )
+        # Second handshake used the cached token, then invalidated it
+        assert (
+            samples['iotlabwebsocket_api_cache_total{resource="token",result="hit"}']
+            == "1"
+        )
+        assert (
+            samples['iotlabwebsocket_api_cache_total{resource="token",result="miss"}']
+            == "1"
+        )
+        assert "123" not in self.api.cache.entries
+        assert (
+            samples[
+                'iotlabwebsocket_write_buffer_bytes_count{connection="websocket"}'
+            ]
+            == "1"
+        )
+
+        # Closed websockets are still counted
+        websocket.close()
+        yield gen.sleep(0.1)
+        response = yield self.http_client.fetch(self.get_url("/metrics"))
+        body = response.body.decode()
+        assert 'iotlabwebsocket_websockets{endpoint="raw"} 0' in body
+        assert 'iotlabwebsocket_websocket_frames_total{direction="out"} 1' in body
+        assert 'iotlabwebsocket_node_connections{state="connected"} 0' in body
+
+        # A single process serves the metrics of the first worker
+        response = yield self.http_client.fetch(self.get_url("/metrics/0"))
+        assert response.body.decode() == body
+        with self.assertRaises(tornado.httpclient.HTTPClientError) as context:
+            yield self.http_client.fetch(self.get_url("/metrics/1"))
+        assert context.exception.code == 404
+
+    @mock.patch("iotlabwebsocket.handlers.http_handler._nodes")
+    @gen_test
+    def test_latency(self, nodes):
+        url = f"ws://localhost:{self.api.port}/ws/local/123/localhost/serial"
+        nodes.return_value = json.dumps({"nodes": ["localhost.local"]})
+
+        sock, _ = bind_unused_port()
+        server = TCPServerStub()
+        server.add_socket(sock)
+        server.listen(NODE_TCP_PORT)
+
+        websocket = yield tornado.websocket.websocket_connect(
+            url, subprotocols=["user", "token", "token"]
+        )
+        yield gen.sleep(0.1)
+        for _ in range(3):
+            yield server.stream.write(b"output")
+            yield websocket.read_message()
+
+        response = yield self.http_client.fetch(self.get_url("/admin/latency"))
+        latency = json.loads(response.body)
+        assert latency["worker"] is None
+        assert latency["sample_rate"] == 1
+        assert latency["fanout"]["localhost"]["count"] == 3
+        output = latency["output"]["localhost"]["text"]
+        assert output["count"] == 3
+        assert 0 < output["p50"] <= output["p99"] < 1
@@ -1,6 +1,7 @@
 """iotlabwebsocket websocket handler tests."""
 
 import json
+import time
 
 import pytest
 
@@ -11,6 +12,7 @@ from tornado import gen
 from tornado.testing import AsyncHTTPTestCase, gen_test
 
 from iotlabwebsocket.api import ApiClient
+from iotlabwebsocket.recorder import NODE_INPUT, NODE_OUTPUT
 from iotlabwebsocket.web_application import WebApplication
 from iotlabwebsocket.handlers.websocket_handler import WebsocketClientHandler
 
@@ -41,7 +43,8 @@ class TestWebsocketHandler(AsyncHTTPTestCase):
         ws_open.assert_called_once()
 
         with patch(
-            "iotlabwebsocket.web_application" ".WebApplication.handle_websocket_data"
+            "iotlabwebsocket.web_application" ".WebApplication.handle_websocket_data",
+            return_value=None,
         ) as ws_data:
             data = b"test"
             yield connection.write_message(data, binary=True)
@@ -85,7 +88,8 @@ class TestWebsocketHandler(AsyncHTTPTestCase):
         ws_open.assert_called_once()
 
         with patch(
-            "iotlabwebsocket.web_application" ".WebApplication.handle_websocket_data"
+            "iotlabwebsocket.web_application" ".WebApplication.handle_websocket_data",
+            return_value=None,
         ) as ws_data:
             data = "test"
             yield connection.write_message(data)
@@ -113,6 +117,26 @@ class TestWebsocketHandler(AsyncHTTPTestCase):
             ws_close.assert_called_once()
             ws_close.assert_called_with(ws_handler)
 
+    @patch("iotlabwebsocket.handlers.http_handler._nodes")
+    @gen_test
+    def test_websocket_connection_lines(self, nodes, ws_open):
+        url = f"ws://localhost:{self.api.port}/ws/local/123/serial/serial/lines"
+        nodes.return_value = json.dumps({"nodes": ["serial.local"]})
+
+        connection = yield tornado.websocket.websocket_connect(
+            url, subprotocols=["user", "token", "token"]
+        )
+        assert connection.selected_subprotocol == "token"
+        ws_open.assert_called_once()
+        args, _ = ws_open.call_args
+        ws_handler = args[0]
+        assert ws_handler.node == "serial"
+        assert ws_handler.site == "local"
+        assert ws_handler.experiment_id == "123"
+        assert ws_handler.text
+        assert ws_handler.lines
+        assert ws_handler.output.max_size == 0
+
     @patch("iotlabwebsocket.handlers.http_handler._nodes")
     @gen_test
     def test_websocket_connection_text_invalid(self, nodes, ws_open):
@@ -129,7 +153,8 @@ class TestWebsocketHandler(AsyncHTTPTestCase):
         ws_open.assert_called_once()
 
         with patch(
-            "iotlabwebsocket.web_application" ".WebApplication.handle_websocket_data"
+            "iotlabwebsocket.web_application" ".WebApplication.handle_websocket_data",
+            return_value=None,
         ) as ws_data:
             data = "test"
             yield connection.write_message(data)
@@ -192,3 +217,165 @@ class TestWebsocketHandler(AsyncHTTPTestCase):
             )
         assert "HTTP 401: Unauthorized" in str(exc_info.value)
         assert ws_open.call_count == 0
+
+    @gen_test
+    def test_websocket_connection_invalid_token_first(self, ws_open):
+        url = f"ws://localhost:{self.api.port}/ws/local/123/invalid-123/serial"
+        metrics = self._app.metrics
+
+        async def slow_token(exp_id):
+            await gen.sleep(0.1)
+            return "token"
+
+        # Nodes are only reported invalid once the token is verified
+        with patch.object(self.api, "fetch_token_async", side_effect=slow_token):
+            with pytest.raises(tornado.httpclient.HTTPClientError) as exc_info:
+                yield tornado.websocket.websocket_connect(
+                    url, subprotocols=["user", "token", "invalid"]
+                )
+            assert exc_info.value.code == 401
+            assert exc_info.value.response.body == b"Invalid token 'invalid'"
+            assert metrics.handshakes.labels("invalid_token").value == 1
+            assert metrics.handshakes.labels("invalid_node").value == 0
+
+            with pytest.raises(tornado.httpclient.HTTPClientError) as exc_info:
+                yield tornado.websocket.websocket_connect(
+                    url, subprotocols=["user", "token", "token"]
+                )
+            assert exc_info.value.response.body == b"Invalid node"
+            assert metrics.handshakes.labels("invalid_node").value == 1
+        assert ws_open.call_count == 0
+
+    @gen_test
+    def test_websocket_connection_timeout(self, ws_open):
+        url = f"ws://localhost:{self.api.port}/ws/local/123/localhost/serial"
+        metrics = self._app.metrics
+        self._app.settings["handshake_timeout"] = 0.1
+
+        async def slow_nodes(exp_id):
+            await gen.sleep(0.3)
+            return ["localhost.local"]
+
+        with patch.object(self.api, "fetch_nodes_async", side_effect=slow_nodes):
+            # Checks run concurrently, the invalid token rejects immediately
+            start = time.monotonic()
+            with pytest.raises(tornado.httpclient.HTTPClientError) as exc_info:
+                yield tornado.websocket.websocket_connect(
+                    url, subprotocols=["user", "token", "invalid"]
+                )
+            assert exc_info.value.code == 401
+            assert time.monotonic() - start < 0.1
+            assert metrics.handshake_latency.labels("token").count == 1
+
+            with pytest.raises(tornado.httpclient.HTTPClientError) as exc_info:
+                yield tornado.websocket.websocket_connect(
+                    url, subprotocols=["user", "token", "token"]
+                )
+            assert exc_info.value.code == 503
+            assert metrics.handshakes.labels("timeout").value == 1
+            assert metrics.handshake_latency.labels("total").count == 2
+            yield gen.sleep(0.3)
+        assert metrics.handshake_latency.labels("nodes").count == 2
+        assert ws_open.call_count == 0
+
+
+class TestReplayHandler(AsyncHTTPTestCase):
+    def get_app(self):
+        return WebApplication(
+            self.api,
+            use_local_api=True,
+            token="token",
+            record_dir=self.record_dir,
+        )
+
+    @pytest.fixture(autouse=True)
+    def _record_dir(self, tmpdir):
+        self.record_dir = str(tmpdir)
+
+    def setUp(self):
+        self.api = ApiClient("http")
+        super(TestReplayHandler, self).setUp()
+        self.api.port = self.get_http_port()
+
+    def tearDown(self):
+        self._app.recorder.stop()
+        super(TestReplayHandler, self).tearDown()
+
+    @patch("iotlabwebsocket.handlers.http_handler._nodes")
+    @gen_test
+    def test_replay(self, nodes):
+        nodes.return_value = json.dumps({"nodes": ["node-1.local"]})
+        recorder = self._app.recorder
+        recorder.open("node-1", "123")
+        recorder.record("node-1", NODE_OUTPUT, b"first")
+        recorder.record("node-1", NODE_INPUT, b"input")
+        recorder.record("node-1", NODE_OUTPUT, b"second")
+        yield recorder.close("node-1")
+
+        url = f"ws://localhost:{self.api.port}/replay/local/123/node-1?speed=0"
+        connection = yield tornado.websocket.websocket_connect(
+            url, subprotocols=["user", "token", "token"]
+        )
+        assert (yield connection.read_message()) == b"first"
+        assert (yield connection.read_message()) == b"second"
+        assert (yield connection.read_message()) is None
+        assert connection.close_reason == "End of recording"
+
+    @patch("iotlabwebsocket.web_application.MAX_WEBSOCKETS_PER_USER", 1)
+    @patch("iotlabwebsocket.handlers.http_handler._nodes")
+    @gen_test
+    def test_replay_limits(self, nodes):
+        nodes.return_value = json.dumps({"nodes": ["node-1.local"]})
+        recorder = self._app.recorder
+        recorder.open("node-1", "123")
+        with patch("time.time", side_effect=[0, 100]):
+            recorder.record("node-1", NODE_OUTPUT, b"first")
+            recorder.record("node-1", NODE_OUTPUT, b"later")
+        yield recorder.close("node-1")
+
+        url = f"ws://localhost:{self.api.port}/replay/local/123/node-1"
+        connection = yield tornado.websocket.websocket_connect(
+            url, subprotocols=["user", "token", "token"]
+        )
+        assert (yield connection.read_message()) == b"first"
+        assert self._app.sessions.users["user"] == 1
+
+        # Replays count as websockets of their user
+        refused = yield tornado.websocket.websocket_connect(
+            url, subprotocols=["user", "token", "token"]
+        )
+        assert (yield refused.read_message()) is None
+        assert refused.close_code == 1000
+
+        # and are closed when draining
+        yield self._app.drain(timeout=0)
+        assert (yield connection.read_message()) is None
+        assert connection.close_code == 1012
+        yield gen.sleep(0.1)
+        assert not self._app.replays
+        assert self._app.sessions.users["user"] == 0
+
+    @gen_test
+    def test_replay_invalid_speed(self):
+        url = "ws://localhost:{}/replay/local/123/node-1?speed={}"
+        for speed in ("fast", "-1", "nan", "inf"):
+            with pytest.raises(tornado.httpclient.HTTPClientError) as exc_info:
+                yield tornado.websocket.websocket_connect(
+                    url.format(self.api.port, speed),
+                    subprotocols=["user", "token", "token"],
+                )
+            assert exc_info.value.code == 400
+            assert exc_info.value.response.body == b"Invalid speed"
+        assert self._app.metrics.handshakes.labels("invalid_argument").value == 4
+        assert not self._app.replays
+
+    @patch("iotlabwebsocket.handlers.http_handler._nodes")
+    @gen_test
+    def test_replay_invalid_node(self, nodes):
+        nodes.return_value = json.dumps({"nodes": ["node-2.local"]})
+        url = f"ws://localhost:{self.api.port}/replay/local/123/node-1"
+        with pytest.raises(tornado.httpclient.HTTPClientError) as exc_info:
+            yield tornado.websocket.websocket_connect(
+                url, subprotocols=["user", "token", "token"]
+            )
+        assert exc_info.value.code == 401
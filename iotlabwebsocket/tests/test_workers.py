@@ -0,0 +1,286 @@
+"""iotlabwebsocket workers tests."""
+
+import asyncio
+import signal
+import socket
+
+import mock
+import tornado
+from tornado import gen
+from tornado.httpserver import HTTPServer
+from tornado.testing import AsyncTestCase, bind_unused_port, gen_test
+
+from iotlabwebsocket.workers import (
+    ConnectionReceiver,
+    Dispatcher,
+    _drain_worker_on_signal,
+    WorkerPool,
+    _reload_on_signals,
+    experiment_from_request_line,
+    receive_connection,
+    send_connection,
+)
+
+
+class WorkerHandler(tornado.web.RequestHandler):
+    # pylint:disable=abstract-method
+    def initialize(self, worker):
+        self.worker = worker
+
+    def get(self, *_):
+        self.write(self.worker)
+
+
+def test_experiment_from_request_line():
+    line = b"GET /ws/grenoble/123/m3-1/serial/raw HTTP/1.1"
+    assert experiment_from_request_line(line) == b"123"
+    assert experiment_from_request_line(b"GET /ws/grenoble/123/mux HTTP/1.1") == (
+        b"123"
+    )
+    line = b"GET /ws/grenoble/123/aggregate HTTP/1.1"
+    assert experiment_from_request_line(line) == b"123"
+    line = b"GET /replay/lille/456/a8-2?speed=0 HTTP/1.1"
+    assert experiment_from_request_line(line) == b"456"
+    line = b"GET /api/experiments/123/token HTTP/1.1"
+    assert experiment_from_request_line(line) is None
+
+
+def test_dispatcher_route():
+    dispatcher = Dispatcher([mock.Mock() for _ in range(4)])
+    # Websockets of an experiment always go to the same worker, the mux and
+    # aggregate ones read the sessions of its nodes
+    paths = [
+        "/ws/grenoble/123/mux",
+        "/ws/grenoble/123/aggregate",
+        "/ws/grenoble/123/m3-1/serial",
+        "/ws/grenoble/123/m3-2/serial/raw",
+        "/replay/grenoble/123/m3-1",
+    ]
+    lines = ["GET {} HTTP/1.1".format(path).encode() for path in paths]
+    assert len({dispatcher.route(line) for line in lines * 4}) == 1
+    line = b"GET /api/experiments HTTP/1.1"
+    assert len({dispatcher.route(line) for _ in range(4)}) == 4
+    # Metrics are always read from the same worker
+    for path, worker in (
+        ("/metrics", 0),
+        ("/metrics/2", 2),
+        ("/admin/latency/3?x=1", 3),
+        ("/metrics/9", 0),
+    ):
+        line = "GET {} HTTP/1.1".format(path).encode()
+        assert {dispatcher.route(line) for _ in range(4)} == {worker}
+
+
+def test_send_connection():
+    parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    connection = socket.socket()
+    send_connection(parent, b"address", connection.fileno())
+    message, fds = receive_connection(child)
+    assert message == b"address"
+    assert len(fds) == 1
+    received = socket.socket(fileno=fds[0])
+    assert received.getsockname() == connection.getsockname()
+    for sock in (received, connection, parent, child):
+        sock.close()
+
+
+def _signal_handlers(io_loop):
+    return {
+        args[0]: args[1:]
+        for args, _ in io_loop.asyncio_loop.add_signal_handler.call_args_list
+    }
+
+
+def test_reload_on_signals():
+    io_loop = mock.Mock()
+    pool = mock.Mock(stop=mock.AsyncMock())
+    _reload_on_signals(io_loop, pool)
+    handlers = _signal_handlers(io_loop)
+    assert set(handlers) == {signal.SIGTERM, signal.SIGHUP}
+
+    # SIGHUP reloads the workers
+    assert handlers[signal.SIGHUP] == (io_loop.spawn_callback, pool.reload)
+
+    # SIGTERM drains them, then stops
+    spawn, shutdown = handlers[signal.SIGTERM]
+    assert spawn == io_loop.spawn_callback
+    asyncio.run(shutdown())
+    pool.stop.assert_awaited_once()
+    io_loop.stop.assert_called_once()
+
+
+def test_drain_worker_on_signal():
+    io_loop = mock.Mock()
+    application = mock.Mock(draining=None, drain=mock.AsyncMock())
+    _drain_worker_on_signal(io_loop, application, 10, 3)
+    handlers = _signal_handlers(io_loop)
+    assert set(handlers) == {signal.SIGTERM}
+
+    spawn, shutdown = handlers[signal.SIGTERM]
+    assert spawn == io_loop.spawn_callback
+    asyncio.run(shutdown())
+    application.drain.assert_awaited_once_with(10, 3)
+    io_loop.stop.assert_called_once()
+
+    application.draining = "draining"
+    asyncio.run(shutdown())
+    application.drain.assert_awaited_once()
+
+
+class DispatcherTest(AsyncTestCase):
+    @gen_test
+    def test_dispatcher(self):
+        channels = []
+        receivers = []
+        for worker in ("worker-0", "worker-1"):
+            parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            application = tornado.web.Application(
+                [(r"/(.*)", WorkerHandler, dict(worker=worker))]
+            )
+            receiver = ConnectionReceiver(child, HTTPServer(application))
+            receiver.start()
+            channels.append(parent)
+            receivers.append(receiver)
+        dispatcher = Dispatcher(channels)
+        sock, port = bind_unused_port()
+        tornado.netutil.add_accept_handler(sock, dispatcher._peek)
+
+        client = tornado.httpclient.AsyncHTTPClient()
+        worker = dispatcher.route(b"GET /ws/grenoble/123/mux HTTP/1.1")
+        for path in (
+            "/ws/grenoble/123/mux",
+            "/ws/grenoble/123/aggregate",
+            "/ws/grenoble/123/m3-1/serial",
+            "/ws/grenoble/123/m3-2/serial",
+        ):
+            response = yield client.fetch("http://localhost:{}{}".format(port, path))
+            assert response.body.decode() == "worker-{}".format(worker)
+
+        for receiver in receivers:
+            receiver.stop()
+        sock.close()
+
+    def test_dispatcher_stop(self):
+        sock, _ = bind_unused_port()
+        dispatcher = Dispatcher([mock.Mock()])
+        dispatcher.accept([sock])
+        assert dispatcher.sockets == [sock]
+
+        # Sockets are kept for the next dispatcher
+        dispatcher.stop(close=False)
+        assert dispatcher.stopped
+        assert sock.fileno() != -1
+        assert dispatcher.sockets == [sock]
+
+        dispatcher.stop()
+        assert sock.fileno() == -1
+        assert dispatcher.sockets == []
+
+    @mock.patch("multiprocessing.active_children", return_value=[])
+    @mock.patch("multiprocessing.get_context")
+    @gen_test
+    def test_worker_pool(self, get_context, _):
+        processes = get_context.return_value.Process
+        processes.side_effect = lambda **_: mock.Mock(
+            **{"is_alive.return_value": False}
+        )
+        sock, _ = bind_unused_port()
+        pool = WorkerPool(2, mock.Mock(), drain_timeout=10, retry_after=3)
+        pool.start([sock])
+        assert processes.call_count == 2
+        _, kwargs = processes.call_args
+        assert kwargs["args"][2] is pool.make_application
+        assert kwargs["args"][4:] == (10, 3)
+        # Workers close the listening sockets
+        assert sock in kwargs["args"][3]
+        dispatcher, workers = pool.dispatcher, pool.workers
+        assert dispatcher.sockets == [sock]
+
+        # New workers get the new connections, the previous ones drain
+        yield pool.reload()
+        assert processes.call_count == 4
+        assert pool.dispatcher is not dispatcher
+        assert dispatcher.stopped
+        assert pool.dispatcher.sockets == [sock]
+        assert sock.fileno() != -1
+        for worker in workers:
+            worker.terminate.assert_called_once()
+        assert [channel.fileno() for channel in dispatcher.channels] == [-1, -1]
+        _, kwargs = processes.call_args
+        assert set(dispatcher.channels) <= set(kwargs["args"][3])
+
+        yield pool.stop()
+        assert pool.stopping
+        assert sock.fileno() == -1
+        for worker in pool.workers:
+            worker.terminate.assert_called_once()
+
+        # Nothing is reloaded once stopped
+        yield pool.reload()
+        assert processes.call_count == 4
+
+    @gen_test
+    def test_dispatcher_request_line(self):
+        dispatcher = Dispatcher([mock.Mock()])
+        address = ("127.0.0.1", 1234)
+        with mock.patch.object(
+            dispatcher, "_read_request_line", wraps=dispatcher._read_request_line
+        ) as read, mock.patch.object(dispatcher, "_dispatch") as dispatch:
+            # Connections closed by the client are dropped at once
+            client, connection = socket.socketpair()
+            dispatcher._peek(connection, address)
+            client.close()
+            yield gen.sleep(0.05)
+            assert connection.fileno() == -1
+            assert read.call_count == 1
+
+            # Idle connections are not polled, and dropped after the timeout
+            read.reset_mock()
+            with mock.patch("iotlabwebsocket.workers.REQUEST_LINE_TIMEOUT", 0.1):
+                client, connection = socket.socketpair()
+                dispatcher._peek(connection, address)
+                yield gen.sleep(0.2)
+            assert connection.fileno() == -1
+            read.assert_not_called()
+            client.close()
+
+            # Partial request lines are checked less and less often
+            read.reset_mock()
+            client, connection = socket.socketpair()
+            dispatcher._peek(connection, address)
+            client.send(b"GET /ws/grenoble")
+            yield gen.sleep(0.3)
+            assert read.call_count <= 6
+            client.send(b"/123/mux HTTP/1.1\r\n\r\n")
+            yield gen.sleep(0.4)
+            dispatch.assert_called_once_with(
+                connection, address, b"GET /ws/grenoble/123/mux HTTP/1.1"
+            )
+            client.close()
+            connection.close()
+
+    @gen_test
+    def test_dispatcher_full_channel(self):
+        parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        dispatcher = Dispatcher([parent])
+        connections = [socket.socket() for _ in range(2)]
+        with mock.patch(
+            "iotlabwebsocket.workers.send_connection",
+            side_effect=[BlockingIOError, None, None],
+        ) as send:
+            # Connections wait for the channel to be writable, in order
+            for connection in connections:
+                dispatcher._dispatch(connection, ("127.0.0.1", 1234), b"GET /")
+            assert send.call_count == 1
+            assert connections[0].fileno() != -1
+            yield gen.sleep(0.05)
+            assert send.call_count == 3
+        assert [connection.fileno() for connection in connections] == [-1, -1]
+        assert not dispatcher._waiting
+
+        with mock.patch("iotlabwebsocket.workers.MAX_PENDING_CONNECTIONS", 0):
+            connection = socket.socket()
+            dispatcher._dispatch(connection, ("127.0.0.1", 1234), b"GET /")
+            assert connection.fileno() == -1
+        parent.close()
+        child.close()
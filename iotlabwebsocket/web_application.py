@@ -1,25 +1,166 @@
 """iotlabwebserial main web application."""
 
-from collections import defaultdict
+import time
 
 import tornado
 import tornado.httpclient
+from tornado import gen
+from tornado.concurrent import Future, future_add_done_callback
+from tornado.httpserver import HTTPServer
+from tornado.websocket import WebSocketClosedError
 
 from . import DEFAULT_API_HOST
+from .coalescer import MAX_FRAME_SIZE, MAX_FRAME_DELAY, MAX_BUFFERED_BYTES
+from .broadcast import (
+    BroadcastMessage,
+    COMPRESSION_LEVEL,
+    COMPRESSION_MEM_LEVEL,
+    COMPRESSION_MIN_SIZE,
+)
+from .decoder import NodeDecoder
+from .listeners import bind_sockets, spawn_successor
 from .logger import LOGGER
-from .clients.tcp_client import TCPClient
+from .metrics import Metrics, MAX_NODE_LABELS, node_class
+from .recorder import Recorder, NODE_INPUT, NODE_OUTPUT
+from .scrollback import RingBuffer, SCROLLBACK_SIZE, SCROLLBACK_BUDGET
+from .sessions import SessionRegistry
+from .clients.connector import NodeConnector
+from .clients.tcp_client import (
+    TCPClient,
+    NODE_RATE,
+    NODE_BURST,
+    NODE_RECONNECT_WINDOW,
+    WRITE_HIGH_WATER,
+    WRITE_LOW_WATER,
+)
+from .handlers.aggregate_handler import AggregateHandler
 from .handlers.http_handler import HttpApiRequestHandler
+from .handlers.latency_handler import LatencyHandler
+from .handlers.metrics_handler import MetricsHandler
+from .handlers.mux_handler import MuxHandler
+from .handlers.replay_handler import ReplayHandler
 from .handlers.websocket_handler import WebsocketClientHandler
 
 MAX_WEBSOCKETS_PER_NODE = 2
 MAX_WEBSOCKETS_PER_USER = 10
+MAX_LINGERING_NODES = 256
+LINGER_BUFFER_SIZE = 65536  # bytes
+LINGER_POLICIES = ("drop", "buffer")
+WRITE_POLICIES = ("pause", "reject")
+COMPRESSION_MODES = ("off", "context", "shared")
+OUTPUT_POLICIES = ("drop", "pause", "close")
+DRAIN_TIMEOUT = 30  # seconds
+HANDSHAKE_TIMEOUT = 15  # seconds
+DRAIN_INTERVAL = 0.1  # seconds
+FLUSH_TIMEOUT = 2  # seconds
+RETRY_AFTER = 5  # seconds
 
 
 class WebApplication(tornado.web.Application):
-    """IoT-LAB websocket to tcp redirector."""
+    """IoT-LAB websocket to tcp redirector.
 
-    def __init__(self, api, use_local_api=False, token=""):
-        settings = {"debug": True}
+    Extra keyword arguments are stored in the application settings, where
+    they configure the node connections:
+
+    - `node_rate`: maximum node output rate in bytes per second
+    - `node_burst`: maximum node output burst in bytes
+    - `node_disconnect_after`: disconnect a node throttled for more than
+      this number of seconds (disabled by default)
+    - `node_zero_copy`: read node output in reusable buffers
+    - `node_reconnect_window`: number of seconds during which a lost node
+      connection is reopened before its websockets are closed (0 disables
+      reconnection)
+    - `node_linger`: number of seconds a node connection is kept open after
+      its last websocket is closed (0 disables it), a lost connection is not
+      kept
+    - `node_linger_policy`: 'drop' to discard the output of a lingering node
+      or 'buffer' to send its last bytes to the next websocket
+    - `node_linger_max`: maximum number of lingering node connections, the
+      oldest one is closed above this number (0 disables lingering)
+    - `node_write_high_water`: number of bytes queued for a node above which
+      websocket input is paused or rejected
+    - `node_write_low_water`: number of bytes queued for a node below which
+      paused websocket input is resumed
+    - `node_write_policy`: 'pause' to stop reading websockets of a node with
+      too many queued bytes or 'reject' to drop their messages, multiplexed
+      websockets always reject
+    - `node_address_preload`: resolve the addresses of all the nodes of an
+      experiment on its first websocket connection
+    - `scrollback_size`: number of bytes of recent node output replayed to
+      new websockets (0 disables it)
+    - `scrollback_lines`: maximum number of lines of recent node output
+      replayed to new websockets
+    - `scrollback_budget`: maximum number of bytes used by the scrollback of
+      all nodes, nodes opened above this budget have no scrollback
+    - `coalesce_max_size`: maximum size in bytes of the frames merging node
+      output sent to a busy websocket (0 disables merging)
+    - `coalesce_max_delay`: maximum delay in seconds before merged node
+      output is sent to a busy websocket
+    - `record_dir`: directory where the traffic of the nodes is recorded,
+      also enables the replay websockets (disabled by default)
+    - `record_mmap`: read recordings with mmap when replaying them
+    - `compression`: 'off' to disable permessage-deflate, 'context' to
+      compress the messages of each websocket with context takeover or
+      'shared' to compress each node output message once, without context
+      takeover, for all websockets
+    - `compression_level`: zlib compression level
+    - `compression_mem_level`: zlib memory level
+    - `compression_min_size`: size in bytes below which messages are not
+      compressed, in both compression modes
+    - `output_buffer_max`: number of bytes of node output buffered for a
+      websocket above which it is considered too slow (0 for no limit)
+    - `output_buffer_policy`: 'drop' to drop the oldest output of a too slow
+      websocket, 'pause' to also stop reading a node whose websockets are
+      all too slow or 'close' to close too slow websockets
+    - `user_counters`: counters of the websockets of each user, shared with
+      the other worker processes (counted in this process by default)
+    - `metrics`: export the metrics of the application on `/metrics`
+    - `metrics_max_nodes`: maximum number of nodes with their own metrics,
+      the other nodes are counted together
+    - `latency_sample_rate`: fraction of the node reads whose latency to the
+      websockets is measured, also enables `/admin/latency` (0 disables it)
+    - `worker`: index of the worker process serving the application, if
+      several, its metrics are labelled and served on `/metrics/<worker>`
+    - `handshake_timeout`: number of seconds after which a websocket
+      handshake waiting for the REST API is answered with a 503
+    """
+
+    def __init__(self, api, use_local_api=False, token="", **kwargs):
+        settings = {
+            "debug": True,
+            "node_rate": NODE_RATE,
+            "node_burst": NODE_BURST,
+            "node_disconnect_after": None,
+            "node_zero_copy": False,
+            "node_reconnect_window": NODE_RECONNECT_WINDOW,
+            "node_linger": 0,
+            "node_linger_policy": "drop",
+            "node_linger_max": MAX_LINGERING_NODES,
+            "node_write_high_water": WRITE_HIGH_WATER,
+            "node_write_low_water": WRITE_LOW_WATER,
+            "node_write_policy": "pause",
+            "node_address_preload": False,
+            "scrollback_size": SCROLLBACK_SIZE,
+            "scrollback_lines": None,
+            "scrollback_budget": SCROLLBACK_BUDGET,
+            "coalesce_max_size": MAX_FRAME_SIZE,
+            "coalesce_max_delay": MAX_FRAME_DELAY,
+            "record_dir": None,
+            "record_mmap": False,
+            "compression": "off",
+            "compression_level": COMPRESSION_LEVEL,
+            "compression_mem_level": COMPRESSION_MEM_LEVEL,
+            "compression_min_size": COMPRESSION_MIN_SIZE,
+            "output_buffer_max": MAX_BUFFERED_BYTES,
+            "output_buffer_policy": "drop",
+            "user_counters": None,
+            "metrics": False,
+            "metrics_max_nodes": MAX_NODE_LABELS,
+            "latency_sample_rate": 0,
+            "worker": None,
+            "handshake_timeout": HANDSHAKE_TIMEOUT,
+        }
+        settings.update(kwargs)
         handlers = [
             (
                 r"/ws/[a-z0-9\-_]+/[0-9]+/[a-z0-9]+-?[a-z0-9]*-?[0-9]*/serial",
@@ -31,8 +172,49 @@ class WebApplication(tornado.web.Application):
                 WebsocketClientHandler,
                 dict(api=api, text=False),
             ),
+            (
+                r"/ws/[a-z0-9\-_]+/[0-9]+/[a-z0-9]+-?[a-z0-9]*-?[0-9]*/serial/lines",
+                WebsocketClientHandler,
+                dict(api=api, text=True, lines=True),
+            ),
+            (r"/ws/[a-z0-9\-_]+/[0-9]+/mux", MuxHandler, dict(api=api)),
+            (r"/ws/[a-z0-9\-_]+/[0-9]+/aggregate", AggregateHandler, dict(api=api)),
         ]
 
+        self.recorder = None
+        if settings["record_dir"]:
+            self.recorder = Recorder(settings["record_dir"])
+            handlers.append(
+                (
+                    r"/replay/[a-z0-9\-_]+/[0-9]+/[a-z0-9]+-?[a-z0-9]*-?[0-9]*",
+                    ReplayHandler,
+                    dict(
+                        api=api,
+                        recorder=self.recorder,
+                        use_mmap=settings["record_mmap"],
+                    ),
+                )
+            )
+
+        self.metrics = Metrics(settings["metrics_max_nodes"], settings["worker"])
+        self.metrics.add_collector(self._collect_metrics)
+        api.metrics = self.metrics
+        if settings["metrics"]:
+            handlers.append(
+                (r"/metrics(?:/([0-9]+))?", MetricsHandler, dict(metrics=self.metrics))
+            )
+        if settings["latency_sample_rate"]:
+            handlers.append(
+                (
+                    r"/admin/latency(?:/([0-9]+))?",
+                    LatencyHandler,
+                    dict(
+                        metrics=self.metrics,
+                        sample_rate=settings["latency_sample_rate"],
+                    ),
+                )
+            )
+
         if use_local_api:
             api.protocol = "http"
             api.host = DEFAULT_API_HOST
@@ -44,9 +226,23 @@ class WebApplication(tornado.web.Application):
                 )
             )
 
-        self.tcp_clients = defaultdict(TCPClient)
-        self.websockets = defaultdict(list)
-        self.user_connections = defaultdict(int)
+        self.sessions = SessionRegistry(
+            settings["user_counters"], self.metrics.node_bytes
+        )
+        # Open multiplexed websockets, their channels are in the sessions
+        self.multiplexers = set()
+        # Open replay websockets, they have no session
+        self.replays = set()
+        self.node_connector = NodeConnector()
+        self.scrollback_memory = 0
+        self._frames_in = self.metrics.frames.labels("in")
+        # Counters of the closed websockets and node connections
+        self._closed_frames = 0
+        self._closed_throttles = 0
+        self.server = None
+        self.listeners = []
+        # Close reason of the websockets opened while draining
+        self.draining = None
         
         # Configure global proxy settings if available
         self._init_proxy_settings(api.proxy)
@@ -78,84 +274,526 @@ class WebApplication(tornado.web.Application):
                 }
                 tornado.httpclient.AsyncHTTPClient.configure(None, defaults=defaults)
                 
+    def listen(self, port, address=None, **kwargs):
+        """Serve port, on the listening sockets inherited if any.
+
+        Sockets are inherited from systemd socket activation or from the
+        previous process of the service, see `restart`.
+        """
+        self.listeners = bind_sockets(port, address)
+        self.server = HTTPServer(self, **kwargs)
+        self.server.add_sockets(self.listeners)
+        return self.server
+
+    def _new_tcp_client(self):
+        return TCPClient(
+            rate=self.settings["node_rate"],
+            burst=self.settings["node_burst"],
+            disconnect_after=self.settings["node_disconnect_after"],
+            zero_copy=self.settings["node_zero_copy"],
+            reconnect_window=self.settings["node_reconnect_window"],
+            write_high_water=self.settings["node_write_high_water"],
+            write_low_water=self.settings["node_write_low_water"],
+            connector=self.node_connector,
+            sample_interval=self._latency_sample_interval(),
+        )
+
+    def _latency_sample_interval(self):
+        rate = self.settings["latency_sample_rate"]
+        if not rate:
+            return 0
+        return max(1, round(1 / rate))
+
+    def handle_experiment_nodes(self, nodes):
+        """Handle the node list fetched for an experiment."""
+        if self.settings["node_address_preload"]:
+            tornado.ioloop.IOLoop.current().spawn_callback(
+                self.node_connector.load_nodes, nodes
+            )
+
     def handle_websocket_open(self, websocket):
         """Handle the websocket connection once authentified."""
         node = websocket.node
-        user = websocket.user
-        site = websocket.site
-        tcp_client = self.tcp_clients[node]
-        if not self.websockets[node]:
+        if self.draining is not None:
+            websocket.close(code=1012, reason=self.draining)
+            return
+        # Multiplexed websockets are counted once for their user, read-only
+        # ones don't take the place of the websockets of the node
+        reason = self.sessions.reserve(
+            websocket,
+            None if websocket.read_only else MAX_WEBSOCKETS_PER_NODE,
+            None if websocket.multiplexed else MAX_WEBSOCKETS_PER_USER,
+        )
+        # Channels of multiplexed websockets are not handshakes, their
+        # websocket is counted once, see `handle_mux_open`
+        count_handshake = not websocket.multiplexed
+        if reason is not None:
+            if count_handshake:
+                self.metrics.handshakes.labels("refused").inc()
+            websocket.close(code=1000, reason=reason)
+            return
+        session = self.sessions.get(node)
+        buffered = None
+        if session is None:
             # Open the tcp connection on first websocket connection.
-            tcp_client.start(
-                node, on_data=self.handle_tcp_data, on_close=self.handle_tcp_close
-            )
-        if len(self.websockets[node]) == MAX_WEBSOCKETS_PER_NODE:
-            websocket.close(
-                code=1000,
-                reason=(
-                    "Cannot open more than {} "
-                    "connections to node {}.".format(MAX_WEBSOCKETS_PER_NODE, node)
-                ),
+            session = self.sessions.open(node, self._new_tcp_client())
+            self._new_scrollback(session)
+            if self.recorder is not None:
+                self.recorder.open(node, websocket.experiment_id)
+            session.tcp_client.start(
+                node,
+                on_data=self.handle_tcp_data,
+                on_close=self.handle_tcp_close,
+                on_status=self.handle_tcp_status,
+                site=websocket.site,
             )
-        elif self.user_connections[user] == MAX_WEBSOCKETS_PER_USER:
-            websocket.close(
-                code=1000,
-                reason=(
-                    "Max number of connections ({}) "
-                    "reached for user {} on site {}.".format(MAX_WEBSOCKETS_PER_USER, user, site)
-                ),
+        elif session.lingering:
+            # Reuse the warm tcp connection
+            buffered = self._unlinger(session)
+        self.sessions.attach(session, websocket)
+        if count_handshake:
+            self.metrics.handshakes.labels("accepted").inc()
+        self.metrics.websockets.labels(websocket.endpoint).inc()
+        if session.scrollback is not None:
+            self._replay_scrollback(session, websocket)
+        elif buffered:
+            self.handle_tcp_data(node, bytes(buffered))
+
+    def handle_mux_open(self, handler):
+        """Handle a multiplexed websocket once authentified.
+
+        Return True if it is accepted.
+        """
+        if self.draining is not None:
+            handler.close(code=1012, reason=self.draining)
+            return False
+        reason = self.sessions.reserve_user(
+            handler.user, handler.site, MAX_WEBSOCKETS_PER_USER
+        )
+        if reason is not None:
+            self.metrics.handshakes.labels("refused").inc()
+            handler.close(code=1000, reason=reason)
+            return False
+        self.multiplexers.add(handler)
+        self.metrics.handshakes.labels("accepted").inc()
+        return True
+
+    def handle_mux_close(self, handler):
+        """Handle the disconnection of a multiplexed websocket.
+
+        Its channels are already closed.
+        """
+        if handler in self.multiplexers:
+            self.multiplexers.remove(handler)
+            self.sessions.release_user(handler.user)
+            self._closed_frames += handler.frames
+
+    def handle_replay_open(self, handler):
+        """Handle a replay websocket once authentified.
+
+        Return True if it is accepted.
+        """
+        if self.draining is not None:
+            handler.close(code=1012, reason=self.draining)
+            return False
+        reason = self.sessions.reserve_user(
+            handler.user, handler.site, MAX_WEBSOCKETS_PER_USER
+        )
+        if reason is not None:
+            self.metrics.handshakes.labels("refused").inc()
+            handler.close(code=1000, reason=reason)
+            return False
+        self.replays.add(handler)
+        self.metrics.handshakes.labels("accepted").inc()
+        self.metrics.websockets.labels(handler.endpoint).inc()
+        return True
+
+    def handle_replay_close(self, handler):
+        """Handle the disconnection of a replay websocket."""
+        if handler in self.replays:
+            self.replays.remove(handler)
+            self.sessions.release_user(handler.user)
+            self.metrics.websockets.labels(handler.endpoint).dec()
+
+    def _new_scrollback(self, session):
+        size = self.settings["scrollback_size"]
+        if not size:
+            return
+        if self.scrollback_memory + size > self.settings["scrollback_budget"]:
+            LOGGER.debug(
+                "Scrollback budget exhausted, none for '{}'".format(session.node)
             )
-        else:
-            self.user_connections[user] += 1
-            self.websockets[node].append(websocket)
+            return
+        session.scrollback = RingBuffer(size)
+        self.scrollback_memory += size
+
+    def _replay_scrollback(self, session, websocket):
+        """Send the recent output of the node in one message."""
+        data = session.scrollback.read(self.settings["scrollback_lines"])
+        if not data:
+            return
+        if not websocket.text:
+            websocket.send_node_output(data)
+            return
+        # Scrollback can start in the middle of a character
+        text = data.decode("utf-8", "ignore")
+        if not websocket.lines:
+            websocket.send_node_output(text)
+            return
+        # Partial line will be sent when completed
+        for line in text.split("\n")[:-1]:
+            websocket.send_node_output(line[:-1] if line.endswith("\r") else line)
 
     def handle_websocket_data(self, websocket, data):
-        """Handle a message coming from a websocket."""
-        tcp_client = self.tcp_clients[websocket.node]
-        if tcp_client.ready:
+        """Handle a message coming from a websocket.
+
+        Return a future when reading from the websocket must be paused until
+        the node has consumed its queued input.
+
+        A multiplexed websocket is never paused, it would stop the input of
+        all its channels for one slow node: input of a channel whose node
+        queue is full is rejected instead, whatever the policy. The client
+        has to resend it, but other channels keep flowing.
+        """
+        self._frames_in.inc()
+        session = self.sessions.get(websocket.node)
+        tcp_client = session.tcp_client if session is not None else None
+        policy = self.settings["node_write_policy"]
+        if websocket.multiplexed:
+            policy = "reject"
+        if tcp_client is not None and tcp_client.ready:
+            if not tcp_client.writable and policy == "reject":
+                LOGGER.debug("Node input queue is full, rejecting message")
+                websocket.write_message(
+                    "Node {} input queue is full ({} bytes), cannot send "
+                    "message.\n".format(websocket.node, tcp_client.queued_bytes)
+                )
+                return None
             tcp_client.send(data)
+            session.input_bytes.inc(len(data))
+            if self.recorder is not None:
+                self.recorder.record(websocket.node, NODE_INPUT, data)
+            if not tcp_client.writable and policy == "pause":
+                LOGGER.debug("Node input queue is full, pausing websocket")
+                return tcp_client.drained()
         else:
             LOGGER.debug("No TCP connection opened, skipping message")
             websocket.write_message(
                 "No TCP connection opened, cannot send "
-                "message '{}'.\n".format(data.decode('utf-8'))
+                "message '{}'.\n".format(data.decode("utf-8", "replace"))
             )
+        return None
+
+    def handle_group_write(self, nodes, data):
+        """Write data to several nodes in one pass, return their delivery status.
+
+        Nodes with a full input queue are skipped whatever the policy, as for
+        the channels of a multiplexed websocket: waiting for the slowest node
+        would pause the input of all the others.
+        """
+        self._frames_in.inc()
+        statuses = {}
+        for node in nodes:
+            session = self.sessions.get(node)
+            tcp_client = session.tcp_client if session is not None else None
+            if tcp_client is None or not tcp_client.ready:
+                statuses[node] = "not_connected"
+                continue
+            if not tcp_client.writable:
+                statuses[node] = "queue_full"
+                continue
+            tcp_client.send(data)
+            session.input_bytes.inc(len(data))
+            if self.recorder is not None:
+                self.recorder.record(node, NODE_INPUT, data)
+            statuses[node] = "sent"
+        return statuses
 
     def handle_websocket_close(self, websocket):
         """Handle the disconnection of a websocket."""
-        node = websocket.node
-        user = websocket.user
-        tcp_client = self.tcp_clients[node]
-        if websocket in self.websockets[node]:
-            self.websockets[node].remove(websocket)
-        if self.user_connections[user] > 0:
-            self.user_connections[user] -= 1
-
-        # websockets list is now empty for given node, closing tcp connection.
-        if tcp_client.ready and not self.websockets[node]:
-            LOGGER.debug("Closing TCP connection to node '{}'".format(node))
-            tcp_client.stop()
-            self.tcp_clients.pop(node)
-            del tcp_client
+        session = self.sessions.detach(
+            websocket, release_user=not websocket.multiplexed
+        )
+        if session is None:
+            return
+        self.metrics.websockets.labels(websocket.endpoint).dec()
+        if not websocket.multiplexed:
+            # Frames of multiplexed websockets are counted with their carrier
+            self._closed_frames += websocket.output.frames
+        if session.websockets:
+            return
+        session.decoder = None
+
+        # websockets list is now empty for given node, closing tcp connection,
+        # even if it is not ready yet (connecting or reconnecting). Only an
+        # open connection lingers, not one lost or closed for its rate.
+        if (
+            self.settings["node_linger"]
+            and self.settings["node_linger_max"] > 0
+            and session.tcp_client.ready
+        ):
+            self._linger(session)
+        else:
+            self._close_session(session)
+
+    def _close_session(self, session):
+        LOGGER.debug("Closing TCP connection to node '{}'".format(session.node))
+        self.sessions.close(session.node)
+        session.tcp_client.stop()
+        self._release_session(session)
+
+    def _release_session(self, session):
+        self._closed_throttles += session.tcp_client.throttles
+        if session.scrollback is not None:
+            self.scrollback_memory -= session.scrollback.size
+            session.scrollback = None
+        if self.recorder is not None:
+            self.recorder.close(session.node)
+
+    def _linger(self, session):
+        """Keep the tcp connection of a node without websocket open."""
+        if len(self.sessions.lingering) >= self.settings["node_linger_max"]:
+            oldest = self.sessions.oldest_lingering()
+            LOGGER.debug("Too many lingering nodes, closing '{}'".format(oldest.node))
+            self._unlinger(oldest)
+            self._close_session(oldest)
+        LOGGER.debug("Keeping TCP connection to node '{}' open".format(session.node))
+        timeout = tornado.ioloop.IOLoop.current().call_later(
+            self.settings["node_linger"], self._linger_expired, session
+        )
+        buffered = None
+        if self.settings["node_linger_policy"] == "buffer":
+            buffered = bytearray()
+        self.sessions.linger(session, timeout, buffered)
+
+    def _unlinger(self, session):
+        """Return the output buffered while the node was lingering."""
+        timeout, buffered = self.sessions.unlinger(session)
+        tornado.ioloop.IOLoop.current().remove_timeout(timeout)
+        return buffered
+
+    def _linger_expired(self, session):
+        self.sessions.unlinger(session)
+        self._close_session(session)
 
     def handle_tcp_data(self, node, data):
-        """Forwards data from TCP connection to all websocket clients."""
-        for websocket in self.websockets[node]:
-            if websocket.text:
-                try:
-                    data = data.decode("utf-8")
-                except UnicodeDecodeError:
-                    LOGGER.debug("Cannot decode message: {}".format(data))
+        """Forwards data from TCP connection to all websocket clients.
+
+        `data` can be a memoryview on a reused buffer: it is decoded or
+        copied once, before returning, for all websockets. Text is decoded
+        incrementally, once per node, and split in lines only if a websocket
+        requested lines. Each message is framed once for all websockets.
+        """
+        session = self.sessions.get(node)
+        if session is None:
+            return
+        session.output_bytes.inc(len(data))
+        # Output of a lingering node is only kept with the 'buffer' policy
+        dropped = session.lingering and session.linger_buffer is None
+        if session.scrollback is not None and not dropped:
+            session.scrollback.write(data)
+        if self.recorder is not None:
+            self.recorder.record(node, NODE_OUTPUT, data)
+        if session.linger_buffer is not None:
+            buffered = session.linger_buffer
+            buffered += data
+            # Only keep the most recent bytes
+            del buffered[:-LINGER_BUFFER_SIZE]
+            return
+        websockets = session.websockets
+        min_size = self.settings["compression_min_size"]
+        text = None
+        lines = ()
+        if any(websocket.text for websocket in websockets):
+            if session.decoder is None:
+                session.decoder = NodeDecoder()
+            text = session.decoder.decode(data)
+            if text is None:
+                LOGGER.debug("Cannot decode message: {}".format(bytes(data)))
+            elif any(websocket.lines for websocket in websockets):
+                lines = [
+                    BroadcastMessage(line, False, min_size)
+                    for line in session.decoder.lines(text)
+                ]
+            if text:
+                text = BroadcastMessage(text, False, min_size)
+        payload = None
+        for websocket in websockets:
+            if websocket.lines:
+                for line in lines:
+                    websocket.send_node_output(line)
+            elif websocket.text:
+                if text:
+                    websocket.send_node_output(text)
+            else:
+                if payload is None:
+                    payload = BroadcastMessage(bytes(data), True, min_size)
+                websocket.send_node_output(payload)
+        if session.tcp_client.read_time is not None:
+            self._sample_latency(session, session.tcp_client.read_time)
+        if (
+            websockets
+            and self.settings["output_buffer_policy"] == "pause"
+            and all(websocket.output.full for websocket in websockets)
+        ):
+            self._pause_tcp_client(session)
+
+    def _sample_latency(self, session, read_time):
+        """Observe the latency of a sampled node read up to the websockets."""
+        metrics = self.metrics
+        name = node_class(session.node)
+        metrics.fanout_latency.labels(name).observe(time.monotonic() - read_time)
+
+        def _written(histogram):
+            histogram.observe(time.monotonic() - read_time)
+
+        for websocket in session.websockets:
+            histogram = metrics.output_latency.labels(name, websocket.endpoint)
+            websocket.output.on_written(lambda histogram=histogram: _written(histogram))
+
+    def _pause_tcp_client(self, session):
+        """Stop reading a node until one of its websockets is drained."""
+        LOGGER.debug(
+            "All websockets of node '{}' are full, pausing".format(session.node)
+        )
+        resume = Future()
+
+        def _resume(_):
+            if not resume.done():
+                resume.set_result(None)
+
+        for websocket in session.websockets:
+            future_add_done_callback(websocket.output.drained(), _resume)
+        session.tcp_client.pause(resume)
+
+    def output_stats(self):
+        """Return the output buffer counters of the websockets, by node."""
+        return {
+            session.node: [
+                dict(websocket.output.stats, user=websocket.user)
+                for websocket in session.websockets
+            ]
+            for session in self.sessions
+            if session.websockets
+        }
+
+    def _collect_metrics(self):
+        """Update the metrics read from the sessions."""
+        metrics = self.metrics
+        states = dict.fromkeys(("connecting", "connected", "lingering"), 0)
+        frames = self._closed_frames
+        throttles = self._closed_throttles
+        websocket_buffers = metrics.write_buffers.labels("websocket")
+        node_buffers = metrics.write_buffers.labels("node")
+        websocket_buffers.reset()
+        node_buffers.reset()
+        for session in self.sessions:
+            tcp_client = session.tcp_client
+            if session.lingering:
+                states["lingering"] += 1
+            elif tcp_client.ready:
+                states["connected"] += 1
+            else:
+                states["connecting"] += 1
+            throttles += tcp_client.throttles
+            node_buffers.observe(tcp_client.queued_bytes)
+            for websocket in session.websockets:
+                if websocket.multiplexed:
                     continue
-            websocket.write_message(data, binary=not websocket.text)
+                frames += websocket.output.frames
+                websocket_buffers.observe(websocket.output.buffered_bytes)
+        for handler in self.multiplexers:
+            frames += handler.frames
+            websocket_buffers.observe(handler.buffered_bytes)
+        for state, count in states.items():
+            metrics.node_connections.labels(state).set(count)
+        metrics.frames.labels("out").set(frames)
+        metrics.throttles.labels().set(throttles)
 
     def handle_tcp_close(self, node, reason="Cannot connect"):
         """Close all websockets connected to a node when TCP is closed."""
-        for websocket in self.websockets[node]:
+        session = self.sessions.get(node)
+        if session is None:
+            return
+        if session.lingering:
+            self._unlinger(session)
+            self._close_session(session)
+        else:
+            # Stop reading from a node closed for its rate, its websockets
+            # then close the session instead of lingering
+            session.tcp_client.stop()
+        for websocket in list(session.websockets):
             websocket.close(code=1000, reason=reason)
 
+    def handle_tcp_status(self, node, message):
+        """Notify all websockets connected to a node of a TCP status change."""
+        for websocket in self.sessions.websockets(node):
+            try:
+                websocket.write_message("{}.\n".format(message))
+            except WebSocketClosedError:
+                continue
+
+    async def restart(self, timeout=DRAIN_TIMEOUT, retry_after=RETRY_AFTER):
+        """Hand the listening sockets over to a new process, then drain.
+
+        The new process accepts the new connections while the websockets of
+        this one are drained.
+        """
+        spawn_successor(self.listeners)
+        await self.drain(timeout, retry_after)
+
+    async def drain(self, timeout=DRAIN_TIMEOUT, retry_after=RETRY_AFTER):
+        """Stop accepting connections and close the websockets gracefully.
+
+        Websockets are left open until their client closes them, for up to
+        `timeout` seconds. The remaining ones are then closed once their
+        pending output is written, with a close reason telling clients to
+        reconnect after `retry_after` seconds.
+        """
+        LOGGER.info("Draining websockets for up to {} seconds".format(timeout))
+        self.draining = "Server is restarting, retry after {} seconds".format(
+            retry_after
+        )
+        if self.server is not None:
+            self.server.stop()
+        deadline = tornado.ioloop.IOLoop.current().time() + timeout
+        while any(session.websockets for session in self.sessions):
+            if tornado.ioloop.IOLoop.current().time() >= deadline:
+                break
+            await gen.sleep(DRAIN_INTERVAL)
+        websockets = [
+            websocket
+            for session in self.sessions
+            for websocket in session.websockets
+        ]
+        flushed = []
+        for websocket in websockets:
+            future = Future()
+            websocket.output.on_written(lambda future=future: future.set_result(None))
+            websocket.output.flush()
+            flushed.append(future)
+        try:
+            await gen.with_timeout(
+                tornado.ioloop.IOLoop.current().time() + FLUSH_TIMEOUT,
+                gen.multi(flushed),
+            )
+        except gen.TimeoutError:
+            LOGGER.warning("Cannot write the pending output of all websockets")
+        for websocket in websockets:
+            websocket.close(code=1012, reason=self.draining)
+        for handler in list(self.multiplexers) + list(self.replays):
+            handler.close(code=1012, reason=self.draining)
+        self.stop()
+
     def stop(self):
         """Stop any pending websocket connection."""
-        for websockets in self.websockets.values():
-            for websocket in websockets:
+        for session in list(self.sessions.lingering.values()):
+            self._unlinger(session)
+            self._close_session(session)
+        for session in self.sessions:
+            for websocket in list(session.websockets):
                 websocket.close(code=1001, reason="server is restarting")
+        for handler in list(self.multiplexers) + list(self.replays):
+            handler.close(code=1001, reason="server is restarting")
+        if self.recorder is not None:
+            self.recorder.stop()
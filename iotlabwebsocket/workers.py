@@ -0,0 +1,405 @@
+"""Dispatch of the connections to several worker processes."""
+
+import array
+import asyncio
+import json
+import multiprocessing
+import os
+import re
+import signal
+import socket
+import zlib
+from collections import deque
+
+import tornado.netutil
+from tornado import gen
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+
+from .listeners import bind_sockets
+from .logger import LOGGER
+from .web_application import DRAIN_INTERVAL, DRAIN_TIMEOUT, RETRY_AFTER
+
+MAX_REQUEST_LINE = 4096  # bytes
+REQUEST_LINE_TIMEOUT = 10  # seconds
+PEEK_INTERVAL = 0.01  # seconds
+MAX_PEEK_INTERVAL = 1  # seconds
+MAX_PENDING_CONNECTIONS = 128
+EXPERIMENT_PATH = re.compile(rb"^[A-Z]+ /(?:ws|replay)/[^/ ]+/([^/? ]+)")
+# Metrics of worker N are served on /metrics/N, /metrics by the first one
+WORKER_PATH = re.compile(rb"^[A-Z]+ /(?:metrics|admin/latency)(?:/([0-9]+))?[? ]")
+
+
+def experiment_from_request_line(line):
+    """Return the experiment requested by an HTTP request line, None if any."""
+    match = EXPERIMENT_PATH.match(line)
+    return match.group(1) if match else None
+
+
+def send_connection(channel, message, fd):
+    """Send message and the file descriptor fd on a unix socket channel."""
+    channel.sendmsg(
+        [message], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [fd]))]
+    )
+
+
+def receive_connection(channel):
+    """Return the message and the file descriptors received on channel."""
+    fds = array.array("i")
+    message, ancdata, _, _ = channel.recvmsg(
+        MAX_REQUEST_LINE, socket.CMSG_LEN(fds.itemsize)
+    )
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[: len(data) - (len(data) % fds.itemsize)])
+    return message, list(fds)
+
+
+class Dispatcher:
+    """Class that hands the accepted connections over to worker processes.
+
+    The request line of each connection is peeked, without reading it, once
+    the connection is readable, and the connection is sent to the worker
+    selected by a hash of the requested experiment: all the websockets of an
+    experiment, including the mux and aggregate ones which read the sessions
+    of its nodes, are handled by the same worker. Connections closed before
+    sending their request line are dropped at once, those too slow to send
+    it after `REQUEST_LINE_TIMEOUT` seconds.
+    Metrics requests go to the worker in their path, the first one by
+    default, so each scrape reads the counters of the same worker. Other
+    requests are spread over the workers in turn.
+
+    Connections are queued while the channel of their worker is full, up to
+    `MAX_PENDING_CONNECTIONS`, so a slow worker doesn't stall the others.
+    """
+
+    def __init__(self, channels):
+        self.channels = channels
+        for channel in channels:
+            channel.setblocking(False)
+        self._next = 0
+        self._pending = [deque() for _ in channels]
+        self._waiting = set()
+        self.sockets = []
+        self._remove_handlers = []
+        self.stopped = False
+
+    def accept(self, sockets):
+        """Accept connections on the listening sockets."""
+        self.sockets = list(sockets)
+        for sock in self.sockets:
+            self._remove_handlers.append(
+                tornado.netutil.add_accept_handler(sock, self._peek)
+            )
+
+    def stop(self, close=True):
+        """Stop accepting connections, close the listening sockets if close."""
+        self.stopped = True
+        for remove_handler in self._remove_handlers:
+            remove_handler()
+        self._remove_handlers = []
+        if close:
+            for sock in self.sockets:
+                sock.close()
+            self.sockets = []
+
+    def route(self, line):
+        """Return the index of the worker for a request line."""
+        experiment = experiment_from_request_line(line)
+        if experiment is not None:
+            return zlib.crc32(experiment) % len(self.channels)
+        match = WORKER_PATH.match(line)
+        if match:
+            # Unknown workers are answered with a 404 by the first one
+            worker = int(match.group(1) or 0)
+            return worker if worker < len(self.channels) else 0
+        self._next = (self._next + 1) % len(self.channels)
+        return self._next
+
+    def _peek(self, connection, address):
+        connection.setblocking(False)
+        # Connections that don't send their request line in time are closed
+        timeout = IOLoop.current().call_later(
+            REQUEST_LINE_TIMEOUT, self._expire, connection
+        )
+        self._wait_request_line(connection, address, timeout, PEEK_INTERVAL)
+
+    @staticmethod
+    def _expire(connection):
+        IOLoop.current().remove_handler(connection)
+        connection.close()
+
+    def _wait_request_line(self, connection, address, timeout, interval):
+        if connection.fileno() == -1:
+            # Closed by its timeout
+            return
+        IOLoop.current().add_handler(
+            connection,
+            lambda *_: self._read_request_line(connection, address, timeout, interval),
+            IOLoop.READ,
+        )
+
+    def _read_request_line(self, connection, address, timeout, interval):
+        io_loop = IOLoop.current()
+        io_loop.remove_handler(connection)
+        try:
+            data = connection.recv(MAX_REQUEST_LINE, socket.MSG_PEEK)
+        except BlockingIOError:
+            self._wait_request_line(connection, address, timeout, interval)
+            return
+        except OSError:
+            data = b""
+        if not data:
+            # Closed by the client
+            io_loop.remove_timeout(timeout)
+            connection.close()
+            return
+        if b"\r\n" not in data and len(data) < MAX_REQUEST_LINE:
+            # Peeked data stays readable, check the rest of the line later
+            io_loop.call_later(
+                interval,
+                self._wait_request_line,
+                connection,
+                address,
+                timeout,
+                min(interval * 2, MAX_PEEK_INTERVAL),
+            )
+            return
+        io_loop.remove_timeout(timeout)
+        self._dispatch(connection, address, data.split(b"\r\n", 1)[0])
+
+    def _dispatch(self, connection, address, line):
+        index = self.route(line)
+        pending = self._pending[index]
+        if len(pending) >= MAX_PENDING_CONNECTIONS:
+            LOGGER.warning("Worker {} is too slow, closing connection".format(index))
+            connection.close()
+            return
+        pending.append((json.dumps(address[:2]).encode("utf-8"), connection))
+        if index not in self._waiting:
+            self._send_pending(index)
+
+    def _send_pending(self, index):
+        channel = self.channels[index]
+        pending = self._pending[index]
+        while pending:
+            message, connection = pending[0]
+            try:
+                send_connection(channel, message, connection.fileno())
+            except BlockingIOError:
+                if index not in self._waiting:
+                    self._waiting.add(index)
+                    IOLoop.current().add_handler(
+                        channel, lambda *_: self._send_pending(index), IOLoop.WRITE
+                    )
+                return
+            except OSError as exc:
+                LOGGER.warning(
+                    "Cannot dispatch connection to worker {}: {}".format(index, exc)
+                )
+            pending.popleft()
+            # Worker has its own copy of the connection
+            connection.close()
+        if index in self._waiting:
+            self._waiting.remove(index)
+            IOLoop.current().remove_handler(channel)
+
+
+class ConnectionReceiver:
+    """Class that serves the connections received from the dispatcher."""
+
+    def __init__(self, channel, server):
+        self.channel = channel
+        self.server = server
+        channel.setblocking(False)
+
+    def start(self):
+        """Start receiving connections."""
+        IOLoop.current().add_handler(self.channel, self._receive, IOLoop.READ)
+
+    def stop(self):
+        """Stop receiving connections."""
+        IOLoop.current().remove_handler(self.channel)
+
+    def _receive(self, channel, _):
+        try:
+            message, fds = receive_connection(channel)
+        except BlockingIOError:
+            return
+        if not fds:
+            # Dispatcher is gone
+            self.stop()
+            IOLoop.current().stop()
+            return
+        connection = socket.socket(fileno=fds[0])
+        connection.setblocking(False)
+        address = tuple(json.loads(message))
+        self.server.handle_stream(IOStream(connection), address)
+
+
+def _drain_worker_on_signal(io_loop, application, drain_timeout, retry_after):
+    """Drain the websockets of a worker on SIGTERM, then stop it."""
+
+    async def _shutdown():
+        if application.draining is not None:
+            return
+        await application.drain(drain_timeout, retry_after)
+        io_loop.stop()
+
+    io_loop.asyncio_loop.add_signal_handler(
+        signal.SIGTERM, io_loop.spawn_callback, _shutdown
+    )
+
+
+def _run_worker(
+    index, channel, make_application, inherited, drain_timeout, retry_after
+):
+    # Only the dispatcher keeps the other ends of the channels
+    for sock in inherited:
+        sock.close()
+    # Workers forked on a reload must not use the event loop and the signal
+    # handlers of the dispatcher
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    application = make_application(index)
+    receiver = ConnectionReceiver(channel, HTTPServer(application))
+    receiver.start()
+    io_loop = IOLoop.current()
+    _drain_worker_on_signal(io_loop, application, drain_timeout, retry_after)
+    try:
+        io_loop.start()
+    except KeyboardInterrupt:
+        pass
+    if application.draining is None:
+        application.stop()
+
+
+class WorkerPool:
+    """Class that runs worker processes behind a dispatcher.
+
+    On `reload`, new workers are forked and dispatched the new connections
+    while the previous ones drain their websockets, see
+    `WebApplication.drain`. The process of the pool keeps running and
+    listening, so it can be the main process of a container or of a systemd
+    service.
+    """
+
+    def __init__(
+        self,
+        count,
+        make_application,
+        drain_timeout=DRAIN_TIMEOUT,
+        retry_after=RETRY_AFTER,
+    ):
+        self.count = count
+        self.make_application = make_application
+        self.drain_timeout = drain_timeout
+        self.retry_after = retry_after
+        self.dispatcher = None
+        self.workers = []
+        self.stopping = False
+
+    def start(self, sockets):
+        """Fork the workers and dispatch the connections of sockets to them."""
+        # Workers don't keep the sockets of the dispatcher
+        inherited = list(sockets)
+        if self.dispatcher is not None:
+            inherited += self.dispatcher.channels
+        context = multiprocessing.get_context("fork")
+        channels = []
+        workers = []
+        for index in range(self.count):
+            parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            worker = context.Process(
+                target=_run_worker,
+                args=(
+                    index,
+                    child,
+                    self.make_application,
+                    inherited + channels + [parent],
+                    self.drain_timeout,
+                    self.retry_after,
+                ),
+                name="iotlabwebsocket-worker-{}".format(index),
+            )
+            worker.start()
+            child.close()
+            channels.append(parent)
+            workers.append(worker)
+        self.dispatcher = Dispatcher(channels)
+        self.dispatcher.accept(sockets)
+        self.workers = workers
+
+    async def reload(self):
+        """Replace the workers by new ones, drain the previous ones."""
+        if self.stopping:
+            return
+        LOGGER.info("Reloading {} workers".format(self.count))
+        dispatcher, workers = self.dispatcher, self.workers
+        dispatcher.stop(close=False)
+        self.start(dispatcher.sockets)
+        await self._drain(dispatcher, workers)
+
+    async def stop(self):
+        """Stop accepting connections, drain the websockets of all workers."""
+        if self.stopping:
+            return
+        self.stopping = True
+        self.dispatcher.stop()
+        await self._drain(self.dispatcher, self.workers)
+        # Workers of a reload still draining
+        while multiprocessing.active_children():
+            await gen.sleep(DRAIN_INTERVAL)
+
+    @staticmethod
+    async def _drain(dispatcher, workers):
+        # SIGTERM makes the workers drain their websockets
+        for worker in workers:
+            worker.terminate()
+        while any(worker.is_alive() for worker in workers):
+            await gen.sleep(DRAIN_INTERVAL)
+        for channel in dispatcher.channels:
+            channel.close()
+
+
+def _reload_on_signals(io_loop, pool):
+    """Reload the workers on SIGHUP, drain them and stop on SIGTERM."""
+
+    async def _shutdown():
+        await pool.stop()
+        io_loop.stop()
+
+    io_loop.asyncio_loop.add_signal_handler(
+        signal.SIGHUP, io_loop.spawn_callback, pool.reload
+    )
+    io_loop.asyncio_loop.add_signal_handler(
+        signal.SIGTERM, io_loop.spawn_callback, _shutdown
+    )
+
+
+def run_workers(
+    count, port, make_application, drain_timeout=DRAIN_TIMEOUT, retry_after=RETRY_AFTER
+):
+    """Serve port with count worker processes.
+
+    `make_application` is called in each worker, with the index of the
+    worker, to create its application. On SIGHUP, the workers are replaced
+    by new ones, on SIGTERM they are stopped. Either way, they drain their
+    websockets for up to `drain_timeout` seconds.
+    """
+    pool = WorkerPool(count, make_application, drain_timeout, retry_after)
+    pool.start(bind_sockets(port))
+    LOGGER.info("Dispatching connections on port {} to {} workers".format(port, count))
+    io_loop = IOLoop.current()
+    _reload_on_signals(io_loop, pool)
+    try:
+        io_loop.start()
+    except KeyboardInterrupt:
+        LOGGER.debug("Shuting down workers")
+        for worker in multiprocessing.active_children():
+            os.kill(worker.pid, signal.SIGINT)
+    for worker in multiprocessing.active_children():
+        worker.join()
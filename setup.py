@@ -45,6 +45,9 @@ if __name__ == "__main__":
         install_requires=[
             "tornado>=6.1",
         ],
+        extras_require={
+            "uvloop": ["uvloop"],
+        },
         classifiers=[
             "Development Status :: 4 - Beta",
             "Programming Language :: Python :: 3.6",